@@ -0,0 +1,229 @@
+## @author: agent <agent@local>
+## @file :  Cache.py
+## @purpose: a little on-disk cache for (pickled) PyCmt results, so they can
+##           be shared across processes. Entries are validated against the
+##           stamps (mtime, size) of the files they were derived from.
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__author__  = "agent <agent@local>"
+
+__all__ = [
+    'cache_dir',
+    'cache_key',
+    'file_stamp',
+    'load',
+    'dump',
+    'remove',
+    'fingerprint',
+    'lookup',
+    'store',
+    'evict',
+    ]
+
+import os
+import os.path as osp
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+## bump this whenever the layout of the cached entries changes
+CACHE_VERSION = 2
+
+def cache_dir():
+    """return the top-level directory holding the PyCmt caches.
+    it can be redirected via the $PYCMT_CACHEDIR environment variable.
+    """
+    d = os.environ.get('PYCMT_CACHEDIR')
+    if not d:
+        d = osp.join(osp.expanduser('~'), '.cache', 'pycmt')
+    return d
+
+def cache_key(*args):
+    """return a (hex) digest of the `repr` of `args`"""
+    import hashlib
+    return hashlib.sha1(repr(args)).hexdigest()
+
+def _cache_fname(kind, key):
+    return osp.join(cache_dir(), kind, '%s.pkl' % key)
+
+def file_stamp(fname):
+    """return the (mtime, size) stamp of `fname` or None if it does not exist
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def load(kind, key):
+    """load the entry `key` from the cache `kind`.
+    return None if there is no such entry or if any of the files it depends
+    upon changed since it was stored.
+    """
+    fname = _cache_fname(kind, key)
+    try:
+        with open(fname, 'rb') as f:
+            entry = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        return None
+    for dep, stamp in entry['stamps'].iteritems():
+        if file_stamp(dep) != stamp:
+            return None
+    return entry['data']
+
+def dump(kind, key, data, files=()):
+    """store `data` as the entry `key` of the cache `kind`.
+    `files` is the list of files `data` has been derived from: the entry is
+    invalidated as soon as one of them changes.
+    the entry is written atomically so concurrent processes can share it.
+    return True on success.
+    """
+    fname = _cache_fname(kind, key)
+    entry = {
+        'version': CACHE_VERSION,
+        'stamps':  dict((f, file_stamp(f)) for f in files),
+        'data':    data,
+        }
+    return _write(fname, entry) is not None
+
+def _write(fname, entry):
+    """pickle `entry` into `fname`, atomically.
+    return the size of the file (None on failure)"""
+    import tempfile
+    tmp = None
+    try:
+        dirname = osp.dirname(fname)
+        if not osp.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not osp.isdir(dirname):     # not created concurrently
+                    raise
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.rename(tmp, fname)
+        tmp = None
+    except (IOError, OSError, TypeError, pickle.PicklingError):
+        return None
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+    return size
+
+def remove(kind, key):
+    """remove the entry `key` from the cache `kind` (if any)"""
+    try:
+        os.remove(_cache_fname(kind, key))
+    except OSError:
+        pass
+    return
+
+### content-addressed entries -------------------------------------------------
+# the entries of `lookup` and `store` are keyed on everything they depend
+# upon (see `fingerprint`): they are never invalidated, only evicted.
+
+def fingerprint(fname, content_hash=False):
+    """return the (path, mtime, size) of the file `fname` (plus the digest of
+    its content if `content_hash`), or (path, None) if it does not exist
+    """
+    fname = osp.abspath(fname)
+    stamp = file_stamp(fname)
+    if stamp is None:
+        return (fname, None)
+    if not content_hash:
+        return (fname,) + stamp
+    import hashlib
+    h = hashlib.sha1()
+    try:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), ''):
+                h.update(chunk)
+    except IOError:
+        return (fname, None)
+    return (fname,) + stamp + (h.hexdigest(),)
+
+def _entry_fname(kind, key):
+    # sharded, so directories stay small
+    return osp.join(cache_dir(), kind, key[:2], '%s.pkl' % key[2:])
+
+def lookup(kind, key):
+    """return the data of the content-addressed entry `key` of the cache
+    `kind`. raise KeyError if there is no such entry."""
+    fname = _entry_fname(kind, key)
+    try:
+        with open(fname, 'rb') as f:
+            entry = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, ValueError):
+        raise KeyError(key)
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        raise KeyError(key)
+    try:
+        os.utime(fname, None)            # most recently used, for `evict`
+    except OSError:
+        pass
+    return entry['data']
+
+_stored = {}   # kind -> bytes stored by this process since the last eviction
+
+def store(kind, key, data, max_size=None):
+    """store `data` as the content-addressed entry `key` of the cache `kind`.
+    the entry is written atomically so concurrent processes can share it.
+    if `max_size` (in bytes) is given, the least recently used entries are
+    evicted (see `evict`) from time to time to keep the cache below it.
+    return True on success.
+    """
+    size = _write(_entry_fname(kind, key),
+                  {'version': CACHE_VERSION, 'data': data})
+    if size is None:
+        return False
+    if max_size is not None:
+        # check the whole cache once we stored 1/16th of its allowed size
+        stored = _stored.get(kind, max_size) + size
+        if stored >= max_size // 16:
+            evict(kind, max_size)
+            stored = 0
+        _stored[kind] = stored
+    return True
+
+def evict(kind, max_size):
+    """remove the least recently used entries of the cache `kind` until it
+    holds at most 3/4 of `max_size` bytes (if it is above `max_size`).
+    return the number of removed entries.
+    """
+    entries = []
+    total = 0
+    topdir = osp.join(cache_dir(), kind)
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        for fn in filenames:
+            fname = osp.join(dirpath, fn)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+            total += st.st_size
+    if total <= max_size:
+        return 0
+    entries.sort()
+    nremoved = 0
+    for mtime, size, fname in entries:
+        if total <= max_size * 3 // 4:
+            break
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        total -= size
+        nremoved += 1
+    return nremoved
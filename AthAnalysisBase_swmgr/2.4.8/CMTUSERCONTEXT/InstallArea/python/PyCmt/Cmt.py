@@ -12,7 +12,10 @@ import os
 import commands
 import re
 import sys
+import itertools
+import contextlib
 import subprocess
+from array import array
 from string import rstrip
 
 ### monkey-patch subprocess (fwd compat w/ py-3.x) ----------------------------
@@ -20,8 +23,11 @@ import PyCmt.bwdcompat
 ### ---------------------------------------------------------------------------
 
 
-from PyCmt.Decorators import memoize
+from PyCmt.Decorators import memoize_method, persistent_memoize
+from PyCmt.Decorators import async_executor
+from PyCmt.Timing import timed
 import PyCmt.Logging as L
+import PyCmt.Cache as Cache
 
 class CmtOptions(object):
     ## the 'raw' names of the various Athena offline projects
@@ -111,81 +117,339 @@ class PkgTree(object):
     
     pass # PkgTree
 
+class _PkgGraphNode(object):
+    """a (light-weight) view on a package of a `PkgGraph`, providing the
+    `PkgNode` interface"""
+    __slots__ = ('_graph', '_id')
+    def __init__(self, graph, pkg_id):
+        self._graph = graph
+        self._id    = pkg_id
+
+    def cmtPkg(self):
+        return self._graph._cmt_pkg(self._id)
+
+    def keys(self):
+        g = self._graph
+        return [g._names[i] for i in g._adj(self._id, clients=False)]
+
+    def deps(self):
+        return self.keys()
+
+    def clients(self):
+        g = self._graph
+        return [g._names[i] for i in g._adj(self._id, clients=True)]
+
+    def __repr__(self):
+        return repr(dict((n, 1) for n in self.keys()))
+
+class PkgGraph(object):
+    """A compact (immutable) dependency graph of packages.
+    Packages are identified by integer ids, their names are interned and
+    the adjacency lists are stored CSR-like in arrays, for both directions
+    (dependencies and clients).
+    It provides the `PkgTree` interface (pkgs, getPkg, types, [])
+    """
+    __slots__ = ('_names', '_ids', '_versions', '_paths', '_projects',
+                 '_dep_off', '_dep', '_cli_off', '_cli')
+
+    def __init__(self, pkgs, edges):
+        """build the graph out of the list of `CmtPkg` `pkgs` and the
+        (unique) list of (package-id, dependency-id) `edges` where ids are
+        indices into `pkgs`.
+        """
+        object.__init__(self)
+        self._names    = [intern(p.name) for p in pkgs]
+        self._ids      = dict((n, i) for i, n in enumerate(self._names))
+        self._versions = [p.version for p in pkgs]
+        self._paths    = [p.path and intern(p.path) for p in pkgs]
+        self._projects = [p.project for p in pkgs]
+        n = len(self._names)
+        self._dep_off, self._dep = PkgGraph._csr(n, edges)
+        self._cli_off, self._cli = PkgGraph._csr(n, [(d, s) for s, d in edges])
+        return
+
+    @staticmethod
+    def _csr(n, edges):
+        """return the (offsets, targets) arrays of the `edges`"""
+        off = array('l', [0]) * (n+1)
+        for src, _ in edges:
+            off[src+1] += 1
+        for i in xrange(n):
+            off[i+1] += off[i]
+        adj = array('l', [0]) * len(edges)
+        pos = off[:-1]
+        for src, dst in edges:
+            adj[pos[src]] = dst
+            pos[src] += 1
+        return off, adj
+
+    @classmethod
+    def from_tree(cls, pkgTree):
+        """build a `PkgGraph` out of a `PkgTree`"""
+        names = sorted(pkgTree.pkgs().keys())
+        ids = dict((n, i) for i, n in enumerate(names))
+        pkgs = [pkgTree.getPkg(n).cmtPkg() for n in names]
+        edges = []
+        for i, n in enumerate(names):
+            for d in pkgTree.getPkg(n).deps():
+                if d in ids:
+                    edges.append((i, ids[d]))
+        return cls(pkgs, edges)
+
+    def _adj(self, pkg_id, clients=False):
+        if clients:
+            off, adj = self._cli_off, self._cli
+        else:
+            off, adj = self._dep_off, self._dep
+        return adj[off[pkg_id]:off[pkg_id+1]]
+
+    def _cmt_pkg(self, pkg_id):
+        return CmtPkg(self._names[pkg_id], self._versions[pkg_id],
+                      self._paths[pkg_id], self._projects[pkg_id])
+
+    def _to_ids(self, names):
+        if isinstance(names, basestring):
+            names = [names]
+        return [self._ids[n] for n in names if n in self._ids]
+
+    ## PkgTree interface
+    def getPkg(self, pkgName):
+        return _PkgGraphNode(self, self._ids[pkgName])
+
+    def pkgs(self):
+        return dict((n, _PkgGraphNode(self, i))
+                    for i, n in enumerate(self._names))
+
+    def types(self):
+        return dict.fromkeys(self._names, 1)
+
+    def __getitem__(self, n):
+        return self.getPkg(n)
+
+    def __contains__(self, n):
+        return n in self._ids
+
+    def __len__(self):
+        return len(self._names)
+
+    ## graph queries
+    def names(self):
+        return list(self._names)
+
+    def cmt_pkg(self, name):
+        """return the `CmtPkg` named `name`"""
+        return self._cmt_pkg(self._ids[name])
+
+    def deps(self, name):
+        """return the names of the direct dependencies of `name`"""
+        return self.getPkg(name).deps()
+
+    def clients(self, name):
+        """return the names of the direct clients of `name`"""
+        return self.getPkg(name).clients()
+
+    def _reach(self, names, clients, transitive=True, exclude=()):
+        """return the list of ids reachable from `names`, following
+        dependencies (or `clients`) and never going through `exclude`"""
+        seen = bytearray(len(self._names))
+        for i in self._to_ids(exclude):
+            seen[i] = 1
+        todo = self._to_ids(names)
+        out = []
+        while todo:
+            for i in self._adj(todo.pop(), clients):
+                if seen[i]:
+                    continue
+                seen[i] = 1
+                out.append(i)
+                if transitive:
+                    todo.append(i)
+        return out
+
+    def transitive_deps(self, names, exclude=()):
+        """return the sorted names of all the packages `names` (a name or a
+        list of names) depend upon, directly or not"""
+        return sorted(self._names[i]
+                      for i in self._reach(names, clients=False,
+                                           exclude=exclude))
+
+    def transitive_clients(self, names, exclude=()):
+        """return the sorted names of all the packages depending upon `names`
+        (a name or a list of names), directly or not"""
+        return sorted(self._names[i]
+                      for i in self._reach(names, clients=True,
+                                           exclude=exclude))
+
+    def topo_sort(self):
+        """return the names of all the packages, dependencies first.
+        raise ValueError if the graph has a cycle.
+        """
+        n = len(self._names)
+        ndeps = array('l', [self._dep_off[i+1] - self._dep_off[i]
+                            for i in xrange(n)])
+        ready = [i for i in xrange(n) if ndeps[i] == 0]
+        order = []
+        while ready:
+            i = ready.pop()
+            order.append(self._names[i])
+            for c in self._adj(i, clients=True):
+                ndeps[c] -= 1
+                if ndeps[c] == 0:
+                    ready.append(c)
+        if len(order) != n:
+            raise ValueError("dependency cycle among [%i] packages" %
+                             (n - len(order),))
+        return order
+
+    def shortest_path(self, src, dst):
+        """return the shortest chain of packages [src, ..., dst] such that
+        each package depends on the next one, or None if `src` does not
+        depend on `dst`"""
+        if src not in self._ids or dst not in self._ids:
+            return None
+        isrc, idst = self._ids[src], self._ids[dst]
+        prev = array('l', [-1]) * len(self._names)
+        prev[isrc] = isrc
+        from collections import deque
+        todo = deque([isrc])
+        while todo:
+            i = todo.popleft()
+            if i == idst:
+                path = [i]
+                while i != isrc:
+                    i = prev[i]
+                    path.append(i)
+                return [self._names[j] for j in reversed(path)]
+            for d in self._adj(i, clients=False):
+                if prev[d] < 0:
+                    prev[d] = i
+                    todo.append(d)
+        return None
+
+    pass # PkgGraph
+
+
+## patterns for the output of 'cmt show uses'
+_depLine   = re.compile( "#\s*?use.*?")
+_athenaDep = re.compile( "#(?P<PkgIndent>\s*?)use (?P<PkgName>\w*) (?P<PkgVers>.*?) (?P<PkgPath>.*?) (.*?)" )
+_gaudiDep  = re.compile( "#(?P<PkgIndent>\s*?)use (?P<PkgName>\w*) (?P<PkgVers>.*)" )
+_selection = re.compile(r'use (?P<PkgName>.*?) (?P<PkgVersion>.*?) (?P<PkgPath>.*?) [(].*[)]')
 
 def lineDecoder( line ):
-    depLine   = re.compile( "#\s*?use.*?")
-    if not re.match( depLine, line ):
+    if not _depLine.match( line ):
         return (None, None)
 
-    athenaDep = re.compile( "#(?P<PkgIndent>\s*?)use (?P<PkgName>\w*) (?P<PkgVers>.*?) (?P<PkgPath>.*?) (.*?)" )
-    gaudiDep  = re.compile( "#(?P<PkgIndent>\s*?)use (?P<PkgName>\w*) (?P<PkgVers>.*)" )
-    l = re.match( athenaDep, line ) or \
-        re.match( gaudiDep,  line )
+    l = _athenaDep.match( line ) or \
+        _gaudiDep.match( line )
     if l:
         pkgIndent = l.group('PkgIndent')
         pkgName   = l.group('PkgName')
         pkgVers   = l.group('PkgVers')
         try:
             pkgPath = l.group('PkgPath')
-        except:
+        except IndexError:
             pkgPath = None
             pass
     else:
         raise RuntimeError, "No decoding !!"
     return (len(pkgIndent)-1, CmtPkg( pkgName, pkgVers, pkgPath ))
 
-def buildDepGraph( fileName, pkgDb, msg ):
-    """ Build the dependency graph """
-    pkgTree = PkgTree()
-    pkgs = []
-    cmtFile = open( os.path.expanduser(os.path.expandvars(fileName)), 'r' )
-    for l in cmtFile.readlines():
+def parse_uses( lines, msg, pkgDb=None ):
+    """Parse the output of 'cmt show uses' in a single pass.
+    `lines` can be any iterable of lines (a file, a pipe, a list, ...)
+    If `pkgDb` is given, it is used to retrieve the 'right' version of the
+    packages instead of the selection part of the output.
+
+    Return: (pkgDb, pkgGraph) where pkgGraph is a `PkgGraph`
+    """
+    selection = {}
+    pkgs  = []      # first CmtPkg seen for each package
+    ids   = {}      # name -> index into pkgs
+    edges = {}      # (pkg-id, dep-id) -> 1
+    # last package seen at each indentation level: the parent of a package
+    # is the last one seen one level up
+    parents = {}
+    for l in lines:
         l = l.strip()
+        if not l.startswith('#'):
+            m = _selection.match( l )
+            if m:
+                pkgName = m.group('PkgName')
+                pkgVers = m.group('PkgVersion')
+                pkgPath = m.group('PkgPath')
+                msg.debug( "found [%s] [%s] [%s]", pkgName, pkgVers, pkgPath )
+                selection[pkgName] = CmtPkg( pkgName, pkgVers, pkgPath )
+            continue
+
         indent, pkg = lineDecoder( l )
         if not pkg:
             continue
         msg.verbose( "found [%3i] [%s]", indent, pkg.name )
-
-        # try to retrieve the 'right' version from the pkg Db
-        if pkgDb.has_key(pkg.name): pkg = pkgDb[pkg.name]
-        else: msg.warning( "[%s] is not in pkgDb !!", pkg.name )
-            
-        pkgTree.addPkg( pkg )
-        pkgs.append( { 'indent':indent, 'pkg': pkg } )
+        pkgId = ids.get( pkg.name )
+        if pkgId is None:
+            pkgId = ids[pkg.name] = len(pkgs)
+            pkgs.append( pkg )
+        parents[indent] = pkgId
         if indent == 0:
             continue
-        for p in reversed(pkgs):
-            pIndent    = p['indent']
-            parentName = p['pkg'].name
-            msg.verbose( "   processing [%3i] [%s]", pIndent, parentName )
-            if pIndent == indent - CmtOptions.deltaIndent:
-                pkgTree.getPkg(parentName).addDep( pkg.name )
-                msg.verbose( "   ==> [%s] depends on [%s]",
-                             parentName, pkg.name )
-                break
-            pass
-        pass
-    return pkgTree
+        parentId = parents.get( indent - CmtOptions.deltaIndent )
+        if parentId is not None:
+            edges[(parentId, pkgId)] = 1
+            msg.verbose( "   ==> [%s] depends on [%s]",
+                         pkgs[parentId].name, pkg.name )
+
+    if pkgDb is None:
+        pkgDb = selection
+    # try to retrieve the 'right' version from the pkg Db
+    for i, pkg in enumerate(pkgs):
+        if pkgDb.has_key(pkg.name): pkgs[i] = pkgDb[pkg.name]
+        else: msg.warning( "[%s] is not in pkgDb !!", pkg.name )
+    return selection, PkgGraph( pkgs, edges.keys() )
 
-def buildPkgDb( fileName, msg ):
+def buildDepGraph( fileName, pkgDb, msg ):
+    """ Build the dependency graph """
+    with open( os.path.expanduser(os.path.expandvars(fileName)), 'r' ) as cmtFile:
+        return parse_uses( cmtFile, msg, pkgDb )[1]
 
-    pattern = re.compile(r'use (?P<PkgName>.*?) (?P<PkgVersion>.*?) (?P<PkgPath>.*?) [(].*[)]')
-    cmtFile = open( os.path.expanduser(os.path.expandvars(fileName)), 'r' )
-    pkgDb = { }
-    for l in cmtFile:
-        l = l.strip()
-        
-        l = re.match( pattern, l )
-        if l:
-            pkgName = l.group('PkgName')
-            pkgVers = l.group('PkgVersion')
-            pkgPath = l.group('PkgPath')  
-            msg.debug( "found [%s] [%s] [%s]", pkgName, pkgVers, pkgPath )
-            pkgDb[pkgName] = CmtPkg( pkgName, pkgVers, pkgPath )
-            pass
-    
+def buildPkgDb( fileName, msg ):
+    pkgDb = {}
+    with open( os.path.expanduser(os.path.expandvars(fileName)), 'r' ) as cmtFile:
+        for l in cmtFile:
+            l = _selection.match( l.strip() )
+            if l:
+                pkgName = l.group('PkgName')
+                pkgVers = l.group('PkgVersion')
+                pkgPath = l.group('PkgPath')  
+                msg.debug( "found [%s] [%s] [%s]", pkgName, pkgVers, pkgPath )
+                pkgDb[pkgName] = CmtPkg( pkgName, pkgVers, pkgPath )
     return pkgDb
 
+_macroLine = re.compile(r"^(?P<Name>[\w.-]+)='(?P<Value>.*)$")
+
+def parse_macros( lines ):
+    """parse the output of 'cmt show macros' (lines of the form name='value',
+    where value may span multiple lines) into a dict of name -> value
+    """
+    macros = {}
+    name = None
+    for l in lines:
+        l = l.rstrip('\r\n')
+        if name is None:
+            m = _macroLine.match(l)
+            if m is None:
+                continue
+            name, value = m.group('Name'), [m.group('Value')]
+        else:
+            value.append(l)
+        if value[-1].endswith("'"):
+            macros[name] = '\n'.join(value)[:-1]
+            name = None
+    return macros
+
+@persistent_memoize(
+    depends_on=lambda fname, msg: [os.path.expanduser(os.path.expandvars(fname))],
+    ignore=('msg',))
+@timed
 def extract_uses(fname, msg):
     cmtFile = open(os.path.expanduser(os.path.expandvars(fname)), 'r')
     pkgDb = { }
@@ -210,6 +474,66 @@ def extract_uses(fname, msg):
             msg.error('unexpected line content: %s', pkg)
     return pkgDb
     
+def _which(exe):
+    """return the full path to the executable `exe` found in $PATH, or None
+    """
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        fname = os.path.join(d, exe)
+        if os.path.isfile(fname) and os.access(fname, os.X_OK):
+            return fname
+    return None
+
+class ClientsIndex(object):
+    """the reverse-dependency graph of a set of packages: for each package,
+    the list of packages 'use'-ing it.
+    """
+    def __init__(self, graph, exclude=()):
+        """
+         `graph`   the `PkgGraph` of the packages
+         `exclude` names of packages never reported as clients
+        """
+        object.__init__(self)
+        self._graph = graph
+        self._exclude = sorted(exclude)
+        return
+
+    @classmethod
+    def from_tree(cls, pkgTree, exclude=()):
+        """build the index out of a `PkgTree` (or a `PkgGraph`)"""
+        if not isinstance(pkgTree, PkgGraph):
+            pkgTree = PkgGraph.from_tree(pkgTree)
+        return cls(pkgTree, exclude)
+
+    @property
+    def graph(self):
+        return self._graph
+
+    def pkg(self, name):
+        """return the `CmtPkg` named `name` (or None)"""
+        if name not in self._graph or name in self._exclude:
+            return None
+        return self._graph.cmt_pkg(name)
+
+    def client_names(self, names, transitive=False):
+        """return the sorted list of (leaf) names of the clients of `names`
+        (a package name or a list of names)"""
+        g = self._graph
+        if transitive:
+            return g.transitive_clients(names, exclude=self._exclude)
+        return sorted(g._names[i]
+                      for i in g._reach(names, clients=True, transitive=False,
+                                        exclude=self._exclude))
+
+    def clients(self, names, transitive=False):
+        """return the list of `CmtPkg` clients of `names` (a package name or
+        a list of names), sorted by name.
+         `transitive` also return the clients of the clients (and so on)
+        """
+        return [self._graph.cmt_pkg(c)
+                for c in self.client_names(names, transitive=transitive)]
+
+    pass # ClientsIndex
+
 class CmtPkg(object):
     def __init__( self,
                   pkgName,
@@ -268,7 +592,13 @@ class CmtWrapper(object):
     A python wrapper around CMT
     """
 
-    def __init__(self, lvl = L.logging.INFO, shell=None):
+    def __init__(self, lvl = L.logging.INFO, shell=None,
+                 use_cache=True, refresh_cache=False):
+        """
+         `use_cache`     use the on-disk cache of the projects tree
+                         (can also be disabled via $PYCMT_NO_CACHE)
+         `refresh_cache` discard the on-disk cache and re-run cmt.exe
+        """
         object.__init__(self)
         self.msg = L.logging.getLogger("Cmt")
         self.msg.setLevel(lvl)
@@ -276,7 +606,14 @@ class CmtWrapper(object):
             self.shell = subprocess
         else:
             self.shell = shell
-        sc,self.bin = self.shell.getstatusoutput("which cmt.exe")
+        self.use_cache = use_cache and not os.environ.get('PYCMT_NO_CACHE')
+        self.refresh_cache = refresh_cache
+        self.bin = None
+        if self.shell is subprocess:
+            # avoid a fork for the usual case
+            self.bin = _which("cmt.exe")
+        if self.bin is None:
+            sc,self.bin = self.shell.getstatusoutput("which cmt.exe")
 
         # make sure we have a correct and sound CMT environment
         assert len(self.projects())>0, "no projects found: corrupted CMT environment ?"
@@ -284,6 +621,7 @@ class CmtWrapper(object):
         
         return
 
+    @timed
     def check_out(self, pkgFullName, pkgVersion = None):
         """check a package out of the source repository
          `pkgFullName` the complete and full path name to that pkg.
@@ -309,13 +647,73 @@ class CmtWrapper(object):
     # bwd compat
     checkOut = check_out
     
-    @memoize
+    @memoize_method(maxsize=1)
     def projects(self):
         return [ p.path for p in self.project_tree().itervalues() ]
 
-    @memoize
+    def _getenv(self, name):
+        """return the value of the environment variable `name` as seen by
+        the shell cmt.exe is run from"""
+        getenv = getattr(self.shell, 'getenv', None) or os.getenv
+        return getenv(name) or ''
+
+    def _getcwd(self):
+        getcwd = getattr(self.shell, 'getcwd', None) or os.getcwd
+        return getcwd()
+
+    def _projects_tree_key(self):
+        """return the key of the on-disk cache entry for the projects tree
+        and the (optional) project.cmt file of the current project"""
+        env = [(k, self._getenv(k)) for k in (CmtStrings.CMTPATH,
+                                              CmtStrings.CMTPROJECTPATH,
+                                              'CMTCONFIG',
+                                              'CMTROOT')]
+        # 'cmt show projects' also picks up the project enclosing the
+        # current directory (if any)
+        cur_proj = None
+        d = self._getcwd()
+        while d and d != os.sep:
+            projfile = os.path.join(d, CmtStrings.CMTDIR,
+                                    CmtStrings.CMTPROJFILE)
+            if os.path.exists(projfile):
+                cur_proj = projfile
+                break
+            d = os.path.dirname(d)
+        return Cache.cache_key(self.bin, env, cur_proj), cur_proj
+
+    @memoize_method(maxsize=1)
     def projects_tree(self):
-        """return an (unordered) tree of all the projects"""
+        """return an (unordered) tree of all the projects.
+        the tree is cached on disk (see PyCmt.Cache), keyed on the CMT
+        environment and validated against the project.cmt files involved.
+        """
+        if not self.use_cache:
+            return self._projects_tree()
+
+        key, cur_proj = self._projects_tree_key()
+        if self.refresh_cache:
+            Cache.remove('projects_tree', key)
+        else:
+            proj_tree = Cache.load('projects_tree', key)
+            if proj_tree is not None:
+                self.msg.debug("projects tree loaded from cache [%s]", key)
+                return proj_tree
+
+        proj_tree = self._projects_tree()
+        projfiles = [os.path.join(p.path,
+                                  CmtStrings.CMTDIR,
+                                  CmtStrings.CMTPROJFILE)
+                     for p in proj_tree.itervalues()
+                     if p.path]
+        if cur_proj is not None:
+            projfiles.append(cur_proj)
+        if len(proj_tree) > 0:
+            Cache.dump('projects_tree', key, proj_tree, files=projfiles)
+        return proj_tree
+
+    @timed
+    def _projects_tree(self):
+        """build the projects tree out of 'cmt show projects'"""
         dec = re.compile(r"(?P<ProjIndent>\s*?)"\
                           "(?P<ProjName>[-_.\w]*?) "\
                           "(?P<ProjVersion>[-_.\w/]*?) "\
@@ -388,7 +786,8 @@ class CmtWrapper(object):
         return proj_tree
     project_tree = projects_tree
     
-    @memoize
+    @memoize_method()
+    @timed
     def project_deps (self, proj_name):
         "return the list of projects a given project is depending upon"
         proj_tree = self.project_tree()
@@ -406,7 +805,8 @@ class CmtWrapper(object):
         deps = set([c for c in _collect_children (proj_tree, proj_name)])
         return list(deps)
 
-    @memoize
+    @memoize_method()
+    @timed
     def project_release (self, proj_name):
         """helper method to return the xyzRelease for a given project
         this is to handle some idiosyncracies of different projects
@@ -418,7 +818,8 @@ class CmtWrapper(object):
         else:
             return "%sRelease"%proj_name
 
-    @memoize
+    @memoize_method(maxsize=1)
+    @timed
     def projects_dag(self):
         """return the (flatten) directed acyclic graph of all the
         currently used project(name)s
@@ -444,45 +845,120 @@ class CmtWrapper(object):
     # bwd compat
     project_dag = projects_dag
 
-    @memoize
+    @memoize_method()
+    @timed
     def release_metadata(self, project=None):
         """return
         """
         return
     
-    @memoize
-    def find_pkg(self, name):
-        """Find CMT package by (leaf)name.
-
-        Return: CmtPkg or None if not found
+    @timed
+    def release_requirements(self):
+        """return the list of (project, path-to-*Release/cmt/requirements)
+        for all the projects of the release, in DAG order.
         """
-        import os
-        osp = os.path
-        # Loop over all *Release/cmt/requirements files
+        reqs = []
         for proj in self.projects_dag():
             reqpath = os.path.join(proj.path,
                                    self.project_release(proj.name),
                                    CmtStrings.CMTDIR,
                                    CmtStrings.CMTREQFILE)
-            if os.path.exists(reqpath):
-                pkgs = open(reqpath, 'r').readlines()
-                pkgs = (l.strip() for l in pkgs)
-                pkgs = (l for l in pkgs if l.startswith('use '))
-                pkgs = (l[len('use '):] for l in pkgs)
-                pkgs = (l.split() for l in pkgs if name in l)
-                for fields in pkgs:
-                    if len(fields)>0 and fields[0]==name:
-                        if len(fields)==3:
-                            return CmtPkg(fields[0],fields[1],fields[2])
-                        elif len(fields)==2:
-                            return CmtPkg(fields[0],fields[1],"")
-
-    @memoize
+            reqs.append((proj, reqpath))
+        return reqs
+
+    @memoize_method(maxsize=1)
+    @timed
+    def pkg_index(self):
+        """return the index of all the packages of the release, as a dict of
+        (leaf)name -> CmtPkg. The `project` attribute of each CmtPkg holds
+        the name of the project providing that package.
+        The index is built in one pass over all the *Release/cmt/requirements
+        files: when a package is provided by many projects, the one coming
+        first in the projects DAG wins.
+        """
+        index = {}
+        for proj, reqpath in self.release_requirements():
+            if not os.path.exists(reqpath):
+                continue
+            with open(reqpath, 'r') as reqfile:
+                for l in reqfile:
+                    l = l.strip()
+                    if not l.startswith('use '):
+                        continue
+                    fields = l[len('use '):].split()
+                    if len(fields) not in (2, 3) or fields[0] in index:
+                        continue
+                    pkg_path = fields[2] if len(fields) == 3 else ""
+                    index[fields[0]] = CmtPkg(fields[0], fields[1], pkg_path,
+                                              projName=proj.name)
+        self.msg.debug("indexed [%i] packages", len(index))
+        return index
+
+    def find_pkg(self, name):
+        """Find CMT package by (leaf)name.
+
+        Return: CmtPkg or None if not found
+        """
+        return self.pkg_index().get(name)
+
+    def find_pkgs(self, names):
+        """Find a list of CMT packages by (leaf)name.
+
+        Return: dict of name -> CmtPkg (or None if not found)
+        """
+        index = self.pkg_index()
+        return dict((name, index.get(name)) for name in names)
+
+    @memoize_method(maxsize=4096)
     def get_pkg_version(self, fullPkgName):
         """Return the package tag in the current release for `fullPkgName`.
 
         Return: Tag or None
         """
+        return self.get_pkg_versions([fullPkgName])[fullPkgName]
+
+    @timed
+    def get_pkg_versions(self, fullPkgNames, max_workers=8):
+        """Return the package tags in the current release for all the
+        packages in the `fullPkgNames` list.
+        Packages are first looked up in the release package index (see
+        `pkg_index`). The remaining ones are resolved via 'cmt show versions',
+        running at most `max_workers` of them concurrently (and at most 8
+        for all the wrappers, see `_show_version_async`).
+
+        Return: dict of fullPkgName -> Tag (or None)
+        """
+        versions = {}
+        todo = []
+        index = self.pkg_index()
+        for full_name in fullPkgNames:
+            if full_name in versions:
+                continue
+            pkg = index.get(os.path.basename(full_name))
+            if (pkg is not None and
+                pkg.full_name == os.path.normpath(full_name)):
+                versions[full_name] = pkg.version
+            else:
+                versions[full_name] = None
+                todo.append(full_name)
+
+        if not todo:
+            return versions
+        self.msg.debug("running 'cmt show versions' for [%i] packages...",
+                       len(todo))
+        if self.shell is subprocess and len(todo) > 1 and max_workers > 1:
+            results = list(self._show_version_async.map(
+                itertools.repeat(self), todo, max_pending=max_workers))
+        else:
+            # a shell-bound wrapper can only run one command at a time
+            results = [self._show_version(n) for n in todo]
+        versions.update(zip(todo, results))
+        return versions
+
+    @timed
+    def _show_version(self, fullPkgName):
+        """run 'cmt show versions' and return the first tag not coming
+        from the $TestArea"""
         _cmd = "%s show versions %s" % (self.bin, fullPkgName)
         self.msg.debug('running [%s]...', _cmd)
         p = self.shell.Popen(_cmd, stdout = subprocess.PIPE, shell=True)
@@ -493,10 +969,21 @@ class CmtWrapper(object):
             if (testArea and cmtline.find(testArea)!=-1): continue
             version = cmtline.split(" ")[1]
             break
-
+        p.stdout.close()
+        p.wait()
         return version
 
-    
+    ## the 'cmt show versions' and 'svn ls' fan-outs of all the wrappers run
+    ## in bounded pools of threads
+    @async_executor(max_workers=8)
+    def _show_version_async(self, fullPkgName):
+        return self._show_version(fullPkgName)
+
+    @async_executor(max_workers=8)
+    def _latest_pkg_tag_async(self, fullPkgName):
+        return self.get_latest_pkg_tag(fullPkgName)
+
+    @timed
     def get_latest_pkg_tag(self, fullPkgName):
         """Return the most recent SVN tag of the package.
 
@@ -525,99 +1012,153 @@ class CmtWrapper(object):
         latest_tag = rstrip(tags[-1],"/\n ")
         return latest_tag
 
-    def show_clients(self, pkgName):
-        """return the list of clients of a given `pkgName` CMT package
-        Note: `pkgName` is the leaf name of a package (not its fullname)
-        """
-        if pkgName.count(os.sep):
-            raise RuntimeError, "pkgName contains a %s !!" % os.sep
-        clientList = []
+    @timed
+    def get_latest_pkg_tags(self, fullPkgNames, timeout=None):
+        """Return the most recent SVN tags of all the packages in the
+        `fullPkgNames` list, running at most 8 'svn ls' concurrently.
+        Packages whose tag is not known after `timeout` seconds are reported
+        as None (and their pending 'svn ls' cancelled).
 
-        proj_deps = self.project_deps('AtlasOffline') + ['AtlasOffline']
-        #proj_deps = ['AtlasOffline']
+        Return: dict of fullPkgName -> Tag (or None on error)
+        """
+        from PyCmt.Futures import as_completed, TimeoutError
+        names = set(fullPkgNames)
+        tags = dict.fromkeys(names)
+        fs = dict((self._latest_pkg_tag_async(n), n) for n in names)
+        try:
+            for f in as_completed(fs, timeout):
+                if f.exception() is None:
+                    tags[fs[f]] = f.result()
+                else:
+                    self.msg.error("could not get the tags of [%s]: %s",
+                                   fs[f], f.exception())
+        except TimeoutError:
+            self.msg.warning("'svn ls' timed out for [%i] packages",
+                             len([f for f in fs if not f.done()]))
+        finally:
+            for f in fs:
+                f.cancel()
+        return tags
+
+    def _clients_index_projects(self):
+        """return the list of projects the clients index is built from"""
+        return self.project_deps('AtlasOffline') + ['AtlasOffline']
+
+    def _release_reqfiles(self, projects):
+        """return the *Release/cmt/requirements files of `projects`"""
+        tree = self.projects_tree()
+        return [os.path.join(tree[p].path,
+                             self.project_release(p),
+                             CmtStrings.CMTDIR,
+                             CmtStrings.CMTREQFILE)
+                for p in projects]
+
+    @memoize_method(maxsize=1)
+    def clients_index(self):
+        """return the reverse-dependency index (a `ClientsIndex`) of all the
+        packages used by the AtlasOffline projects.
+        the index is built once (via 'cmt show uses') and then cached on disk
+        until one of the projects' *Release/cmt/requirements files changes.
+        """
+        proj_deps = self._clients_index_projects()
+        reqfiles = self._release_reqfiles(proj_deps)
+        key = Cache.cache_key(self.bin, reqfiles)
+        if self.use_cache and not self.refresh_cache:
+            index = Cache.load('clients_index', key)
+            if index is not None:
+                self.msg.debug("clients index loaded from cache [%s]", key)
+                return index
+
+        index = self._build_clients_index(proj_deps)
+        if self.use_cache:
+            Cache.dump('clients_index', key, index, files=reqfiles)
+        return index
+
+    @timed
+    def _build_clients_index(self, proj_deps):
+        """build the `ClientsIndex` of the packages used by all the
+        <AtlasProject>Release packages of the `proj_deps` projects
+        """
         self.msg.info( "building dependencies..." )
         self.msg.info( "projects used: %r", proj_deps )
         
         projReleases = [self.project_release(p) for p in proj_deps ]
         ## create a temporary directory containing a CMT package 'use'-ing
         ## all <AtlasProject>Release packages
-        import tempfile
+        import tempfile, shutil
+        pkgName = "ClientsIndex"
         tmpRoot = tempfile.mkdtemp()
         cwd = os.getcwd()
-        os.chdir( tmpRoot )
-        cmtTmpDir = os.path.join( "Dep%s" % pkgName, "cmt" )
-        if not os.path.exists( cmtTmpDir ):
-            os.makedirs( cmtTmpDir )
-        os.chdir( cmtTmpDir )
-
-        with open( 'requirements', 'w' ) as req:
-            print >> req, "package Dep%s" % pkgName
-            print >> req, ""
-            print >> req, "author DependenciesViewer"
-            print >> req, ""
-            for p in projReleases:
-                print >> req, "use %s %s-*" % (p,p)
-            print >> req, ""
-            req.flush()
-
-        if 0:
-            print "+"*80
-            with open('requirements', 'r') as req:
-                for l in req:
-                    print l,
-            print "+"*80
-                
-        with open('version.cmt', 'w') as cmt_version:
-            print >> cmt_version, "Dep%s-00-00-00" % (pkgName,)
-            print >> cmt_version, ""
-            cmt_version.flush()
-
-        _cmd = "%s config >& /dev/null" % self.bin
-        self.msg.debug('running [%s]...', _cmd)
-        sc = self.shell.check_call(_cmd, shell=True)
-        if sc:
-            raise RuntimeError(
-                "could not configure Dep%s package" % (pkgName,)
-                )
-
-        f_use_name = os.path.join(tmpRoot,cmtTmpDir,pkgName)
-        f_use_name = "%s.cmt" % f_use_name
-        _cmd =  "%s show uses > %s" % (self.bin, f_use_name)# pkgName)
-        self.msg.debug('running [%s]...', _cmd)
-        sc = self.shell.call(_cmd, shell=True)
-        if sc:
-            self.msg.warning("problem running command [%s]", _cmd)
-            self.msg.warning("(ignoring it as I am resilient)")
-        del f_use_name
-        
-        self.msg.info( "building packages db..." )
-        pkgDb   = buildPkgDb( "%s.cmt" % pkgName, self.msg )
+        try:
+            os.chdir( tmpRoot )
+            cmtTmpDir = os.path.join( "Dep%s" % pkgName, "cmt" )
+            if not os.path.exists( cmtTmpDir ):
+                os.makedirs( cmtTmpDir )
+            os.chdir( cmtTmpDir )
+
+            with open( 'requirements', 'w' ) as req:
+                print >> req, "package Dep%s" % pkgName
+                print >> req, ""
+                print >> req, "author DependenciesViewer"
+                print >> req, ""
+                for p in projReleases:
+                    print >> req, "use %s %s-*" % (p,p)
+                print >> req, ""
+                req.flush()
+
+            with open('version.cmt', 'w') as cmt_version:
+                print >> cmt_version, "Dep%s-00-00-00" % (pkgName,)
+                print >> cmt_version, ""
+                cmt_version.flush()
+
+            # the shell may be a long-lived one: run from the package dir
+            _cmd = "cd %s && %s config > /dev/null 2>&1" % (
+                os.path.join(tmpRoot, cmtTmpDir), self.bin)
+            self.msg.debug('running [%s]...', _cmd)
+            sc,out = self.shell.getstatusoutput(_cmd)
+            if sc:
+                raise RuntimeError(
+                    "could not configure Dep%s package" % (pkgName,)
+                    )
+
+            _cmd = "cd %s && %s show uses" % (
+                os.path.join(tmpRoot, cmtTmpDir), self.bin)
+            self.msg.debug('running [%s]...', _cmd)
+            sc,out = self.shell.getstatusoutput(_cmd)
+
+            self.msg.info( "building packages db and dependency tree..." )
+            pkgDb, pkgTree = parse_uses( out.splitlines(), self.msg )
+            if sc:
+                self.msg.warning("problem running command [%s]", _cmd)
+                self.msg.warning("(ignoring it as I am resilient)")
+        finally:
+            os.chdir( cwd )
+            shutil.rmtree( tmpRoot, ignore_errors=True )
+
+        return ClientsIndex.from_tree(pkgTree,
+                                      exclude=projReleases+["Dep"+pkgName])
+
+    @timed
+    def show_clients(self, pkgName, transitive=False):
+        """return the list of clients of a given `pkgName` CMT package
+        Note: `pkgName` is the leaf name of a package (not its fullname)
+         `transitive` also return the clients of the clients (and so on)
+        """
+        if pkgName.count(os.sep):
+            raise RuntimeError, "pkgName contains a %s !!" % os.sep
 
-        self.msg.info( "building packages dependency tree..." )
-        pkgTree = buildDepGraph( "%s.cmt" % pkgName, pkgDb, self.msg )
-        
-        os.chdir( cwd )
-        
-        pkgs = pkgTree.pkgs()
-        keys = sorted(pkgs.keys())
-        for k in keys:
-            self.msg.verbose("-> %s: %s",k,pkgs[k].deps())
-            if pkgName in pkgs[k].deps() and not k in clientList and \
-               not k in projReleases :
-                client = pkgTree.getPkg(k).cmtPkg()
-                clientList.append( client )
-                self.msg.info( "=> [%s] (%s)",
-                               client.fullName(), client.version )
-                pass
-        import shutil
-        shutil.rmtree( tmpRoot )
+        clientList = self.clients_index().clients(pkgName,
+                                                  transitive=transitive)
+        for client in clientList:
+            self.msg.info( "=> [%s] (%s)",
+                           client.fullName(), client.version )
         
         self.msg.info( "Found [%i] clients for [%s]",
                        len(clientList), pkgName )
         return clientList
-    # bwd compat
     showClients = show_clients
     
+    @timed
     def slowShowClients(self, pkgName):
         if pkgName.count(os.sep):
             raise RuntimeError, "pkgName contains a %s !!" % os.sep
@@ -653,6 +1194,7 @@ class CmtWrapper(object):
                        len(clientList), pkgName )
         return clientList
 
+    @timed
     def show(self, **kw):
         cmd = "%s show " % self.bin
         cmd = cmd + " ".join( "%s %s" % (k, kw[k]) for k in kw.keys() )
@@ -666,7 +1208,51 @@ class CmtWrapper(object):
             self.msg.warning( "Problem during [%s]" % cmd )
             self.msg.warning( out )
         return out
-        
+
+    def show_macros(self, names, cmtdir=None):
+        """Return the values of the CMT macros `names` as seen from the
+        `cmtdir` directory (default: the current directory).
+        All the macros are retrieved with a single 'cmt show macros' which is
+        cached per directory for the lifetime of this wrapper.
+
+        Return: dict of name -> value ('' for undefined macros)
+        """
+        if isinstance(names, basestring):
+            names = [names]
+        if cmtdir is None:
+            cmtdir = self._getcwd()
+        macros = self._show_macros(os.path.realpath(cmtdir))
+        return dict((n, macros.get(n, '')) for n in names)
+
+    def show_macro(self, name, cmtdir=None):
+        """Return the value of the CMT macro `name` (see `show_macros`)"""
+        return self.show_macros([name], cmtdir)[name]
+
+    @memoize_method(maxsize=32)
+    @timed
+    def _show_macros(self, cmtdir):
+        cmd = "%s show macros" % self.bin
+        self.msg.debug('running [%s] from [%s]...', cmd, cmtdir)
+        # only capture the stdout (see `show`)
+        with open(os.devnull, 'w') as devnull:
+            if self.shell is subprocess:
+                p = subprocess.Popen(cmd, shell=True, cwd=cmtdir,
+                                     stdout=subprocess.PIPE, stderr=devnull)
+                macros = parse_macros(p.stdout)
+                p.stdout.close()
+                sc = p.wait()
+            else:
+                # run from a sub-shell to leave the shell's cwd untouched
+                cmd = "(cd '%s' && %s)" % (cmtdir, cmd)
+                sc,out = self.shell.getstatusoutput(cmd, stderr=devnull)
+                macros = parse_macros(out.splitlines())
+        if sc != 0:
+            self.msg.warning( "Problem during [%s] (from [%s])", cmd, cmtdir )
+        return macros
+
+## where AtlasSetup is taken from by default
+ASETUP_ROOT = '/afs/cern.ch/atlas/software/dist/AtlasSetup'
+
 class CmtMgr(object):
     """a simple class to manage CMT environments"""
     def __init__(self,
@@ -675,7 +1261,12 @@ class CmtMgr(object):
                  cmt_version='v1r22',
                  asetup=None,
                  tags='16.0.0,gcc43,opt',
-                 verbose=False):
+                 verbose=False,
+                 sh=None):
+        """
+         `sh` the (fresh) shell to set up, e.g. from a `pyshell.ShellPool`.
+              a new `pyshell.LocalShell` is started if None.
+        """
         import os
         if project_name is None:
             project_name = os.getenv('AtlasProject', 'AtlasOffline')
@@ -687,7 +1278,7 @@ class CmtMgr(object):
             raise OSError, "no such file [%s]"%cmt_setup
 
         if asetup is None:
-            asetup = '/afs/cern.ch/atlas/software/dist/AtlasSetup'
+            asetup = ASETUP_ROOT
         self._asetup_root = asetup
         
         self.verbose = verbose
@@ -695,8 +1286,11 @@ class CmtMgr(object):
         self.project = project_name
         import tempfile
         self.top_dir = tempfile.mkdtemp()
-        from . import pyshell as ps
-        self.sh = ps.LocalShell()
+        self._own_sh = sh is None
+        if sh is None:
+            from . import pyshell as ps
+            sh = ps.LocalShell()
+        self.sh = sh
         # setup AtlasSetup
         self.sh.environ['AtlasSetup'] = self._asetup_root
         self._asetup_sh = os.path.join(self._asetup_root,
@@ -705,6 +1299,14 @@ class CmtMgr(object):
         orig_dir = self.sh.getcwd()
         self._create_asetup_cfg(tags)
 
+    def close(self):
+        """logout of the shell (unless it was given to the constructor) and
+        remove the work area"""
+        if self._own_sh:
+            self.sh.close()
+        import shutil
+        shutil.rmtree(self.top_dir, ignore_errors=True)
+
     def _create_asetup_cfg(self, tags):
         
         self.sh.chdir(self.top_dir)
@@ -739,14 +1341,18 @@ class CmtMgr(object):
             '--input=%s' % (asetup_cfg_name,),
             tags
             ])
-        sc = self.sh.source(self._asetup_sh,
-                            args=args)
+        cmds = [
+            'source %s %s' % (self._asetup_sh, args),
+            'cmt show path',
+            ]
+        # one round-trip for the whole setup sequence
+        results = self.sh.run_batch(cmds)
+        (sc,_), (sc_path,out) = results
         if sc:
             print "**ERROR** while running 'asetup %s'" % args
-            
-        sc,out = self.sh.getstatusoutput('cmt show path')
-        if sc:
-            print "**ERROR** while running cmd=[%s]:\n%s"%(cmt_setup,
+
+        if sc_path:
+            print "**ERROR** while running cmd=[%s]:\n%s"%(cmds[1],
                                                            out)
         else:
             # if self.verbose:
@@ -755,50 +1361,155 @@ class CmtMgr(object):
         
         return
     
-def get_tag_diff(ref, chk, verbose=False):
+def release_pkgdb(cmt):
+    """return the packages of the release `cmt` (a `CmtWrapper`) is set up
+    for, as a dict of full-name -> `CmtPkg` (labelled with their project),
+    and the list of *Release/cmt/requirements files they were read from.
+    """
+    pkgdb = {}
+    reqfiles = []
+    for proj in reversed(cmt.projects_dag()):
+        reldata = os.listdir(proj.path)
+        reldata = [p for p in reldata if p.endswith('Release')]
+        if len(reldata) != 1:
+            continue
+        reldata = reldata[0]
+        reldata = os.path.join(proj.path, reldata, 'cmt', 'requirements')
+        if not os.path.exists(reldata):
+            continue
+        reqfiles.append(reldata)
+        uses = extract_uses(reldata, msg=cmt.msg)
+        for p in uses:
+            pname = proj.name
+            if pname.startswith('Atlas'):
+                pname = pname[len('Atlas'):]
+            uses[p].project = pname
+        pkgdb.update(uses)
+    return pkgdb, reqfiles
+
+def asetup_pool(size=2, maxsize=None, **kw):
+    """return a `pyshell.ShellPool` of shells set up (see `CmtMgr`) for the
+    asetup tags used as keys. `kw` is forwarded to `CmtMgr`.
+
+    usage:
+     pool = asetup_pool()
+     with pool.session('17.0.0,opt') as sh:
+         cmt = CmtWrapper(shell=sh)
+    """
+    from .pyshell import ShellPool
+    def setup(sh, tags):
+        CmtMgr(tags=tags, sh=sh, **kw)
+    pool = ShellPool(size=size, maxsize=maxsize, setup=setup)
+    pool.asetup_root = kw.get('asetup') or ASETUP_ROOT
+    return pool
+
+@contextlib.contextmanager
+def _release_cmt(tags, project_name=None, verbose=False, use_cache=True,
+                 pool=None, asetup=None):
+    """yield a `CmtWrapper` for the release described by the asetup `tags`,
+    running in a shell of `pool` if given, in a freshly set up one otherwise
+    (which is closed afterwards)"""
+    if pool is not None:
+        with pool.session(tags) as sh:
+            yield CmtWrapper(shell=sh, use_cache=use_cache)
+        return
+    mgr = CmtMgr(project_name=project_name, tags=tags, verbose=verbose,
+                 asetup=asetup)
+    try:
+        yield CmtWrapper(shell=mgr.sh, use_cache=use_cache)
+    finally:
+        mgr.close()
+
+def _snapshot_key(tags, pool=None, asetup=None):
+    """return the key of the snapshots of the release described by `tags`"""
+    if pool is not None:
+        asetup = pool.asetup_root
+    return Cache.cache_key(tags, asetup or ASETUP_ROOT,
+                           os.environ.get('CMTCONFIG', ''))
+
+def release_snapshot(tags, project_name=None, verbose=False, use_cache=True,
+                     pool=None, asetup=None):
+    """return the packages of the release described by the asetup `tags`
+    (see `release_pkgdb`), set up from the AtlasSetup installation `asetup`
+    (see `CmtMgr`).
+    the result is saved in a snapshot (see PyCmt.Cache) keyed on `tags`,
+    the AtlasSetup root and $CMTCONFIG so asetup is skipped entirely for
+    releases which have already been seen, as long as their
+    *Release/cmt/requirements files did not change.
+    if a `pool` (see `asetup_pool`) is given, the release is inspected from
+    one of its shells instead of a freshly set up one.
+    """
+    key = _snapshot_key(tags, pool, asetup)
+    if use_cache:
+        pkgdb = Cache.load('release_snapshot', key)
+        if pkgdb is not None:
+            if verbose:
+                print "::: using snapshot of [%s]..." % tags
+            return pkgdb
+
+    with _release_cmt(tags, project_name, verbose, use_cache,
+                      pool, asetup) as cmt:
+        pkgdb, reqfiles = release_pkgdb(cmt)
+    if use_cache and pkgdb:
+        Cache.dump('release_snapshot', key, pkgdb, files=reqfiles)
+    return pkgdb
+
+def release_graph(tags, project_name=None, verbose=False, use_cache=True,
+                  pool=None, asetup=None):
+    """return the 'use' graph (a `PkgGraph`) of the release described by the
+    asetup `tags` (see `CmtWrapper.clients_index`).
+    like `release_snapshot`, the result is saved in a snapshot so asetup is
+    skipped for releases which have already been seen.
+    """
+    key = _snapshot_key(tags, pool, asetup)
+    if use_cache:
+        graph = Cache.load('release_graph', key)
+        if graph is not None:
+            return graph
+
+    with _release_cmt(tags, project_name, verbose, use_cache,
+                      pool, asetup) as cmt:
+        graph = cmt.clients_index().graph
+        reqfiles = cmt._release_reqfiles(cmt._clients_index_projects())
+    if use_cache:
+        Cache.dump('release_graph', key, graph, files=reqfiles)
+    return graph
+
+def get_tag_diff(ref, chk, verbose=False, use_cache=True, pool=None):
     """return the list of tag differences between 2 releases
+    both releases are set up concurrently (or retrieved from their snapshot,
+    see `release_snapshot`), possibly from the shells of `pool` (see
+    `asetup_pool`)
     """
-    mgrs = {}
-    cmts = {}
-
-    if verbose:
-        print "::: setup reference env. [%s]..." % ref
-    mgrs['ref'] = CmtMgr(project_name='reference_rel', tags=ref,
-                         verbose=verbose)
-    cmts['ref'] = CmtWrapper(shell=mgrs['ref'].sh)
-
-    if verbose:
-        print "::: setup check env. [%s]..." % chk
-    mgrs['chk'] = CmtMgr(project_name='check_rel', tags=chk,
-                         verbose=verbose)
-    cmts['chk'] = CmtWrapper(shell=mgrs['chk'].sh)
-
     # list of packages for each ref/chk
     pkgdb = {}
     # diff for each ref/chk
     cmt_diffs = {}
     diffs = []
-    
-    for rel in ('ref', 'chk'):
-        cmt = cmts[rel]
-        pkgdb[rel] = {}
-        
-        for proj in reversed(cmt.projects_dag()):
-            reldata = os.listdir(proj.path)
-            reldata = [p for p in reldata if p.endswith('Release')]
-            if len(reldata) != 1:
-                continue
-            reldata = reldata[0]
-            reldata = os.path.join(proj.path, reldata, 'cmt', 'requirements')
-            if not os.path.exists(reldata):
-                continue
-            uses = extract_uses(reldata, msg=cmt.msg)
-            for p in uses:
-                pname = proj.name
-                if pname.startswith('Atlas'):
-                    pname = pname[len('Atlas'):]
-                uses[p].project = pname
-            pkgdb[rel].update(uses)
+
+    import threading
+    errors = []
+    def setup(rel, tags, project_name):
+        try:
+            if verbose:
+                print "::: setup %s env. [%s]..." % (rel, tags)
+            pkgdb[rel] = release_snapshot(tags,
+                                          project_name=project_name,
+                                          verbose=verbose,
+                                          use_cache=use_cache,
+                                          pool=pool)
+        except BaseException:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=setup, args=args)
+               for args in (('ref', ref, 'reference_rel'),
+                            ('chk', chk, 'check_rel'))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        exc_class, exc, tb = errors[0]
+        raise exc_class, exc, tb
 
     def cmp_pkgs(a, b):
         diffs = {}
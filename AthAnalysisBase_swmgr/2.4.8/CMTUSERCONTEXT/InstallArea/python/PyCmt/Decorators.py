@@ -11,8 +11,15 @@ __author__  = "Sebastien Binet <binet@cern.ch>"
 
 __all__ = [
     'memoize',
+    'memoize_method',
+    'persistent_memoize',
     'forking',
+    'mp_forking',
+    'ForkingPool',
+    'forking_pool',
     'async',
+    'AsyncExecutor',
+    'async_executor',
     ]
 
 import sys
@@ -41,40 +48,592 @@ def memoize(func, *args):
         mem_dict[args] = result = func(*args)
         return result
 
-# FIXME: does not work... func is an instance of FunctionMaker which cannot
-#        be pickled...
-import __builtin__
+### a bounded, per-instance memoize for methods
+import threading
+import weakref
+import contextlib
+from collections import namedtuple, OrderedDict
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+_kwd_mark = object()
+
+def _make_key(args, kwargs):
+    key = args
+    if kwargs:
+        key += (_kwd_mark,) + tuple(sorted(kwargs.items()))
+    return key
+
+class _InstanceCache(object):
+    """the LRU cache of one instance for one method"""
+    __slots__ = ('data', 'hits', 'misses')
+    def __init__(self):
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+class _MemoizedMethod(object):
+    """descriptor implementing `memoize_method`.
+    results are stored per-instance, in a weak-keyed dictionary so the cache
+    does not keep the instances alive.
+    """
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.__name__ = func.__name__
+        self.__doc__  = func.__doc__
+        self.__module__ = func.__module__
+        self._caches = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return _BoundMemoizedMethod(self, obj)
+
+    def _cache(self, obj, create=True):
+        with self._lock:
+            cache = self._caches.get(obj)
+            if cache is None and create:
+                cache = self._caches[obj] = _InstanceCache()
+            return cache
+
+    def call(self, obj, args, kwargs):
+        try:
+            key = _make_key(args, kwargs)
+            hash(key)
+        except TypeError:
+            # un-hashable arguments: do not cache
+            return self.func(obj, *args, **kwargs)
+        cache = self._cache(obj)
+        with self._lock:
+            try:
+                result = cache.data.pop(key)
+            except KeyError:
+                cache.misses += 1
+            else:
+                # re-insert as most-recently used
+                cache.data[key] = result
+                cache.hits += 1
+                return result
+        result = self.func(obj, *args, **kwargs)
+        with self._lock:
+            cache.data[key] = result
+            if self.maxsize is not None:
+                while len(cache.data) > self.maxsize:
+                    cache.data.popitem(last=False)
+        return result
+
+    def cache_info(self):
+        """return the statistics summed over all the (live) instances"""
+        with self._lock:
+            caches = self._caches.values()
+            return CacheInfo(sum(c.hits for c in caches),
+                             sum(c.misses for c in caches),
+                             self.maxsize,
+                             sum(len(c.data) for c in caches))
+
+    def cache_clear(self):
+        """clear the cache of all the instances"""
+        with self._lock:
+            self._caches.clear()
+
+class _BoundMemoizedMethod(object):
+    """a `memoize_method` bound to an instance"""
+    __slots__ = ('_desc', '_obj')
+    def __init__(self, desc, obj):
+        self._desc = desc
+        self._obj  = obj
+
+    def __call__(self, *args, **kwargs):
+        return self._desc.call(self._obj, args, kwargs)
+
+    @property
+    def __name__(self):
+        return self._desc.__name__
+
+    @property
+    def __doc__(self):
+        return self._desc.__doc__
+
+    def cache_info(self):
+        """return the (hits, misses, maxsize, currsize) of this instance"""
+        desc = self._desc
+        cache = desc._cache(self._obj, create=False)
+        if cache is None:
+            return CacheInfo(0, 0, desc.maxsize, 0)
+        with desc._lock:
+            return CacheInfo(cache.hits, cache.misses,
+                             desc.maxsize, len(cache.data))
+
+    def cache_clear(self):
+        """clear the cache of this instance"""
+        desc = self._desc
+        with desc._lock:
+            desc._caches.pop(self._obj, None)
+
+    def invalidate(self, *args, **kwargs):
+        """drop the cached result for the call with `args` and `kwargs`.
+        return True if there was such a result.
+        """
+        desc = self._desc
+        cache = desc._cache(self._obj, create=False)
+        if cache is None:
+            return False
+        with desc._lock:
+            return cache.data.pop(_make_key(args, kwargs), _kwd_mark) \
+                   is not _kwd_mark
+
+    def __repr__(self):
+        return '<memoized method %s of %r>' % (self._desc.__name__, self._obj)
+
+def memoize_method(maxsize=128):
+    """This decorator implements the memoize pattern for methods, i.e. it
+    caches the result of a method so that the next time it is called on the
+    same instance with the same input parameters the result is retrieved
+    from the cache and not recomputed.
+    Contrary to `memoize`:
+     - results are stored per-instance and the cache only holds a weak
+       reference to the instance,
+     - at most `maxsize` results are kept per instance (least-recently used
+       ones are discarded first). Use `maxsize=None` for an unbounded cache,
+     - the bound method provides `cache_clear()`, `invalidate(*args)` and
+       `cache_info()` (hits/misses statistics).
+
+    usage:
+      class Foo(object):
+          @memoize_method(maxsize=16)
+          def bar(self, x): ...
+      foo.bar.cache_info()
+    """
+    if callable(maxsize):
+        # used as '@memoize_method'
+        return _MemoizedMethod(maxsize, 128)
+    def wrap(func):
+        return _MemoizedMethod(func, maxsize)
+    return wrap
+
+### a memoize persisted on disk, across processes
+def _bind_args(argnames, defaults, args, kwargs):
+    """return the dict of the values of the arguments of a call"""
+    bound = dict(zip(argnames, args))
+    if len(args) > len(argnames):
+        bound['*'] = args[len(argnames):]
+    bound.update(kwargs)
+    for name, value in zip(argnames[len(argnames)-len(defaults):], defaults):
+        bound.setdefault(name, value)
+    return bound
+
+def persistent_memoize(depends_on=None, max_size=64*1024*1024,
+                       content_hash=False, ignore=(), kind=None):
+    """This decorator implements the memoize pattern on disk, i.e. it
+    pickles the result of a function into the PyCmt cache directory (see
+    `PyCmt.Cache`) so that the next time the function is called with the same
+    input parameters -- in this process or in another one -- the result is
+    retrieved from the cache and not recomputed.
+     - `depends_on` is called with the arguments of the call and returns the
+       list of the files the result depends on: the entries are keyed on the
+       arguments and on the (path, mtime, size) of these files (plus a digest
+       of their content if `content_hash` is True), so they never go stale,
+     - the arguments named in `ignore` (loggers...) are not part of the key,
+     - the entries of the function (or of `kind`, default: the qualified name
+       of the function) are evicted, least-recently used first, to keep them
+       below `max_size` bytes (`None` for no limit),
+     - the cache is bypassed if $PYCMT_NO_CACHE is set.
+    The arguments must have a stable repr and the result must be picklable.
+
+    usage:
+      @persistent_memoize(depends_on=lambda fname, msg: [fname],
+                          ignore=('msg',))
+      def parse(fname, msg): ...
+    """
+    import inspect
+    import PyCmt.Cache as Cache
+    def wrap(func):
+        name = kind or '%s.%s' % (func.__module__, func.__name__)
+        argnames, varargs, varkw, defaults = inspect.getargspec(func)
+        defaults = defaults or ()
+        def call(func, *args, **kwargs):
+            if os.environ.get('PYCMT_NO_CACHE'):
+                return func(*args, **kwargs)
+            bound = _bind_args(argnames, defaults, args, kwargs)
+            for n in ignore:
+                bound.pop(n, None)
+            deps = ()
+            if depends_on is not None:
+                deps = depends_on(*args, **kwargs)
+                if isinstance(deps, basestring):
+                    deps = [deps]
+            key = Cache.cache_key(
+                name,
+                sorted(bound.items()),
+                [Cache.fingerprint(f, content_hash) for f in deps])
+            try:
+                return Cache.lookup(name, key)
+            except KeyError:
+                pass
+            result = func(*args, **kwargs)
+            Cache.store(name, key, result, max_size)
+            return result
+        return decorator(call, func)
+    return wrap
+
+### functions run in child processes
+# the (decorated) functions can not be pickled: child processes are forked and
+# find them back in this registry, from their index
+_fct_registry = []
+_fct_ids = {}
+_fct_lock = threading.Lock()
+
+def _register(func):
+    """return the index of `func` in the registry of functions run in child
+    processes"""
+    with _fct_lock:
+        fid = _fct_ids.get(func)
+        if fid is None:
+            fid = _fct_ids[func] = len(_fct_registry)
+            _fct_registry.append(func)
+        return fid
+
+def _run(func, args, kwargs):
+    """run `func(*args, **kwargs)` (in a child process).
+    return (status, result) with status 0: ok, 1: exception (result is the
+    exception and its traceback)
+    """
+    try:
+        return 0, func(*args, **kwargs)
+    except (Exception, KeyboardInterrupt), exc:
+        return _exc_result(exc)
+
+def _exc_result(exc):
+    import traceback
+    exc_string = traceback.format_exc(limit=10)
+    for l in exc_string.splitlines():
+        print "[%d]"%os.getpid(),l.rstrip()
+    return 1, (exc, exc_string)
+
+def _run_registered(fid, args, kwargs):
+    """run the registered function `fid` (in a child process)"""
+    return _run(_fct_registry[fid], args, kwargs)
+
+def _func_name(func):
+    """return the (module, name) under which `func` can be imported, None if
+    it can not (lambdas, closures, methods...)"""
+    modname = getattr(func, '__module__', None)
+    name = getattr(func, '__name__', None)
+    mod = sys.modules.get(modname)
+    if mod is None or getattr(mod, name, None) is not func:
+        return None
+    return modname, name
+
+def _lookup(ref):
+    """return the function `ref`: its index in the registry or its (module,
+    name)"""
+    if isinstance(ref, tuple):
+        modname, name = ref
+        if modname not in sys.modules:
+            __import__(modname)
+        return getattr(sys.modules[modname], name)
+    return _fct_registry[ref]
+
+### transport of the results of child processes
+# results are pickled on a pipe. large ones can be written to a file in
+# /dev/shm (or $TMPDIR) instead, and only its handle goes through the pipe:
+# the parent maps the file and unpickles from the mapping, which spares the
+# copies through the kernel pipe buffers, and the child does not wait for the
+# parent to read its result. (off by default: filling tmpfs pages is not
+# cheaper than a pipe on an idle linux box)
+# iterators are streamed: the parent receives their items in chunks while the
+# child is still producing them.
+# the cyclic garbage collector is paused while (un)pickling: large results
+# otherwise trigger many useless collections.
+
+## pickles bigger than this (in bytes) are passed through a file (None: never)
+shm_threshold = None
+
+## a chunk of streamed items is sent when it holds `stream_chunksize` items or
+## `stream_latency` seconds after the previous one
+stream_chunksize = 512
+stream_latency = 0.1
+
+# statuses of the messages, besides 0: ok, 1: exception and 2: result could
+# not be pickled (result is the pickling error)
+_STREAM = 3        # a stream of chunks follows, ended by a 0, 1 or 2 message
+_CHUNK  = 4        # result is a list of streamed items
+_UNKNOWN = 5       # the (pool) worker could not find the function by name
+
+_gc_lock = threading.Lock()
+_gc_paused_depth = 0
+_gc_was_enabled = False
+
+@contextlib.contextmanager
+def _gc_paused():
+    global _gc_paused_depth, _gc_was_enabled
+    import gc
+    with _gc_lock:
+        if _gc_paused_depth == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_paused_depth += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_paused_depth -= 1
+            if _gc_paused_depth == 0 and _gc_was_enabled:
+                gc.enable()
+
+class _ShmHandle(object):
+    """the handle of a pickle stored in a file, sent in place of the pickle.
+    the file is removed as soon as it is loaded."""
+    __slots__ = ('path', 'size')
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __getstate__(self):
+        return self.path, self.size
+
+    def __setstate__(self, state):
+        self.path, self.size = state
+
+    def load(self):
+        import mmap
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.unlink(self.path)
+            m = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            data = m[:]
+        finally:
+            m.close()
+        with _gc_paused():
+            return pickle.loads(data)
+
+def _shm_dir():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    import tempfile
+    return tempfile.gettempdir()
+
+class _Spool(object):
+    """file-like object collecting a pickle in memory, then in a file once it
+    grows bigger than `threshold` bytes"""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.chunks = []
+        self.size = 0
+        self.path = None
+        self.f = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.f is not None:
+            self.f.write(data)
+            return
+        self.chunks.append(data)
+        if self.threshold is not None and self.size > self.threshold:
+            import tempfile
+            try:
+                fd, self.path = tempfile.mkstemp(prefix='pycmt-result-',
+                                                 dir=_shm_dir())
+            except (IOError, OSError):
+                self.threshold = None  # keep it in memory
+                return
+            self.f = os.fdopen(fd, 'wb')
+            self.f.write(''.join(self.chunks))
+            self.chunks = []
+
+    def discard(self):
+        self.chunks = []
+        self.size = 0
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.path)
+
+def _pack(msg, threshold):
+    """return the list of the chunks of bytes to send for the (status, result)
+    message `msg`, and whether `msg` could be pickled"""
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    spool = _Spool(threshold)
+    try:
+        with _gc_paused():
+            pickle.Pickler(spool, pickle.HIGHEST_PROTOCOL).dump(msg)
+        if spool.f is not None:
+            spool.f.close()
+            spool.f = None
+            handle = _ShmHandle(spool.path, spool.size)
+            return [pickle.dumps(handle, pickle.HIGHEST_PROTOCOL)], True
+    except (pickle.PicklingError, TypeError), exc:
+        spool.discard()
+        return [pickle.dumps((2,exc), pickle.HIGHEST_PROTOCOL)], False
+    except:
+        spool.discard()
+        raise
+    return spool.chunks, True
+
+def _loads(data):
+    """return the message packed by `_pack` into the bytes `data`"""
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    with _gc_paused():
+        msg = pickle.loads(data)
+    if isinstance(msg, _ShmHandle):
+        msg = msg.load()
+    return msg
+
+def _recv(f):
+    """read a message written by `_send` from the file `f`"""
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    with _gc_paused():
+        msg = pickle.load(f)
+    if isinstance(msg, _ShmHandle):
+        msg = msg.load()
+    return msg
+
+def _send(f, msg, threshold):
+    chunks, ok = _pack(msg, threshold)
+    for data in chunks:
+        f.write(data)
+    f.flush()
+    return ok
+
+def _is_iterator(obj):
+    return hasattr(obj, 'next') and iter(obj) is obj
+
+def _send_result(f, msg, threshold):
+    """write the (status, result) message `msg` (see `_run`) on the file `f`.
+    an iterator result is sent as a stream"""
+    status, result = msg
+    if status != 0 or not _is_iterator(result):
+        _send(f, msg, threshold)
+        return
+    import time
+    _send(f, (_STREAM, None), threshold)
+    chunk = []
+    last = 0       # the first item is sent right away
+    try:
+        for item in result:
+            chunk.append(item)
+            now = time.time()
+            if len(chunk) >= stream_chunksize or now - last >= stream_latency:
+                if not _send(f, (_CHUNK, chunk), threshold):
+                    return
+                chunk = []
+                last = now
+        if chunk and not _send(f, (_CHUNK, chunk), threshold):
+            return
+        msg = (0, None)
+    except (Exception, KeyboardInterrupt), exc:
+        msg = _exc_result(exc)
+    _send(f, msg, threshold)
+
+class _Stream(object):
+    """iterator over the items of a stream read from the file `f`.
+    `done(ok)` is called once, at the end of the stream or when the iterator
+    is closed (or garbage collected) before, even if it was never started:
+    `ok` is then False (the sender is in an unknown state)."""
+    def __init__(self, f, done):
+        self._f = f
+        self._done = done
+        self._items = []
+
+    def __iter__(self):
+        return self
+
+    def _finish(self, ok):
+        done, self._done = self._done, None
+        self._items = []
+        if done is not None:
+            done(ok)
+
+    def next(self):
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        while not self._items:
+            if self._done is None:
+                raise StopIteration
+            try:
+                status, result = _recv(self._f)
+            except (EOFError, IOError, OSError, pickle.UnpicklingError):
+                self._finish(False)
+                raise RuntimeError("child process died while streaming "
+                                   "its result")
+            except BaseException:
+                self._finish(False)
+                raise
+            if status != _CHUNK:
+                self._finish(True)
+                _unpack_result(status, result)
+                raise StopIteration
+            self._items = result[::-1]
+        return self._items.pop()
+
+    def close(self):
+        """stop reading the stream (the sender is then killed)"""
+        if self._done is not None:
+            self._finish(False)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def _unpack_result(status, result):
+    if status in (0, _STREAM):
+        return result
+    if status == 1:
+        remote_exc = result[0]
+        reraise_exception(remote_exc)
+    raise result
+
+def _mp_call(q, fid, args, kwargs):
+    chunks, ok = _pack(_run_registered(fid, args, kwargs), shm_threshold)
+    q.put(''.join(chunks))
+
 @decorator
 def mp_forking(func, *args, **kwargs):
+    """
+    This decorator runs the function in a `multiprocessing.Process`.
+    The function is not pickled (the forked process finds it back in a
+    registry), only its arguments and result are. Large results can be passed
+    through a file (see `shm_threshold`); iterators can not be returned.
+    """
     import multiprocessing as mp
-    ## pool = mp.Pool (processes=1)
-    ## return pool.apply (func, *args, **kwargs)
+    import Queue
 
-    # create a local queue to fetch the results back
-    def wrapping(func):
-        q = mp.Queue()
-        def wrap_fct(*args, **kwargs):
-            try:
-                res = func(*args, **kwargs)
-            # catch *everything* and 're-raise'
-            except BaseException,err:
-                #import traceback; traceback.print_exc()
-                res = err
-            q.put(res)
-        wrap_fct.q = q
-        return wrap_fct
-
-    func = wrapping(func)
-    proc = mp.Process(target=func, args=args, kwargs=kwargs)
+    fid = _register(func)
+    q = mp.Queue()
+    proc = mp.Process(target=_mp_call, args=(q, fid, args, kwargs))
     proc.start()
-    res = func.q.get()
-    proc.join()
-    proc.terminate()
-    if isinstance(res, BaseException):
-        #import traceback; traceback.print_exc()
-        raise res
-        #reraise_exception(exc,exc_info)
-    return res
+    try:
+        while 1:
+            try:
+                data = q.get(timeout=0.1)
+                break
+            except Queue.Empty:
+                if not proc.is_alive() and q.empty():
+                    raise RuntimeError("process [%d] died (exitcode=%s)" %
+                                       (proc.pid, proc.exitcode))
+    finally:
+        proc.join()
+    return _unpack_result(*_loads(data))
 
 def reraise_exception(new_exc, exc_info=None):
     if exc_info is None:
@@ -87,15 +646,14 @@ def forking(func, *args, **kwargs):
     """
     This decorator implements the forking patterns, i.e. it runs the function
     in a forked process.
+    Large results can be passed through a file (see `shm_threshold`). If the
+    function returns an iterator (e.g. a generator), an iterator is returned
+    which yields its items as the forked process produces them (the process
+    is killed if that iterator is closed or discarded before its end).
     see:
      http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/511474
     """
     import os
-    try:
-        import cPickle as pickle
-    except ImportError:
-        import pickle
-        
     # create a pipe which will be shared between parent and child
     pread, pwrite = os.pipe()
 
@@ -105,36 +663,379 @@ def forking(func, *args, **kwargs):
     ## parent ##
     if pid > 0:
         os.close(pwrite)
-        with os.fdopen(pread, 'rb') as f:
-            status, result = pickle.load(f)
+        f = os.fdopen(pread, 'rb')
+        try:
+            status, result = _recv(f)
+        except BaseException:
+            f.close()
+            os.waitpid(pid, 0)
+            raise
+        if status == _STREAM:
+            def done(ok):
+                f.close()
+                if not ok:
+                    import signal
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                os.waitpid(pid, 0)
+            return _Stream(f, done)
+        f.close()
         os.waitpid(pid, 0)
-        if status == 0:
-            return result
-        else:
-            remote_exc = result[0]
-            reraise_exception(remote_exc)
+        return _unpack_result(status, result)
             
     ## child ##
     else:
-        os.close(pread)
         try:
-            result = func(*args, **kwargs)
-            status = 0
-        except (Exception, KeyboardInterrupt), exc:
-            import traceback
-            exc_string = traceback.format_exc(limit=10)
-            for l in exc_string.splitlines():
-                print "[%d]"%os.getpid(),l.rstrip()
-            result = exc, exc_string
-            status = 1
-        with os.fdopen(pwrite, 'wb') as f:
-            try:
-                pickle.dump((status,result), f, pickle.HIGHEST_PROTOCOL)
-            except pickle.PicklingError, exc:
-                pickle.dump((2,exc), f, pickle.HIGHEST_PROTOCOL)
-        os._exit(0)
+            os.close(pread)
+            with os.fdopen(pwrite, 'wb') as f:
+                _send_result(f, _run(func, args, kwargs), shm_threshold)
+        finally:
+            os._exit(0)
     pass # forking
 
+### a pool of long-lived forked processes
+# set in the worker processes: pooled functions then run in-line
+_in_pool_worker = False
+
+# parent's ends of the pipes of the workers of all the pools
+_pool_fds = set()
+
+# default value of the options following a module-level setting
+_default = object()
+
+class _Worker(object):
+    """the parent's end of a `ForkingPool` worker process"""
+    __slots__ = ('pid', 'fin', 'fout', 'ready', 'ntasks', 'nfcts')
+    def __init__(self, pid, fin, fout, nfcts):
+        self.pid  = pid
+        self.fin  = fin       # results (and warm-up status) from the worker
+        self.fout = fout      # tasks to the worker
+        self.ready = False    # warm-up status read
+        self.ntasks = 0
+        self.nfcts = nfcts    # functions registered when it was forked
+
+class ForkingPool(object):
+    """
+    A pool of long-lived worker processes, forked from the current one, to run
+    functions in isolation without paying for a fresh process (and the
+    initialization of its environment) each time.
+     - `processes` is the maximum number of workers (started on demand),
+     - `warmup` is called once in each new worker (e.g. to import ROOT),
+     - a worker is recycled after `maxtasks` calls (never if None) and when
+       it crashes (the call it was running then raises a RuntimeError),
+     - results bigger than `shm_threshold` bytes are passed through a file
+       (default: the module's `shm_threshold`).
+    Functions are not pickled, only their arguments and results are: the
+    workers import module-level functions by module and name, and find the
+    other callables (lambdas, closures, methods...) back in a registry they
+    inherit when they are forked. A worker forked before such a callable was
+    first seen is thus replaced by a new (warmed-up) one, and the callable
+    is kept in the registry for good: prefer module-level functions, or
+    decorate the callables (see `function`) before the first call.
+    Exceptions are re-raised in the caller and iterators are streamed back
+    like with `forking` (the worker is busy until the returned iterator is
+    exhausted, and is killed if the iterator is closed or discarded before,
+    even if it was never started).
+
+    usage:
+      pool = ForkingPool(processes=4, warmup=import_root, maxtasks=50)
+      @pool.function
+      def inspect(libname): ...
+      pool.map(inspect, libnames)
+    """
+    def __init__(self, processes=1, warmup=None, maxtasks=None,
+                 shm_threshold=_default):
+        self.processes = processes
+        self.warmup = warmup
+        if warmup is not None:
+            self._warmup_id = _register(warmup)
+        self.maxtasks = maxtasks
+        if shm_threshold is _default:
+            shm_threshold = globals()['shm_threshold']
+        self.shm_threshold = shm_threshold
+        self._idle = []
+        self._nworkers = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    ## worker side
+    def _worker_main(self, rfd, wfd):
+        global _in_pool_worker
+        _in_pool_worker = True
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        fin = os.fdopen(rfd, 'rb')
+        fout = os.fdopen(wfd, 'wb')
+        status = 0
+        if self.warmup is not None:
+            status = _run_registered(self._warmup_id, (), {})[0]
+        fout.write(pickle.dumps(status, pickle.HIGHEST_PROTOCOL))
+        fout.flush()
+        if status == 0:
+            while 1:
+                try:
+                    task = pickle.load(fin)
+                except EOFError:
+                    break
+                if task is None:
+                    break
+                ref, args, kwargs = task
+                try:
+                    func = _lookup(ref)
+                except (ImportError, AttributeError):
+                    res = _UNKNOWN, None
+                else:
+                    res = _run(func, args, kwargs)
+                _send_result(fout, res, self.shm_threshold)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+    ## parent side
+    def _spawn(self):
+        task_r, task_w = os.pipe()
+        res_r, res_w = os.pipe()
+        nfcts = len(_fct_registry)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # only keep our own pipes: the other workers must see their
+                # end-of-file when the parent goes away
+                for fd in _pool_fds | set([task_w, res_r]):
+                    os.close(fd)
+                self._worker_main(task_r, res_w)
+            finally:
+                os._exit(1)
+        os.close(task_r)
+        os.close(res_w)
+        _pool_fds.update((task_w, res_r))
+        return _Worker(pid, os.fdopen(res_r, 'rb'), os.fdopen(task_w, 'wb'),
+                       nfcts)
+
+    def _retire(self, worker, kill=False):
+        _pool_fds.difference_update((worker.fin.fileno(),
+                                     worker.fout.fileno()))
+        if kill:
+            import signal
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        else:
+            try:
+                import cPickle as pickle
+            except ImportError:
+                import pickle
+            try:
+                pickle.dump(None, worker.fout, pickle.HIGHEST_PROTOCOL)
+            except (IOError, OSError):
+                pass
+        for f in (worker.fout, worker.fin):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        try:
+            _, status = os.waitpid(worker.pid, 0)
+        except OSError:
+            status = None
+        with self._cond:
+            self._nworkers -= 1
+            self._cond.notify()
+        return status
+
+    def _checkout(self, block=True):
+        """return an idle (possibly new) worker, None if none is available
+        and `block` is False"""
+        with self._cond:
+            while 1:
+                if self._closed:
+                    raise ValueError("pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._nworkers < self.processes:
+                    self._nworkers += 1
+                    break
+                if not block:
+                    return None
+                self._cond.wait()
+        try:
+            return self._spawn()
+        except BaseException:
+            with self._cond:
+                self._nworkers -= 1
+                self._cond.notify()
+            raise
+
+    def _checkin(self, worker):
+        if self.maxtasks is not None and worker.ntasks >= self.maxtasks:
+            self._retire(worker)
+            return
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                self._idle.append(worker)
+                self._cond.notify()
+        if closed:
+            self._retire(worker)
+
+    def _call(self, worker, ref, args, kwargs):
+        """run the function `ref` (see `_lookup`) on `worker`. return its
+        (status, result)"""
+        try:
+            import cPickle as pickle
+        except ImportError:
+            import pickle
+        try:
+            if not worker.ready:
+                if pickle.load(worker.fin) != 0:
+                    raise RuntimeError("warm-up of worker [%d] failed" %
+                                       worker.pid)
+                worker.ready = True
+            pickle.dump((ref, args, kwargs), worker.fout,
+                        pickle.HIGHEST_PROTOCOL)
+            worker.fout.flush()
+            worker.ntasks += 1
+            res = _recv(worker.fin)
+        except (EOFError, IOError, OSError, pickle.UnpicklingError):
+            status = self._retire(worker, kill=True)
+            raise RuntimeError("worker [%d] died (status=%s)" %
+                               (worker.pid, status))
+        except BaseException:
+            # interrupted: the worker is in an unknown state
+            self._retire(worker, kill=True)
+            raise
+        if res[0] == _STREAM:
+            # the worker is checked in once the stream is read
+            def done(ok):
+                if ok:
+                    self._checkin(worker)
+                else:
+                    self._retire(worker, kill=True)
+            return _STREAM, _Stream(worker.fin, done)
+        if res[0] == _UNKNOWN:
+            # forked before the function was defined
+            self._retire(worker)
+            return res
+        self._checkin(worker)
+        return res
+
+    def _apply(self, func, args, kwargs):
+        fid = _register(func)
+        name = _func_name(func)
+        while 1:
+            worker = self._checkout()
+            if fid < worker.nfcts:
+                ref = fid
+            elif name is not None:
+                ref = name
+            else:
+                # forked before the function was registered
+                self._retire(worker)
+                continue
+            res = self._call(worker, ref, args, kwargs)
+            if res[0] != _UNKNOWN:
+                return res
+            name = None
+
+    def apply(self, func, args=(), kwargs=None):
+        """run `func(*args, **kwargs)` in a worker and return its result"""
+        if kwargs is None:
+            kwargs = {}
+        if _in_pool_worker:
+            return func(*args, **kwargs)
+        status, result = self._apply(func, args, kwargs)
+        return _unpack_result(status, result)
+
+    def map(self, func, iterable):
+        """return the list of `func(x)` for all `x` in `iterable`, run
+        concurrently in the workers of the pool"""
+        args = list(iterable)
+        if _in_pool_worker or len(args) < 2 or self.processes < 2:
+            results = []
+            for x in args:
+                res = self.apply(func, (x,))
+                if isinstance(res, _Stream):
+                    # release the worker for the next items
+                    res = list(res)
+                results.append(res)
+            return results
+        results = [None] * len(args)
+        errors = []
+        def run(i):
+            try:
+                res = self._apply(func, (args[i],), {})
+                if res[0] == _STREAM:
+                    # release the worker for the next items
+                    res = 0, list(res[1])
+                results[i] = res
+            except BaseException:
+                errors.append(sys.exc_info())
+        it = iter(xrange(len(args)))
+        lock = threading.Lock()
+        def consume():
+            while not errors:
+                with lock:
+                    try:
+                        i = it.next()
+                    except StopIteration:
+                        return
+                run(i)
+        threads = [threading.Thread(target=consume)
+                   for _ in xrange(min(self.processes, len(args)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            exc_class, exc, tb = errors[0]
+            raise exc_class, exc, tb
+        return [_unpack_result(*res) for res in results]
+
+    def function(self, func):
+        """decorator running `func` in the workers of the pool"""
+        _register(func)
+        def call(func, *args, **kwargs):
+            return self.apply(func, args, kwargs)
+        wrapped = decorator(call, func)
+        wrapped.pool = self
+        return wrapped
+
+    def close(self):
+        """stop all the workers (once they are done with their task)"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            self._retire(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    pass # ForkingPool
+
+def forking_pool(processes=1, warmup=None, maxtasks=None,
+                 shm_threshold=_default):
+    """
+    This decorator runs the function in a pool of long-lived forked
+    processes (see `ForkingPool`): same isolation as `forking` (modulo
+    `maxtasks`) without the start-up of a new process for each call.
+    the pool is available as the `pool` attribute of the decorated function.
+
+    usage:
+      @forking_pool(warmup=import_root, maxtasks=20)
+      def inspect_library(libname): ...
+    """
+    return ForkingPool(processes, warmup, maxtasks, shm_threshold).function
+
             
 ### a decorator converting blocking functions into asynchronous functions
 #   stolen from http://pypi.python.org/pypi/decorator/3.0.0
@@ -205,3 +1106,123 @@ def async(async_type='mp'):
     return async_obj
         
     
+
+### a decorator converting blocking functions into functions returning futures
+class AsyncExecutor(object):
+    """
+    A decorator converting blocking functions into asynchronous functions
+    returning futures (see `PyCmt.Futures`). Contrary to `Async`, each
+    decorated function has its own pool of at most `max_workers` threads
+    (or of `ForkingPool` processes with `processes=True`), started on demand:
+    extra calls are queued, so fanning out many calls can not overload the
+    node. The decorated function `f` returns a `Future` (`result(timeout)`,
+    `cancel()`, ...) and provides:
+     - `f.map(*iterables, timeout=None, max_pending=None)`: an iterator over
+       the results, in order. at most `max_pending` calls are queued at a
+       time (default: all of them at once),
+     - `f.as_completed(*iterables, timeout=None)`: an iterator over the
+       futures of the calls, as they complete,
+     - `f.submit(*args, **kwargs)`: the same as `f(*args, **kwargs)`,
+     - `f.shutdown(wait=True)`: stop the workers (the next call restarts them).
+    For methods, pass the instance along with the arguments of `map`, e.g.
+    `self.fetch.map(itertools.repeat(self), names)`.
+    """
+
+    def __init__(self, max_workers=4, processes=False):
+        self.max_workers = max_workers
+        self.processes = processes
+
+    def __call__(self, func):
+        from PyCmt import Futures
+        lock = threading.Lock()
+        state = {'executor': None, 'pool': None}
+        processes = self.processes
+        max_workers = self.max_workers
+        if processes:
+            _register(func)
+
+        def submit(*args, **kwargs):
+            with lock:
+                if state['executor'] is None:
+                    state['executor'] = Futures.ThreadPoolExecutor(max_workers)
+                    if processes:
+                        state['pool'] = ForkingPool(processes=max_workers)
+                executor, pool = state['executor'], state['pool']
+            if pool is None:
+                return executor.submit(func, *args, **kwargs)
+            # the threads wait for the workers of the pool
+            return executor.submit(pool.apply, func, args, kwargs)
+
+        def call(func, *args, **kwargs):
+            return submit(*args, **kwargs)
+
+        def map(*iterables, **kwargs):
+            return _map_futures(submit, iterables, **kwargs)
+
+        def as_completed(*iterables, **kwargs):
+            timeout = kwargs.pop('timeout', None)
+            if kwargs:
+                raise TypeError('unexpected arguments %s' % kwargs.keys())
+            fs = [submit(*args) for args in itertools.izip(*iterables)]
+            return Futures.as_completed(fs, timeout)
+
+        def shutdown(wait=True):
+            with lock:
+                executor, pool = state['executor'], state['pool']
+                state['executor'] = state['pool'] = None
+            if executor is not None:
+                executor.shutdown(wait)
+            if pool is not None:
+                pool.close()
+
+        wrapped = decorator(call, func)
+        wrapped.submit = submit
+        wrapped.map = map
+        wrapped.as_completed = as_completed
+        wrapped.shutdown = shutdown
+        return wrapped
+
+def _map_futures(submit, iterables, timeout=None, max_pending=None):
+    """iterate over the results of the futures returned by `submit` for the
+    items of `iterables`, in order, with at most `max_pending` futures
+    pending at a time. the remaining futures are cancelled if the iteration
+    is interrupted."""
+    import collections
+    import time
+    end = None
+    if timeout is not None:
+        end = time.time() + timeout
+    def result(f):
+        if end is None:
+            return f.result()
+        return f.result(max(0, end - time.time()))
+    pending = collections.deque()
+    try:
+        for args in itertools.izip(*iterables):
+            pending.append(submit(*args))
+            if max_pending is not None and len(pending) >= max_pending:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+    finally:
+        for f in pending:
+            f.cancel()
+
+def async_executor(max_workers=4, async_type='th'):
+    """return a decorator running the functions in their own pool of at most
+    `max_workers` threads ('th', 'threading') or forked processes ('mp',
+    'multiprocessing'), and returning futures (see `AsyncExecutor`)
+
+    usage:
+      @async_executor(max_workers=8)
+      def svn_ls(url): ...
+      for tags in svn_ls.map(urls, timeout=60): ...
+    """
+    if async_type in ("mp", "multiprocessing"):
+        processes = True
+    elif async_type in ("th", "threading"):
+        processes = False
+    else:
+        raise ValueError ("async_type must be either 'multiprocessing' "
+                          "or 'threading' (got: %s)"%async_type)
+    return AsyncExecutor(max_workers, processes)
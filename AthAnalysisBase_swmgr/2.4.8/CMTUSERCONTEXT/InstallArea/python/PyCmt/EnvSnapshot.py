@@ -0,0 +1,247 @@
+## @author: agent <agent@local>
+## @file :  EnvSnapshot.py
+## @purpose: record the environment set up by asetup (or any other setup
+##           command) into a flat, relocatable shell script which restores it
+##           without running the setup again. The script refuses to apply
+##           itself once the release install tree it was taken from changed.
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__author__  = "agent <agent@local>"
+
+__all__ = [
+    'asetup_cmd',
+    'take',
+    'write',
+    'read_header',
+    'is_valid',
+    ]
+
+import os
+import os.path as osp
+import re
+import time
+
+from PyCmt.pyshell import utils as shutils
+from PyCmt.pyshell.localshell import _quote
+
+## bump this whenever the layout of the snapshot files changes
+SNAPSHOT_VERSION = 1
+
+## variables maintained by the shell, never recorded
+_IGNORED_ENV = ('_', 'SHLVL', 'OLDPWD', 'PWD')
+
+## variables which can be exported from a shell script
+_env_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+## placeholder for the work directory in the recorded values
+_WORKDIR_VAR = 'ENVSNAP_WORKDIR'
+
+def asetup_cmd(tags, asetup_root=None):
+    """return the command sourcing asetup for `tags`
+    (e.g. 'AthAnalysisBase,2.4.8,here')
+    """
+    if asetup_root is None:
+        asetup_root = os.environ.get(
+            'AtlasSetup', '/afs/cern.ch/atlas/software/dist/AtlasSetup')
+    asetup_sh = osp.join(asetup_root, 'scripts', 'asetup.sh')
+    return 'source %s %s' % (_quote(asetup_sh), tags)
+
+def _release_stamps(env, workdir):
+    """return the list of (path, mtime) of the directories of the release
+    install tree the environment `env` is set up for"""
+    dirs = [d for d in env.get('CMTPATH', '').split(os.pathsep) if d]
+    if not dirs:
+        dirs = [env[k] for k in ('AtlasBaseDir', 'SITEROOT') if env.get(k)]
+    stamps = []
+    for d in dirs:
+        if d == workdir or d.startswith(workdir + os.sep):
+            continue                            # the user's work area
+        install_area = osp.join(d, 'InstallArea')
+        for p in (d, install_area,
+                  osp.join(install_area, env.get('CMTCONFIG', ''), 'lib')):
+            try:
+                stamps.append((p, int(os.stat(p).st_mtime)))
+            except OSError:
+                pass
+    return stamps
+
+def take(setup, workdir=None):
+    """run the `setup` command (in a bash sub-shell, from the directory
+    `workdir`) and return the snapshot of its effects, as a dict:
+     'setup':       the command
+     'workdir':     the (absolute) directory it was run from
+     'changed':     the dict of the set or modified variables
+     'unset':       the list of the removed variables
+     'base':        the former values of the modified variables
+     'asetup_save': the content of the .asetup.save file (or None)
+     'stamps':      the (path, mtime) of the release install tree
+    raise RuntimeError if `setup` fails.
+    """
+    if workdir is None:
+        workdir = os.getcwd()
+    workdir = osp.abspath(workdir)
+    sc, out, before, after = shutils.capture_env(setup, cwd=workdir)
+    if sc != 0 or after is None:
+        raise RuntimeError('setup [%s] failed (sc=%s):\n%s' % (setup, sc, out))
+    changed, unset = shutils.diff_env(before, after, ignore=_IGNORED_ENV)
+    changed = dict((k, v) for k, v in changed.iteritems() if _env_name.match(k))
+    unset = [k for k in unset if _env_name.match(k)]
+
+    asetup_save = None
+    try:
+        with open(osp.join(workdir, '.asetup.save'), 'r') as f:
+            asetup_save = f.read()
+    except IOError:
+        pass
+
+    return {
+        'setup':       setup,
+        'workdir':     workdir,
+        'changed':     changed,
+        'unset':       unset,
+        'base':        dict((k, before[k]) for k in changed if k in before),
+        'asetup_save': asetup_save,
+        'stamps':      _release_stamps(after, workdir),
+        }
+
+def _render(name, value, base, workdir):
+    """return the shell expression of `value`: the former value `base` of
+    the variable is referenced rather than copied when it was only extended,
+    and `workdir` is replaced by its placeholder"""
+    pieces = [value]
+    if base and value != base:
+        if value.endswith(base):
+            pieces = [value[:-len(base)], None]
+        elif value.startswith(base):
+            pieces = [None, value[len(base):]]
+    out = []
+    if workdir != os.sep:
+        # whole paths only: not within a longer path ('/x/w', '/w2')
+        anchor = re.compile(r'(?<![^\s:;=\'"])' + re.escape(workdir) +
+                            r'(?=[/\s:;\'"]|$)')
+    else:
+        anchor = None
+    for piece in pieces:
+        if piece is None:
+            out.append('"${%s}"' % name)
+            continue
+        pos = 0
+        while pos < len(piece):
+            m = anchor and anchor.search(piece, pos)
+            if not m:
+                out.append(_quote(piece[pos:]))
+                break
+            if m.start() > pos:
+                out.append(_quote(piece[pos:m.start()]))
+            out.append('"${%s}"' % _WORKDIR_VAR)
+            pos = m.end()
+    return ''.join(out) or "''"
+
+def write(snap, fname):
+    """write the snapshot `snap` (see `take`) as the shell script `fname`"""
+    lines = [
+        '# PyCmt environment snapshot (abuild-env-snapshot.py) -- do not edit',
+        '#@version %d' % SNAPSHOT_VERSION,
+        '#@created %s' % time.strftime('%Y-%m-%d %H:%M:%S'),
+        '#@setup %s' % snap['setup'],
+        '#@workdir %s' % snap['workdir'],
+        ]
+    for path, mtime in snap['stamps']:
+        lines.append('#@stamp %d %s' % (mtime, path))
+    lines += [
+        '#',
+        '# usage: . %s' % osp.basename(fname),
+        '# the environment is restored for the work directory $%s (default:'
+        % _WORKDIR_VAR,
+        '# the current directory). nothing is done (and 1 is returned) if the',
+        '# release install tree changed since the snapshot was taken.',
+        '',
+        '_envsnap_ok=1',
+        ]
+    for path, mtime in snap['stamps']:
+        lines.append('[ "`stat -L -c %%Y %s 2>/dev/null`" = "%d" ] '
+                     '|| _envsnap_ok=0' % (_quote(path), mtime))
+    lines += [
+        'if [ "$_envsnap_ok" != 1 ]; then',
+        '    unset _envsnap_ok',
+        '    echo "%s: stale environment snapshot, the release changed" >&2'
+        % osp.basename(fname),
+        '    return 1 2>/dev/null || exit 1',
+        'fi',
+        'unset _envsnap_ok',
+        ': ${%s:=$PWD}' % _WORKDIR_VAR,
+        '',
+        ]
+    if snap['asetup_save'] is not None:
+        content = snap['asetup_save']
+        if content and not content.endswith('\n'):
+            content += '\n'
+        lines += [
+            'if [ ! -e "${%s}/.asetup.save" ]; then' % _WORKDIR_VAR,
+            'cat > "${%s}/.asetup.save" <<\'_ENVSNAP_EOF_\'' % _WORKDIR_VAR,
+            content + '_ENVSNAP_EOF_',
+            'fi',
+            '',
+            ]
+    changed, base = snap['changed'], snap['base']
+    for name in sorted(changed):
+        lines.append('export %s=%s' % (
+            name, _render(name, changed[name], base.get(name, ''),
+                          snap['workdir'])))
+    for name in sorted(snap['unset']):
+        lines.append('unset %s' % name)
+    lines.append('')
+
+    import tempfile
+    outdir = osp.dirname(osp.abspath(fname))
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=outdir)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines))
+        os.chmod(tmp, 0644)
+        os.rename(tmp, fname)
+        tmp = None
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+    return
+
+def read_header(fname):
+    """return the header of the snapshot `fname` as a dict with the keys
+    'version', 'created', 'setup', 'workdir' and 'stamps' (or None if `fname`
+    is not a snapshot)
+    """
+    hdr = {'stamps': []}
+    try:
+        with open(fname, 'r') as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                if not line.startswith('#@'):
+                    continue
+                key, _, value = line[2:].rstrip('\n').partition(' ')
+                if key == 'stamp':
+                    mtime, _, path = value.partition(' ')
+                    hdr['stamps'].append((path, int(mtime)))
+                else:
+                    hdr[key] = value
+    except (IOError, ValueError):
+        return None
+    if 'version' not in hdr:
+        return None
+    return hdr
+
+def is_valid(fname):
+    """return True if the snapshot `fname` is up to date w.r.t. the release
+    install tree it was taken from"""
+    hdr = read_header(fname)
+    if hdr is None or hdr['version'] != str(SNAPSHOT_VERSION):
+        return False
+    for path, mtime in hdr['stamps']:
+        try:
+            if int(os.stat(path).st_mtime) != mtime:
+                return False
+        except OSError:
+            return False
+    return True
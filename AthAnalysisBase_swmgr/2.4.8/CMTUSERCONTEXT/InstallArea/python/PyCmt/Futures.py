@@ -0,0 +1,275 @@
+## @author: agent <agent@local>
+## @file :  Futures.py
+## @purpose: futures (results of asynchronous operations).
+##           `concurrent.futures` is used when available (python >= 3.2 or
+##           the 'futures' backport), a minimal compatible implementation is
+##           provided otherwise (futures, a pool of threads and as_completed).
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__author__  = "agent <agent@local>"
+
+__all__ = [
+    'Future',
+    'CancelledError',
+    'TimeoutError',
+    'ThreadPoolExecutor',
+    'as_completed',
+    ]
+
+try:
+    from concurrent.futures import Future, CancelledError, TimeoutError
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+except ImportError:
+    import sys
+    import threading
+    import logging
+    import Queue
+    import time
+    import weakref
+    import atexit
+
+    class CancelledError(Exception):
+        """the future was cancelled"""
+
+    class TimeoutError(Exception):
+        """the operation exceeded the given deadline"""
+
+    _PENDING   = 'PENDING'
+    _RUNNING   = 'RUNNING'
+    _CANCELLED = 'CANCELLED'
+    _FINISHED  = 'FINISHED'
+
+    class Future(object):
+        """the result of an asynchronous computation.
+        (a subset of `concurrent.futures.Future`)
+        """
+        def __init__(self):
+            self._cond = threading.Condition()
+            self._state = _PENDING
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def __repr__(self):
+            return '<Future at 0x%x state=%s>' % (id(self), self._state)
+
+        def _invoke_callbacks(self):
+            for fn in self._callbacks:
+                try:
+                    fn(self)
+                except Exception:
+                    logging.getLogger('Future').exception(
+                        'exception calling callback for %r', self)
+
+        def cancel(self):
+            """cancel the future if it is not running (or done) yet.
+            return True if the future is cancelled"""
+            with self._cond:
+                if self._state in (_RUNNING, _FINISHED):
+                    return False
+                if self._state == _CANCELLED:
+                    return True
+                self._state = _CANCELLED
+                self._cond.notify_all()
+            self._invoke_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._state == _CANCELLED
+
+        def running(self):
+            return self._state == _RUNNING
+
+        def done(self):
+            return self._state in (_CANCELLED, _FINISHED)
+
+        def _wait(self, timeout):
+            with self._cond:
+                if not self.done():
+                    self._cond.wait(timeout)
+                if self._state == _CANCELLED:
+                    raise CancelledError()
+                if self._state != _FINISHED:
+                    raise TimeoutError()
+
+        def result(self, timeout=None):
+            """return the result of the call, waiting at most `timeout`
+            seconds for it. re-raise the exception raised by the call"""
+            self._wait(timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+        def exception(self, timeout=None):
+            """return the exception raised by the call (or None)"""
+            self._wait(timeout)
+            return self._exception
+
+        def add_done_callback(self, fn):
+            """call `fn(future)` once the future is done"""
+            with self._cond:
+                if not self.done():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        ## methods for the producer of the result
+        def set_running_or_notify_cancel(self):
+            """mark the future as running.
+            return False if it has been cancelled"""
+            with self._cond:
+                if self._state == _CANCELLED:
+                    return False
+                self._state = _RUNNING
+                return True
+
+        def set_result(self, result):
+            with self._cond:
+                self._result = result
+                self._state = _FINISHED
+                self._cond.notify_all()
+            self._invoke_callbacks()
+
+        def set_exception(self, exception):
+            with self._cond:
+                self._exception = exception
+                self._state = _FINISHED
+                self._cond.notify_all()
+            self._invoke_callbacks()
+
+        pass # Future
+
+    class ThreadPoolExecutor(object):
+        """run calls in a pool of at most `max_workers` threads, started on
+        demand. (a subset of `concurrent.futures.ThreadPoolExecutor`)
+        """
+        def __init__(self, max_workers):
+            if max_workers <= 0:
+                raise ValueError("max_workers must be greater than 0")
+            self._max_workers = max_workers
+            self._queue = Queue.Queue()
+            self._threads = set()
+            self._lock = threading.Lock()
+            self._shutdown = False
+            _live_executors.add(self)
+
+        def _work(self):
+            while 1:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.put(None)       # for the other workers
+                    return
+                future, fn, args, kwargs = item
+                del item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException:
+                    future.set_exception(sys.exc_info()[1])
+                else:
+                    future.set_result(result)
+                del future, fn, args, kwargs
+
+        def submit(self, fn, *args, **kwargs):
+            """schedule `fn(*args, **kwargs)` and return its `Future`"""
+            with self._lock:
+                if self._shutdown:
+                    raise RuntimeError(
+                        'cannot schedule new futures after shutdown')
+                future = Future()
+                self._queue.put((future, fn, args, kwargs))
+                if len(self._threads) < self._max_workers:
+                    t = threading.Thread(target=self._work)
+                    t.daemon = True
+                    t.start()
+                    self._threads.add(t)
+                return future
+
+        def map(self, fn, *iterables, **kwargs):
+            """return an iterator over the results of `fn` applied to the
+            items of `iterables` (like `itertools.imap`), run concurrently.
+            `timeout` (in seconds, from the call to map) raises TimeoutError
+            when a result is not available in time."""
+            timeout = kwargs.pop('timeout', None)
+            if kwargs:
+                raise TypeError('unexpected arguments %s' % kwargs.keys())
+            end = None
+            if timeout is not None:
+                end = time.time() + timeout
+            fs = [self.submit(fn, *args) for args in zip(*iterables)]
+            def results():
+                try:
+                    for f in fs:
+                        if end is None:
+                            yield f.result()
+                        else:
+                            yield f.result(max(0, end - time.time()))
+                finally:
+                    for f in fs:
+                        f.cancel()
+            return results()
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            """stop the workers once the pending calls are done (or
+            cancelled if `cancel_futures` is True)"""
+            with self._lock:
+                self._shutdown = True
+                while cancel_futures:
+                    try:
+                        item = self._queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if item is not None:
+                        item[0].cancel()
+                self._queue.put(None)
+            if wait:
+                for t in self._threads:
+                    t.join()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.shutdown(wait=True)
+            return False
+
+        pass # ThreadPoolExecutor
+
+    _live_executors = weakref.WeakSet()
+
+    def _python_exit():
+        # the workers must be done before the interpreter is torn down
+        for executor in list(_live_executors):
+            executor.shutdown(wait=True, cancel_futures=True)
+    atexit.register(_python_exit)
+
+    def as_completed(fs, timeout=None):
+        """iterate over the futures `fs` as they complete (or are cancelled).
+        raise TimeoutError if they are not all done after `timeout` seconds.
+        """
+        fs = set(fs)
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        done = Queue.Queue()
+        for f in fs:
+            f.add_done_callback(done.put)
+        for _ in xrange(len(fs)):
+            try:
+                if end is None:
+                    # (a blocking Queue.get can not be interrupted)
+                    while 1:
+                        try:
+                            f = done.get(timeout=3600)
+                            break
+                        except Queue.Empty:
+                            pass
+                else:
+                    f = done.get(timeout=max(0, end - time.time()))
+            except Queue.Empty:
+                raise TimeoutError('%d (of %d) futures unfinished' %
+                                   (len([f for f in fs if not f.done()]),
+                                    len(fs)))
+            yield f
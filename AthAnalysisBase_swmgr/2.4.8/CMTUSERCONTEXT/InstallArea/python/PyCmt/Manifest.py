@@ -0,0 +1,272 @@
+## @author: agent <agent@local>
+## @file :  Manifest.py
+## @purpose: an indexed (sqlite) store of the content of releases: packages,
+##           versions, paths, projects and 'use' edges. It answers questions
+##           like "version of X in release R" or "which releases contain
+##           X-00-01-02" without touching the release trees.
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__author__  = "agent <agent@local>"
+
+__all__ = [
+    'ReleaseManifest',
+    ]
+
+import os
+import os.path as osp
+import sqlite3
+
+import PyCmt.Logging as L
+import PyCmt.Cache as Cache
+
+_schema = """\
+CREATE TABLE IF NOT EXISTS releases (
+    id        INTEGER PRIMARY KEY,
+    name      TEXT UNIQUE NOT NULL,
+    cmtconfig TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    release_id INTEGER NOT NULL,
+    name       TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    version    TEXT,
+    project    TEXT,
+    PRIMARY KEY (release_id, name, path)
+);
+CREATE INDEX IF NOT EXISTS packages_by_name    ON packages (name, path);
+CREATE INDEX IF NOT EXISTS packages_by_version ON packages (version);
+CREATE TABLE IF NOT EXISTS uses (
+    release_id INTEGER NOT NULL,
+    pkg        TEXT NOT NULL,
+    dep        TEXT NOT NULL,
+    PRIMARY KEY (release_id, pkg, dep)
+);
+CREATE INDEX IF NOT EXISTS uses_by_dep ON uses (release_id, dep);
+"""
+
+def _split_name(pkg):
+    """split a package (full)name into its (path, leaf-name)"""
+    pkg = osp.normpath(pkg).strip(os.sep)
+    return osp.dirname(pkg), osp.basename(pkg)
+
+class ReleaseManifest(object):
+    """An indexed store of the content of (many) releases.
+
+    usage:
+     db = ReleaseManifest('releases.db')
+     db.add_release('AthAnalysisBase,2.4.8', pkgdb)
+     db.version('Control/AthenaKernel', 'AthAnalysisBase,2.4.8')
+     db.releases_with('AthenaKernel-00-42-07')
+    """
+
+    def __init__(self, fname=None):
+        """open (or create) the manifest stored in `fname`.
+        it defaults to 'manifest.db' under the PyCmt cache directory.
+        """
+        object.__init__(self)
+        if fname is None:
+            fname = osp.join(Cache.cache_dir(), 'manifest.db')
+        if fname != ':memory:' and not osp.exists(osp.dirname(fname) or '.'):
+            os.makedirs(osp.dirname(fname))
+        self.fname = fname
+        self.msg = L.logging.getLogger("ReleaseManifest")
+        self.db = sqlite3.connect(fname)
+        self.db.text_factory = str
+        self.db.executescript(_schema)
+        return
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _release_id(self, release):
+        row = self.db.execute("SELECT id FROM releases WHERE name=?",
+                              (release,)).fetchone()
+        if row is None:
+            raise KeyError(release)
+        return row[0]
+
+    ## filling -----------------------------------------------------------------
+    def add_release(self, release, pkgdb, graph=None, cmtconfig=None):
+        """store (or replace) the content of `release`.
+         `pkgdb`  a dict of full-name -> `CmtPkg` (see `Cmt.release_pkgdb`)
+                  or any iterable of `CmtPkg`
+         `graph`  an optional `Cmt.PkgGraph` holding the 'use' edges
+        """
+        if isinstance(pkgdb, dict):
+            pkgdb = pkgdb.values()
+        pkgdb = list(pkgdb)
+        with self.db:
+            self.remove_release(release, commit=False)
+            cur = self.db.execute(
+                "INSERT INTO releases (name, cmtconfig) VALUES (?,?)",
+                (release, cmtconfig))
+            rid = cur.lastrowid
+            self.db.executemany(
+                "INSERT OR REPLACE INTO packages VALUES (?,?,?,?,?)",
+                ((rid, p.name, (p.path or '').strip(os.sep), p.version,
+                  p.project) for p in pkgdb))
+            if graph is not None:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO uses VALUES (?,?,?)",
+                    ((rid, n, d)
+                     for n in graph.names()
+                     for d in graph.deps(n)))
+        self.msg.debug("stored release [%s] (%i packages)",
+                       release, len(pkgdb))
+        return
+
+    def add_release_tags(self, tags, with_uses=False, use_cache=True,
+                         pool=None):
+        """set up (or reuse the snapshot of) the release described by the
+        asetup `tags` and store its content under the name `tags`.
+         `with_uses` also store the 'use' edges (needs a 'cmt show uses',
+                     unless they were snapshotted too, see `Cmt.release_graph`)
+         `pool`      a `Cmt.asetup_pool` to inspect the release from
+        """
+        import PyCmt.Cmt as Cmt
+        pkgdb = Cmt.release_snapshot(tags, use_cache=use_cache, pool=pool)
+        graph = None
+        if with_uses:
+            graph = Cmt.release_graph(tags, use_cache=use_cache, pool=pool)
+        self.add_release(tags, pkgdb, graph=graph)
+        return
+
+    def remove_release(self, release, commit=True):
+        """remove all the content of `release` from the manifest"""
+        def _remove():
+            try:
+                rid = self._release_id(release)
+            except KeyError:
+                return
+            for table in ('packages', 'uses'):
+                self.db.execute("DELETE FROM %s WHERE release_id=?" % table,
+                                (rid,))
+            self.db.execute("DELETE FROM releases WHERE id=?", (rid,))
+        if commit:
+            with self.db:
+                _remove()
+        else:
+            _remove()
+        return
+
+    ## queries -----------------------------------------------------------------
+    def releases(self):
+        """return the (sorted) names of all the stored releases"""
+        return [r[0] for r in
+                self.db.execute("SELECT name FROM releases ORDER BY name")]
+
+    def pkg(self, pkg, release):
+        """return the `CmtPkg` for package `pkg` (a leaf or full name) in
+        `release`, or None"""
+        from PyCmt.Cmt import CmtPkg
+        path, name = _split_name(pkg)
+        sql = ("SELECT p.name, p.version, p.path, p.project "
+               "FROM packages p JOIN releases r ON p.release_id=r.id "
+               "WHERE r.name=? AND p.name=?")
+        args = [release, name]
+        if path:
+            sql += " AND p.path=?"
+            args.append(path)
+        row = self.db.execute(sql, args).fetchone()
+        if row is None:
+            return None
+        return CmtPkg(row[0], row[1], row[2], projName=row[3])
+
+    def version(self, pkg, release):
+        """return the version of package `pkg` (a leaf or full name) in
+        `release`, or None"""
+        pkg = self.pkg(pkg, release)
+        if pkg is None:
+            return None
+        return pkg.version
+
+    def versions(self, pkg):
+        """return a dict of release -> version of package `pkg` (a leaf or
+        full name) for all the releases holding it"""
+        path, name = _split_name(pkg)
+        sql = ("SELECT r.name, p.version "
+               "FROM packages p JOIN releases r ON p.release_id=r.id "
+               "WHERE p.name=?")
+        args = [name]
+        if path:
+            sql += " AND p.path=?"
+            args.append(path)
+        return dict(self.db.execute(sql, args))
+
+    def releases_with(self, version):
+        """return the (sorted) names of the releases containing the package
+        tag `version` (e.g. 'AthenaKernel-00-42-07')"""
+        return [r[0] for r in self.db.execute(
+            "SELECT DISTINCT r.name "
+            "FROM packages p JOIN releases r ON p.release_id=r.id "
+            "WHERE p.version=? ORDER BY r.name", (version,))]
+
+    def uses(self, pkg, release):
+        """return the (sorted) names of the packages `pkg` (leaf name) uses
+        in `release`"""
+        return [r[0] for r in self.db.execute(
+            "SELECT u.dep FROM uses u JOIN releases r ON u.release_id=r.id "
+            "WHERE r.name=? AND u.pkg=? ORDER BY u.dep",
+            (release, _split_name(pkg)[1]))]
+
+    def clients(self, pkg, release):
+        """return the (sorted) names of the packages using `pkg` (leaf name)
+        in `release`"""
+        return [r[0] for r in self.db.execute(
+            "SELECT u.pkg FROM uses u JOIN releases r ON u.release_id=r.id "
+            "WHERE r.name=? AND u.dep=? ORDER BY u.pkg",
+            (release, _split_name(pkg)[1]))]
+
+    pass # ReleaseManifest
+
+def main(args=None):
+    """command line interface:
+      Manifest.py [-f db] add <asetup-tags>...
+      Manifest.py [-f db] version <pkg> <release>
+      Manifest.py [-f db] releases-with <pkg-tag>
+      Manifest.py [-f db] releases
+    """
+    import sys
+    import getopt
+    if args is None:
+        args = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(args, 'f:', ['file='])
+    except getopt.error:
+        print main.__doc__
+        return 1
+    fname = None
+    for opt, arg in opts:
+        if opt in ('-f', '--file'):
+            fname = arg
+    if not args:
+        print main.__doc__
+        return 1
+    cmd, args = args[0], args[1:]
+    with ReleaseManifest(fname) as db:
+        if cmd == 'add':
+            for tags in args:
+                db.add_release_tags(tags)
+        elif cmd == 'version' and len(args) == 2:
+            print db.version(args[0], args[1])
+        elif cmd == 'releases-with' and len(args) == 1:
+            for r in db.releases_with(args[0]):
+                print r
+        elif cmd == 'releases':
+            for r in db.releases():
+                print r
+        else:
+            print main.__doc__
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
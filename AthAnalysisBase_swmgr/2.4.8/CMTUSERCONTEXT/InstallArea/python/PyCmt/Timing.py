@@ -0,0 +1,207 @@
+## @author: agent <agent@local>
+## @file :  Timing.py
+## @purpose: opt-in instrumentation of the hot paths of PyCmt (cmt.exe
+##           spawns, shell round trips, files parsing, merge scripts...).
+##           functions decorated with `timed` are left untouched unless
+##           $PYCMT_TIMING is set when they are defined. their call counts,
+##           wall and cpu times and arguments sizes are then collected and
+##           reported when the process exits:
+##            PYCMT_TIMING=1              flat report on stderr
+##            PYCMT_TIMING=timing.txt     flat report appended to the file
+##            PYCMT_TIMING=timing-%p.json JSON report (%p: the process id)
+from __future__ import with_statement
+
+__version__ = "$Revision$"
+__author__  = "agent <agent@local>"
+
+__all__ = [
+    'enabled',
+    'timed',
+    'stats',
+    'report',
+    'reset',
+    ]
+
+import os
+import sys
+import time
+import threading
+
+from PyCmt.decorator import decorator
+
+## where the report goes (None: instrumentation disabled)
+_output = os.environ.get('PYCMT_TIMING', '')
+if _output in ('', '0'):
+    _output = None
+enabled = _output is not None
+
+class _Stat(object):
+    """the statistics of one timed function"""
+    __slots__ = ('count', 'errors', 'wall', 'cpu', 'wall_max', 'sizes')
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.wall_max = 0.
+        self.sizes = {}   # power-of-2 upper bound -> number of calls
+
+    def to_dict(self):
+        return {
+            'count':    self.count,
+            'errors':   self.errors,
+            'wall':     self.wall,
+            'cpu':      self.cpu,
+            'wall_max': self.wall_max,
+            'sizes':    dict(('<%d' % k, v) for k, v in self.sizes.items()),
+            }
+
+_stats = {}
+_lock = threading.Lock()
+_start = time.time()
+
+def _cpu():
+    # user+system time of the whole process (all its threads)
+    t = os.times()
+    return t[0] + t[1]
+
+_sized = (basestring, list, tuple, dict, set, frozenset)
+
+def _arg_size(args, kwargs):
+    """the default size of the arguments of a call: the total length of the
+    strings and containers among them"""
+    n = 0
+    for a in args:
+        if isinstance(a, _sized):
+            n += len(a)
+    for a in kwargs.itervalues():
+        if isinstance(a, _sized):
+            n += len(a)
+    return n
+
+def _record(name, wall, cpu, size, failed):
+    bucket = 1
+    while bucket <= size:
+        bucket <<= 1
+    with _lock:
+        st = _stats.get(name)
+        if st is None:
+            st = _stats[name] = _Stat()
+        st.count += 1
+        st.errors += failed
+        st.wall += wall
+        st.cpu += cpu
+        if wall > st.wall_max:
+            st.wall_max = wall
+        st.sizes[bucket] = st.sizes.get(bucket, 0) + 1
+
+def _label(func):
+    mod = func.__module__ or ''
+    if mod == '__main__':
+        # a script: use its name
+        mod = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return '%s.%s' % (mod.rsplit('.', 1)[-1], func.__name__)
+
+def timed(name=None, size=None):
+    """decorator collecting the statistics of the calls of a function (if
+    the instrumentation is enabled, see the module's documentation).
+     - `name` is the name of the function in the report (default:
+       'module.function', the script name is used for '__main__'),
+     - `size(args, kwargs)` returns the size of the arguments of a call, for
+       the histogram of the report (default: the total length of the strings
+       and containers among them).
+    the cpu time is the one of the whole process.
+
+    usage:
+      @timed
+      def parse(fname): ...
+      @timed('cmt.show', size=lambda args, kw: len(kw))
+      def show(self, **kw): ...
+    """
+    if callable(name):
+        # used as '@timed'
+        return timed()(name)
+    def wrap(func):
+        if not enabled:
+            return func
+        label = name or _label(func)
+        argsize = size or _arg_size
+        def call(func, *args, **kwargs):
+            n = argsize(args, kwargs)
+            failed = True
+            t0, c0 = time.time(), _cpu()
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _record(label, time.time() - t0, _cpu() - c0, n, failed)
+        return decorator(call, func)
+    return wrap
+
+def stats():
+    """return the statistics collected so far, as a dict of name -> dict
+    with the keys 'count', 'errors', 'wall', 'cpu', 'wall_max' (in seconds)
+    and 'sizes' (arguments size upper bound ('<n') -> number of calls)"""
+    with _lock:
+        return dict((k, st.to_dict()) for k, st in _stats.iteritems())
+
+def reset():
+    """forget the statistics collected so far"""
+    with _lock:
+        _stats.clear()
+
+def _flat_report(data):
+    lines = [
+        '## PyCmt timing report -- pid %d, %.3fs -- %s' % (
+            data['pid'], data['wall'], ' '.join(data['argv'])),
+        '# %-40s %7s %10s %10s %10s %6s  %s' % (
+            'name', 'count', 'wall[s]', 'cpu[s]', 'max[s]', 'errors',
+            'args-sizes'),
+        ]
+    fcts = data['functions']
+    for name in sorted(fcts, key=lambda k: -fcts[k]['wall']):
+        st = fcts[name]
+        sizes = sorted(st['sizes'].items(), key=lambda kv: int(kv[0][1:]))
+        lines.append('  %-40s %7d %10.3f %10.3f %10.3f %6d  %s' % (
+            name, st['count'], st['wall'], st['cpu'], st['wall_max'],
+            st['errors'], ' '.join('%s:%d' % kv for kv in sizes)))
+    return '\n'.join(lines) + '\n'
+
+def report(output=None):
+    """write the report of the statistics collected so far into `output`
+    ('1' or 'stderr', or a file name: JSON if it ends with '.json', a flat
+    report appended to the file otherwise. '%p' is replaced by the process
+    id). default: $PYCMT_TIMING
+    """
+    if output is None:
+        output = _output or 'stderr'
+    data = {
+        'pid':       os.getpid(),
+        'argv':      sys.argv,
+        'wall':      time.time() - _start,
+        'functions': stats(),
+        }
+    if output in ('1', 'stderr'):
+        sys.stderr.write(_flat_report(data))
+        return
+    fname = output.replace('%p', str(os.getpid()))
+    if fname.endswith('.json'):
+        import json
+        with open(fname, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+    else:
+        with open(fname, 'a') as f:
+            f.write(_flat_report(data))
+
+def _report_at_exit():
+    if not _stats:
+        return
+    try:
+        report()
+    except (IOError, OSError), err:
+        print >> sys.stderr, "PyCmt.Timing: could not write report: %s" % err
+
+if enabled:
+    import atexit
+    atexit.register(_report_at_exit)
@@ -0,0 +1,260 @@
+# @file: cache_unittest.py
+
+"""unit tests for the on-disk cache of PyCmt.Cache and the memoize
+decorators of PyCmt.Decorators"""
+
+import gc, os, shutil, tempfile, unittest
+
+import PyCmt.Cache as Cache
+from PyCmt.Decorators import memoize_method, persistent_memoize
+
+### data ----------------------------------------------------------------------
+_ncalls = []
+
+@persistent_memoize (depends_on=lambda fname, scale=1, msg=None: [fname],
+                     ignore=('msg',))
+def count_lines (fname, scale=1, msg=None):
+    _ncalls.append (fname)
+    with open (fname) as f:
+        return scale * len (f.readlines())
+
+class Squares (object):
+    def __init__ (self):
+        self.ncalls = 0
+
+    @memoize_method (maxsize=2)
+    def square (self, x):
+        self.ncalls += 1
+        return x*x
+
+    @memoize_method (maxsize=2)
+    def length (self, seq):
+        self.ncalls += 1
+        return len (seq)
+
+def write (fname, content):
+    with open (fname, 'w') as f:
+        f.write (content)
+
+class CacheDirTestCase (unittest.TestCase):
+    """runs its tests with $PYCMT_CACHEDIR pointing to a temporary directory
+    """
+    def setUp (self):
+        self.top = tempfile.mkdtemp()
+        self.cachedir = os.path.join (self.top, 'cache')
+        self.environ = dict ((k, os.environ.get (k))
+                             for k in ('PYCMT_CACHEDIR', 'PYCMT_NO_CACHE'))
+        os.environ['PYCMT_CACHEDIR'] = self.cachedir
+        os.environ.pop ('PYCMT_NO_CACHE', None)
+
+    def tearDown (self):
+        for k, v in self.environ.items():
+            if v is None:
+                os.environ.pop (k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree (self.top)
+
+    def entries (self, kind):
+        return sorted (os.path.join (d, f) for d, _, fs in
+                       os.walk (os.path.join (self.cachedir, kind))
+                       for f in fs)
+
+### stamped entries -----------------------------------------------------------
+class StampedCacheTestCase (CacheDirTestCase):
+    def test1_load_dump (self):
+        """entries are found back, from the cache directory"""
+        self.assertEqual (Cache.cache_dir(), self.cachedir)
+        key = Cache.cache_key ('17.0.0', 'x86_64')
+        self.assertNotEqual (key, Cache.cache_key ('17.0.1', 'x86_64'))
+        self.assertEqual (Cache.load ('test', key), None)
+        self.assert_ (Cache.dump ('test', key, {'a': [1, 2]}))
+        self.assertEqual (Cache.load ('test', key), {'a': [1, 2]})
+        Cache.remove ('test', key)
+        self.assertEqual (Cache.load ('test', key), None)
+        Cache.remove ('test', key)
+        self.assert_ (not Cache.dump ('test', key, lambda: 0))
+        self.assertEqual (os.listdir (os.path.join (self.cachedir, 'test')),
+                          [])
+
+    def test2_stamps (self):
+        """entries are invalidated when their files change"""
+        fname = os.path.join (self.top, 'requirements')
+        write (fname, 'use AthenaKernel AthenaKernel-00-42-07 Control\n')
+        self.assertEqual (Cache.file_stamp (fname)[1], 47)
+        self.assertEqual (Cache.file_stamp (fname+'.none'), None)
+        Cache.dump ('test', 'key', 42, files=[fname])
+        self.assertEqual (Cache.load ('test', 'key'), 42)
+        write (fname, 'use AthenaKernel AthenaKernel-00-42-08 Control \n')
+        self.assertEqual (Cache.load ('test', 'key'), None)
+        Cache.dump ('test', 'key', 43, files=[fname])
+        os.remove (fname)
+        self.assertEqual (Cache.load ('test', 'key'), None)
+        # files which did not exist are part of the stamps too
+        Cache.dump ('test', 'key', 44, files=[fname])
+        self.assertEqual (Cache.load ('test', 'key'), 44)
+        write (fname, '')
+        self.assertEqual (Cache.load ('test', 'key'), None)
+
+    def test3_corrupted (self):
+        """corrupted or outdated entries are ignored"""
+        Cache.dump ('test', 'key', 42)
+        write (os.path.join (self.cachedir, 'test', 'key.pkl'), 'garbage')
+        self.assertEqual (Cache.load ('test', 'key'), None)
+        Cache.dump ('test', 'key', 42)
+        version = Cache.CACHE_VERSION
+        Cache.CACHE_VERSION = version + 1
+        try:
+            self.assertEqual (Cache.load ('test', 'key'), None)
+        finally:
+            Cache.CACHE_VERSION = version
+
+### content-addressed entries -------------------------------------------------
+class AddressedCacheTestCase (CacheDirTestCase):
+    def test1_lookup_store (self):
+        """content-addressed entries are stored, sharded"""
+        key = Cache.cache_key ('x')
+        self.assertRaises (KeyError, Cache.lookup, 'test', key)
+        self.assert_ (Cache.store ('test', key, range (3)))
+        self.assertEqual (Cache.lookup ('test', key), [0, 1, 2])
+        self.assertEqual (self.entries ('test'),
+                          [os.path.join (self.cachedir, 'test', key[:2],
+                                         key[2:]+'.pkl')])
+        self.assert_ (not Cache.store ('test', key+'0', lambda: 0))
+        self.assertRaises (KeyError, Cache.lookup, 'test', key+'0')
+
+    def test2_fingerprint (self):
+        """fingerprints change with the files"""
+        fname = os.path.join (self.top, 'f')
+        self.assertEqual (Cache.fingerprint (fname), (fname, None))
+        write (fname, 'abc')
+        os.utime (fname, (1000, 1000))
+        self.assertEqual (Cache.fingerprint (fname), (fname, 1000, 3))
+        fp = Cache.fingerprint (fname, content_hash=True)
+        write (fname, 'abd')
+        os.utime (fname, (1000, 1000))      # same (mtime, size)
+        self.assertEqual (Cache.fingerprint (fname)[:3], fp[:3])
+        self.assertNotEqual (Cache.fingerprint (fname, True), fp)
+
+    def test3_evict (self):
+        """the least recently used entries are evicted first"""
+        keys = [Cache.cache_key (i) for i in range (8)]
+        for i, key in enumerate (keys):
+            Cache.store ('test', key, 'x' * 1000)
+            os.utime (Cache._entry_fname ('test', key), (i, i))
+        Cache.lookup ('test', keys[0])      # most recently used now
+        size = os.path.getsize (Cache._entry_fname ('test', keys[0]))
+        self.assertEqual (Cache.evict ('test', 8*size), 0)
+        self.assertEqual (Cache.evict ('test', 4*size), 5)
+        self.assertEqual (len (self.entries ('test')), 3)
+        self.assertEqual (Cache.lookup ('test', keys[0]), 'x' * 1000)
+        for key in keys[1:6]:
+            self.assertRaises (KeyError, Cache.lookup, 'test', key)
+
+    def test4_bounded (self):
+        """stored entries are kept below their maximum size"""
+        max_size = 16 * 1024
+        for i in range (200):
+            self.assert_ (Cache.store ('bounded', Cache.cache_key (i),
+                                       'x' * 500, max_size))
+        # the size is only checked once 1/16th of it has been stored
+        total = sum (os.path.getsize (f) for f in self.entries ('bounded'))
+        self.assert_ (0 < total <= max_size * 17 // 16, total)
+        self.assertEqual (Cache.lookup ('bounded', Cache.cache_key (199)),
+                          'x' * 500)
+
+### memoize decorators --------------------------------------------------------
+class PersistentMemoizeTestCase (CacheDirTestCase):
+    def setUp (self):
+        CacheDirTestCase.setUp (self)
+        del _ncalls[:]
+        self.fname = os.path.join (self.top, 'lines.txt')
+        write (self.fname, 'a\nb\n')
+
+    def test1_memoize (self):
+        """results are computed once per arguments"""
+        self.assertEqual (count_lines (self.fname), 2)
+        self.assertEqual (count_lines (self.fname, msg='ignored'), 2)
+        self.assertEqual (count_lines (self.fname, 1), 2)
+        self.assertEqual (len (_ncalls), 1)
+        self.assertEqual (count_lines (self.fname, scale=2), 4)
+        self.assertEqual (len (_ncalls), 2)
+        self.assertEqual (
+            len (self.entries ('%s.count_lines' % (__name__,))), 2)
+        os.environ['PYCMT_NO_CACHE'] = '1'
+        self.assertEqual (count_lines (self.fname), 2)
+        self.assertEqual (len (_ncalls), 3)
+
+    def test2_depends_on (self):
+        """results are recomputed when the files they depend on change"""
+        os.utime (self.fname, (1000, 1000))
+        self.assertEqual (count_lines (self.fname), 2)
+        write (self.fname, 'a\nb\nc\n')      # new size
+        os.utime (self.fname, (1000, 1000))
+        self.assertEqual (count_lines (self.fname), 3)
+        self.assertEqual (len (_ncalls), 2)
+        write (self.fname, 'a\nb\nd\n')      # new mtime
+        os.utime (self.fname, (2000, 2000))
+        self.assertEqual (count_lines (self.fname), 3)
+        self.assertEqual (count_lines (self.fname), 3)
+        self.assertEqual (len (_ncalls), 3)
+        write (self.fname, 'a\nb\n')         # back to the first stamp
+        os.utime (self.fname, (1000, 1000))
+        self.assertEqual (count_lines (self.fname), 2)
+        self.assertEqual (len (_ncalls), 3)
+
+class MemoizeMethodTestCase (unittest.TestCase):
+    def test1_per_instance (self):
+        """results are cached per instance"""
+        a, b = Squares(), Squares()
+        self.assertEqual ([a.square (2), a.square (2), b.square (2)], [4]*3)
+        self.assertEqual ((a.ncalls, b.ncalls), (1, 1))
+        self.assertEqual (a.square.cache_info(), (1, 1, 2, 1))
+        self.assertEqual (a.square.__name__, 'square')
+        nitems = Squares.square.cache_info()[3]
+        del b
+        gc.collect()
+        self.assertEqual (Squares.square.cache_info()[3], nitems - 1)
+
+    def test2_maxsize (self):
+        """least recently used results are evicted first"""
+        a = Squares()
+        for x in (1, 2, 1, 3):              # 2 is evicted, not 1
+            a.square (x)
+        self.assertEqual (a.ncalls, 3)
+        a.square (1)
+        self.assertEqual (a.ncalls, 3)
+        a.square (2)
+        self.assertEqual (a.ncalls, 4)
+        self.assertEqual (a.square.cache_info()[3], 2)
+
+    def test3_invalidate (self):
+        """results can be dropped, one by one or all at once"""
+        a, b = Squares(), Squares()
+        a.square (1), a.square (2), b.square (1)
+        self.assert_ (a.square.invalidate (1))
+        self.assert_ (not a.square.invalidate (1))
+        self.assert_ (not Squares().square.invalidate (1))
+        a.square (1), a.square (2)
+        self.assertEqual (a.ncalls, 3)
+        a.square.cache_clear()
+        a.square (2)
+        self.assertEqual (a.ncalls, 4)
+        b.square (1)
+        self.assertEqual (b.ncalls, 1)      # untouched by a's cache_clear
+        Squares.square.cache_clear()
+        b.square (1)
+        self.assertEqual (b.ncalls, 2)
+
+    def test4_unhashable (self):
+        """calls with unhashable arguments are not cached"""
+        a = Squares()
+        self.assertEqual ([a.length ([1, 2]), a.length ([1, 2])], [2, 2])
+        self.assertEqual (a.ncalls, 2)
+        self.assertEqual ([a.length ((1, 2)), a.length ((1, 2))], [2, 2])
+        self.assertEqual (a.ncalls, 3)
+        self.assertEqual (a.length.cache_info()[3], 1)
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+# @file: cmt_unittest.py
+
+"""unit tests for the parsers and package graphs of PyCmt.Cmt
+(canned cmt output: no cmt.exe needed)"""
+
+import os, shutil, tempfile, unittest
+
+import PyCmt.Logging as L
+from PyCmt.Cmt import (CmtWrapper, CmtProject, PkgGraph, ClientsIndex,
+                       parse_uses, parse_macros)
+
+### data ----------------------------------------------------------------------
+msg = L.logging.getLogger ('cmt-test')
+msg.setLevel (L.logging.ERROR)
+
+show_uses = """\
+# use AtlasOfflineRelease AtlasOfflineRelease-*
+#   use MyAna MyAna-* PhysicsAnalysis
+#     use AnalysisTools AnalysisTools-* PhysicsAnalysis
+#       use StoreGate StoreGate-* Control
+#         use AthenaKernel AthenaKernel-* Control
+#           use AtlasPolicy AtlasPolicy-*
+#         use SGTools SGTools-* Control
+#           use AthenaKernel AthenaKernel-* Control
+#     use AthenaKernel AthenaKernel-* Control
+# use AtlasAnalysisRelease AtlasAnalysisRelease-*
+#   use AnalysisTools AnalysisTools-* PhysicsAnalysis
+# use AtlasCoreRelease AtlasCoreRelease-*
+#   use AtlasPolicy AtlasPolicy-*
+#
+# Selection :
+use CMT v1r25 (/sw/CMT)
+use AtlasPolicy AtlasPolicy-01-08-03 (/sw/AtlasCore/17.0.0)
+use AthenaKernel AthenaKernel-00-42-07 Control (/sw/AtlasCore/17.0.0)
+use SGTools SGTools-00-10-00 Control (/sw/AtlasCore/17.0.0)
+use StoreGate StoreGate-02-39-08 Control (/sw/AtlasCore/17.0.0)
+use AnalysisTools AnalysisTools-00-01-00 PhysicsAnalysis (/sw/AtlasAnalysis/17.0.0)
+use MyAna MyAna-00-00-01 PhysicsAnalysis (/sw/AtlasOffline/17.0.0)
+use AtlasCoreRelease AtlasCoreRelease-00-00-00 (/sw/AtlasCore/17.0.0)
+use AtlasAnalysisRelease AtlasAnalysisRelease-00-00-00 (/sw/AtlasAnalysis/17.0.0)
+use AtlasOfflineRelease AtlasOfflineRelease-00-00-00 (/sw/AtlasOffline/17.0.0)
+"""
+
+show_macros = """\
+cc='gcc'
+#CMTCONFIG=i686-slc5-gcc43-opt
+cppflags=' -pipe -O2 -Wall '
+includes=' -I"/sw/inc"
+ -I"/sw/more/inc" '
+empty=''
+package='MyAna'
+"""
+
+releases = ('AtlasOfflineRelease', 'AtlasAnalysisRelease', 'AtlasCoreRelease')
+
+class FakeCmt (CmtWrapper):
+    """a `CmtWrapper` over canned requirements files, not running cmt.exe"""
+    def __init__ (self, reqs):
+        self.msg = msg
+        self.reqs = reqs
+
+    def release_requirements (self):
+        return self.reqs
+
+### parsers -------------------------------------------------------------------
+class ParsersTestCase (unittest.TestCase):
+    def test1_parse_uses (self):
+        """the selection and the 'use' graph of 'cmt show uses'"""
+        pkgdb, graph = parse_uses (show_uses.splitlines (True), msg)
+        self.assertEqual (pkgdb['StoreGate'].version, 'StoreGate-02-39-08')
+        self.assertEqual (pkgdb['StoreGate'].path, 'Control')
+        self.assert_ ('CMT' not in graph)   # only in the selection
+        self.assertEqual (graph.cmt_pkg ('AthenaKernel').version,
+                          'AthenaKernel-00-42-07')
+        self.assertEqual (sorted (graph.deps ('MyAna')),
+                          ['AnalysisTools', 'AthenaKernel'])
+        self.assertEqual (sorted (graph.deps ('StoreGate')),
+                          ['AthenaKernel', 'SGTools'])
+        self.assertEqual (sorted (graph.deps ('AtlasAnalysisRelease')),
+                          ['AnalysisTools'])
+        self.assertEqual (graph.deps ('AtlasPolicy'), [])
+        # a package seen many times is only stored once
+        self.assertEqual (len (graph), 9)
+
+    def test2_parse_uses_pkgdb (self):
+        """versions are taken from the given package db"""
+        from PyCmt.Cmt import CmtPkg
+        pkgdb = {'AthenaKernel': CmtPkg ('AthenaKernel',
+                                         'AthenaKernel-00-99-00', 'Control')}
+        selection, graph = parse_uses (show_uses.splitlines(), msg, pkgdb)
+        self.assertEqual (selection['AthenaKernel'].version,
+                          'AthenaKernel-00-42-07')
+        self.assertEqual (graph.cmt_pkg ('AthenaKernel').version,
+                          'AthenaKernel-00-99-00')
+
+    def test3_parse_macros (self):
+        """name='value' lines, with values spanning multiple lines"""
+        macros = parse_macros (show_macros.splitlines (True))
+        self.assertEqual (sorted (macros),
+                          ['cc', 'cppflags', 'empty', 'includes', 'package'])
+        self.assertEqual (macros['cc'], 'gcc')
+        self.assertEqual (macros['cppflags'], ' -pipe -O2 -Wall ')
+        self.assertEqual (macros['includes'],
+                          ' -I"/sw/inc"\n -I"/sw/more/inc" ')
+        self.assertEqual (macros['empty'], '')
+        self.assertEqual (macros['package'], 'MyAna')
+
+### package graphs ------------------------------------------------------------
+class PkgGraphTestCase (unittest.TestCase):
+    def setUp (self):
+        self.graph = parse_uses (show_uses.splitlines(), msg)[1]
+
+    def test1_clients (self):
+        """direct and transitive clients and dependencies"""
+        g = self.graph
+        self.assertEqual (sorted (g.clients ('AthenaKernel')),
+                          ['MyAna', 'SGTools', 'StoreGate'])
+        self.assertEqual (g.transitive_clients ('StoreGate'),
+                          ['AnalysisTools', 'AtlasAnalysisRelease',
+                           'AtlasOfflineRelease', 'MyAna'])
+        self.assertEqual (g.transitive_deps ('AnalysisTools'),
+                          ['AthenaKernel', 'AtlasPolicy', 'SGTools',
+                           'StoreGate'])
+        self.assertEqual (g.transitive_deps ('MyAna', exclude=['StoreGate']),
+                          ['AnalysisTools', 'AthenaKernel', 'AtlasPolicy'])
+        self.assertEqual (g.transitive_clients ('NoSuchPkg'), [])
+
+    def test2_order (self):
+        """topological order and dependency chains"""
+        g = self.graph
+        order = g.topo_sort()
+        self.assertEqual (sorted (order), sorted (g.names()))
+        for n in order:
+            for d in g.deps (n):
+                self.assert_ (order.index (d) < order.index (n))
+        self.assertEqual (g.shortest_path ('MyAna', 'AtlasPolicy'),
+                          ['MyAna', 'AthenaKernel', 'AtlasPolicy'])
+        self.assertEqual (g.shortest_path ('AtlasPolicy', 'MyAna'), None)
+        from PyCmt.Cmt import CmtPkg
+        cycle = PkgGraph ([CmtPkg ('A'), CmtPkg ('B')], [(0, 1), (1, 0)])
+        self.assertRaises (ValueError, cycle.topo_sort)
+
+    def test3_clients_index (self):
+        """clients of a `ClientsIndex`, never reporting excluded packages"""
+        index = ClientsIndex.from_tree (self.graph, exclude=releases)
+        self.assertEqual (index.client_names ('AnalysisTools'), ['MyAna'])
+        self.assertEqual (index.client_names ('AthenaKernel', transitive=True),
+                          ['AnalysisTools', 'MyAna', 'SGTools', 'StoreGate'])
+        self.assertEqual (index.client_names (['SGTools', 'AnalysisTools']),
+                          ['MyAna', 'StoreGate'])
+        clients = index.clients ('StoreGate')
+        self.assertEqual ([(c.name, c.version) for c in clients],
+                          [('AnalysisTools', 'AnalysisTools-00-01-00')])
+        self.assertEqual (index.pkg ('AtlasOfflineRelease'), None)
+        self.assertEqual (index.pkg ('MyAna').path, 'PhysicsAnalysis')
+
+### package index -------------------------------------------------------------
+class PkgIndexTestCase (unittest.TestCase):
+    def setUp (self):
+        self.top = tempfile.mkdtemp()
+        reqs = []
+        for proj, uses in (
+            ('AtlasAnalysis', ['use AnalysisTools AnalysisTools-00-01-00 '
+                               'PhysicsAnalysis',
+                               'use AthenaKernel AthenaKernel-00-99-00 '
+                               'Control']),
+            ('AtlasCore', ['use AtlasPolicy AtlasPolicy-01-08-03',
+                           '  use AthenaKernel AthenaKernel-00-42-07 Control',
+                           'use_if tag=x pkg=Foo',
+                           'use Bad',
+                           '# use Commented Commented-00-00-00']),
+            ('AtlasEvent', None)):
+            path = os.path.join (self.top, proj, '17.0.0')
+            reqfile = os.path.join (path, proj+'Release', 'cmt',
+                                    'requirements')
+            if uses is not None:
+                os.makedirs (os.path.dirname (reqfile))
+                with open (reqfile, 'w') as f:
+                    f.write ('\n'.join (uses) + '\n')
+            reqs.append ((CmtProject (path, '17.0.0'), reqfile))
+        self.cmt = FakeCmt (reqs)
+
+    def tearDown (self):
+        shutil.rmtree (self.top)
+
+    def test1_pkg_index (self):
+        """packages of the *Release requirements, first project wins"""
+        index = self.cmt.pkg_index()
+        self.assertEqual (sorted (index),
+                          ['AnalysisTools', 'AthenaKernel', 'AtlasPolicy'])
+        pkg = index['AthenaKernel']
+        self.assertEqual ((pkg.version, pkg.path, pkg.project),
+                          ('AthenaKernel-00-99-00', 'Control',
+                           'AtlasAnalysis'))
+        pkg = index['AtlasPolicy']
+        self.assertEqual ((pkg.path, pkg.project), ('', 'AtlasCore'))
+        self.assertEqual (self.cmt.find_pkg ('AtlasPolicy').version,
+                          'AtlasPolicy-01-08-03')
+        self.assertEqual (self.cmt.find_pkgs (['AthenaKernel', 'Bad']),
+                          {'AthenaKernel': index['AthenaKernel'], 'Bad': None})
+        self.assertEqual (
+            self.cmt.get_pkg_versions (['PhysicsAnalysis/AnalysisTools']),
+            {'PhysicsAnalysis/AnalysisTools': 'AnalysisTools-00-01-00'})
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# @file: decorators_unittest.py
+
+"""unit tests for the process pools and executors of PyCmt.Decorators"""
+
+import logging, os, threading, time, unittest
+
+from PyCmt import Futures
+from PyCmt.Decorators import (forking, mp_forking, ForkingPool, forking_pool,
+                              async_executor)
+
+### data ----------------------------------------------------------------------
+msg = logging.getLogger ('decorators-test')
+if len(msg.handlers)==0:
+    logging.basicConfig()
+
+_nwarmups = 0
+
+def warmup():
+    global _nwarmups
+    _nwarmups += 1
+
+def bad_warmup():
+    raise ImportError ('no ROOT here')
+
+def getpid (*args):
+    return os.getpid(), _nwarmups
+
+def square (x):
+    return x*x
+
+def cube (x):                               # only used by test6_functions
+    return x*x*x
+
+def crash_on (x, bad=3):
+    if x == bad:
+        os._exit (3)                        # no result, no exception
+    return x
+
+def fail (x):
+    raise ValueError ('bad value %r' % (x,))
+
+def count (n):
+    for i in xrange (n):
+        yield i
+
+@forking
+def forked_fail (x):
+    return fail (x)
+
+@forking
+def forked_count (n):
+    return count (n)
+
+@mp_forking
+def mp_square (x):
+    return square (x)
+
+@mp_forking
+def mp_fail (x):
+    return fail (x)
+
+@forking_pool (processes=1, warmup=warmup)
+def pooled_getpid():
+    return getpid()
+
+def no_children():
+    """True if the process has no child left (running or unreaped)"""
+    try:
+        os.waitpid (-1, os.WNOHANG)
+    except OSError:
+        return True
+    return False
+
+### forking pools -------------------------------------------------------------
+class ForkingPoolTestCase (unittest.TestCase):
+    def setUp (self):
+        self.pool = ForkingPool (processes=2, warmup=warmup)
+
+    def tearDown (self):
+        self.pool.close()
+        pooled_getpid.pool.close()
+
+    def test1_warmup (self):
+        """workers are warmed up once, and reused"""
+        pids = [pooled_getpid() for i in range (3)]
+        self.assertEqual (len (set (pids)), 1)
+        self.assertEqual (pids[0][1], 1)
+        self.assertNotEqual (pids[0][0], os.getpid())
+        self.assertEqual (_nwarmups, 0)     # not in this process
+        pool = ForkingPool (warmup=bad_warmup)
+        try:
+            self.assertRaises (RuntimeError, pool.apply, square, (2,))
+        finally:
+            pool.close()
+
+    def test2_maxtasks (self):
+        """workers are recycled after maxtasks calls"""
+        pool = ForkingPool (processes=1, warmup=warmup, maxtasks=2)
+        try:
+            pids = [pool.apply (getpid)[0] for i in range (5)]
+        finally:
+            pool.close()
+        self.assertEqual (pids[0], pids[1])
+        self.assertEqual (pids[2], pids[3])
+        self.assertEqual (len (set (pids)), 3)
+
+    def test3_crash (self):
+        """a worker crashing in map raises, and is replaced"""
+        self.assertRaises (RuntimeError, self.pool.map, crash_on, range (6))
+        self.assertRaises (RuntimeError, self.pool.apply, crash_on, (3,))
+        self.assertEqual (self.pool.map (square, range (6)),
+                          [0, 1, 4, 9, 16, 25])
+        self.assertEqual (self.pool._nworkers, 2)
+
+    def test4_exceptions (self):
+        """exceptions of the child processes are re-raised"""
+        self.pool.apply (getpid)
+        pids = set ([w.pid for w in self.pool._idle])
+        self.assertRaises (ValueError, self.pool.apply, fail, (1,))
+        self.assertRaises (ValueError, self.pool.map, fail, range (4))
+        # the workers survive the exceptions of their tasks
+        self.assert_ (pids <= set ([w.pid for w in self.pool._idle]))
+        self.assertRaises (ValueError, forked_fail, 1)
+        self.assertRaises (ValueError, mp_fail, 1)
+        self.assertEqual (mp_square (3), 9)
+
+    def test5_stream (self):
+        """iterators are streamed back, and can be discarded"""
+        pool = ForkingPool (processes=1)
+        try:
+            n = 10000
+            self.assertEqual (list (pool.apply (count, (n,))), range (n))
+            pid = pool.apply (getpid)[0]
+            items = pool.apply (count, (10**9,))
+            del items                       # never started: worker killed
+            self.assertNotEqual (pool.apply (getpid)[0], pid)
+            items = pool.apply (count, (10**9,))
+            self.assertEqual (items.next(), 0)
+            items.close()
+            self.assertEqual (pool.map (count, [2, 3]), [[0, 1], [0, 1, 2]])
+        finally:
+            pool.close()
+        self.assertEqual (list (forked_count (n)), range (n))
+        items = forked_count (10**9)
+        del items
+        self.pool.close()
+        pooled_getpid.pool.close()
+        self.assert_ (no_children())
+
+    def test6_functions (self):
+        """module-level functions do not need a new worker"""
+        pool = ForkingPool (processes=1, warmup=warmup)
+        try:
+            pid = pool.apply (getpid)[0]
+            self.assertEqual (pool.apply (cube, (3,)), 27)
+            self.assertEqual (pool.apply (getpid), (pid, 1))
+            # unknown to the worker: replaced once
+            exec 'def late (x):\n    return -x\n' in globals()
+            self.assertEqual (pool.apply (late, (2,)), -2)
+            pid2 = pool.apply (getpid)[0]
+            self.assertNotEqual (pid2, pid)
+            self.assertEqual (pool.apply (lambda: getpid()[1]), 1)
+            self.assertNotEqual (pool.apply (getpid)[0], pid2)
+        finally:
+            pool.close()
+
+### executors -----------------------------------------------------------------
+class AsyncExecutorTestCase (unittest.TestCase):
+    def setUp (self):
+        lock = threading.Lock()
+        self.running = running = [0, 0]     # current, max
+        @async_executor (max_workers=2)
+        def sleep (dt, value=None):
+            with lock:
+                running[0] += 1
+                running[1] = max (running)
+            try:
+                time.sleep (dt)
+            finally:
+                with lock:
+                    running[0] -= 1
+            return value
+        self.sleep = sleep
+
+    def tearDown (self):
+        self.sleep.shutdown()
+
+    def test1_map (self):
+        """calls are run concurrently, at most max_workers at a time"""
+        values = range (6)
+        self.assertEqual (list (self.sleep.map ([0.05]*6, values)), values)
+        self.assertEqual (self.running[1], 2)
+        fs = self.sleep.as_completed ([0.1, 0.01], ['slow', 'fast'])
+        self.assertEqual ([f.result() for f in fs], ['fast', 'slow'])
+
+    def test2_timeout (self):
+        """timeout of the results of an executor"""
+        f = self.sleep (0.5)
+        self.assertRaises (Futures.TimeoutError, f.result, 0.05)
+        self.assertEqual (f.result (10), None)
+        self.assertRaises (Futures.TimeoutError, list,
+                           self.sleep.map ([0.5]*4, timeout=0.1))
+
+    def test3_cancel (self):
+        """cancellation of the queued calls of an executor"""
+        fs = [self.sleep (0.2, i) for i in range (3)]
+        self.assert_ (fs[2].cancel())
+        self.assertRaises (Futures.CancelledError, fs[2].result, 10)
+        self.assertEqual ([f.result (10) for f in fs[:2]], [0, 1])
+
+    def test4_processes (self):
+        """executors running their calls in forked processes"""
+        sq = async_executor (max_workers=2, async_type='mp') (square)
+        bad = async_executor (async_type='mp') (fail)
+        try:
+            self.assertEqual (list (sq.map (range (5))), [0, 1, 4, 9, 16])
+            self.assertRaises (ValueError, bad (1).result, 10)
+        finally:
+            sq.shutdown()
+            bad.shutdown()
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# @file: envsnapshot_unittest.py
+
+"""unit tests for the environment snapshots of PyCmt.EnvSnapshot"""
+
+import os, shutil, subprocess, tempfile, unittest
+
+import PyCmt.EnvSnapshot as EnvSnapshot
+from PyCmt.EnvSnapshot import _render
+
+### data ----------------------------------------------------------------------
+def source (fname, cmd, cwd, **env):
+    """source the snapshot `fname` from `cwd` then run `cmd` (in sh).
+    return the (status, stdout, stderr)"""
+    environ = dict (os.environ)
+    environ.update (env)
+    p = subprocess.Popen (['sh', '-c', '. %s && %s' % (fname, cmd)], cwd=cwd,
+                          env=environ, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, out, err
+
+### rendering -----------------------------------------------------------------
+class RenderTestCase (unittest.TestCase):
+    def test1_base (self):
+        """extended variables reference their former value"""
+        self.assertEqual (_render ('PATH', '/sw/bin:/usr/bin', '/usr/bin', '/w'),
+                          """'/sw/bin:'"${PATH}\"""")
+        self.assertEqual (_render ('PATH', '/usr/bin:/sw/bin', '/usr/bin', '/w'),
+                          """"${PATH}"':/sw/bin'""")
+        self.assertEqual (_render ('PATH', '/usr/bin', '/usr/bin', '/w'),
+                          "'/usr/bin'")
+        self.assertEqual (_render ('PATH', '/sw/bin', '/usr/bin', '/w'),
+                          "'/sw/bin'")
+        self.assertEqual (_render ('X', '', 'old', '/w'), "''")
+
+    def test2_workdir (self):
+        """the work directory is replaced by its placeholder"""
+        self.assertEqual (_render ('X', '/w/bin:/usr/bin', '', '/w'),
+                          """"${ENVSNAP_WORKDIR}"'/bin:/usr/bin'""")
+        self.assertEqual (_render ('X', '/usr:/w', '', '/w'),
+                          """'/usr:'"${ENVSNAP_WORKDIR}\"""")
+        # only whole path components
+        self.assertEqual (_render ('X', '/wx:/w2/w', '', '/w'),
+                          "'/wx:/w2/w'")
+        self.assertEqual (_render ('X', '/x/w/bin:/w/w', '', '/w'),
+                          """'/x/w/bin:'"${ENVSNAP_WORKDIR}"'/w'""")
+        self.assertEqual (_render ('X', ' -I"/w" ', '', '/w'),
+                          """' -I"'"${ENVSNAP_WORKDIR}"'" '""")
+        self.assertEqual (_render ('PATH', '/w/bin:/usr/bin', '/usr/bin', '/w'),
+                          """"${ENVSNAP_WORKDIR}"'/bin:'"${PATH}\"""")
+        self.assertEqual (_render ('X', '/w', '', os.sep), "'/w'")
+
+    def test3_quoting (self):
+        """values are restored verbatim by the shell"""
+        values = ["it's", 'a "b" $HOME `id` \\n', ' -I"/w/inc" ', 'a\nb']
+        for value in values:
+            rendered = _render ('X', value, '', '/w')
+            p = subprocess.Popen (['sh', '-c', 'printf %%s %s' % rendered],
+                                  stdout=subprocess.PIPE,
+                                  env={'ENVSNAP_WORKDIR': '/new'})
+            out = p.communicate()[0]
+            self.assertEqual (out, value.replace ('/w/', '/new/'))
+
+### snapshot files ------------------------------------------------------------
+class SnapshotTestCase (unittest.TestCase):
+    def setUp (self):
+        self.top = tempfile.mkdtemp()
+        self.release = os.path.join (self.top, 'release')
+        self.work = os.path.join (self.top, 'work')
+        for d in (self.release, self.work):
+            os.makedirs (d)
+        os.utime (self.release, (1000, 1000))
+        self.fname = os.path.join (self.top, 'env.sh')
+        self.snap = {
+            'setup':   'source asetup.sh 17.0.0,here',
+            'workdir': self.work,
+            'changed': {'PYCMT_T_PATH': self.work+'/bin:/base',
+                        'PYCMT_T_VALUE': "it's \"quoted\""},
+            'unset':   ['PYCMT_T_GONE'],
+            'base':    {'PYCMT_T_PATH': '/base'},
+            'asetup_save': '[defaults]\nopt = True',
+            'stamps':  [(self.release, 1000)],
+            }
+
+    def tearDown (self):
+        shutil.rmtree (self.top)
+
+    def test1_header (self):
+        """the header of a snapshot is read back"""
+        EnvSnapshot.write (self.snap, self.fname)
+        hdr = EnvSnapshot.read_header (self.fname)
+        self.assertEqual (hdr['version'], str (EnvSnapshot.SNAPSHOT_VERSION))
+        self.assertEqual (hdr['setup'], self.snap['setup'])
+        self.assertEqual (hdr['workdir'], self.work)
+        self.assertEqual (hdr['stamps'], [(self.release, 1000)])
+        self.assert_ ('created' in hdr)
+        # written atomically: no temporary file left
+        self.assertEqual (sorted (os.listdir (self.top)),
+                          ['env.sh', 'release', 'work'])
+        # not a snapshot
+        self.assertEqual (EnvSnapshot.read_header (self.fname+'.none'), None)
+        with open (self.fname, 'w') as f:
+            f.write ('#!/bin/sh\nexport X=1\n')
+        self.assertEqual (EnvSnapshot.read_header (self.fname), None)
+        self.assert_ (not EnvSnapshot.is_valid (self.fname))
+
+    def test2_is_valid (self):
+        """snapshots are invalidated when the release tree changes"""
+        EnvSnapshot.write (self.snap, self.fname)
+        self.assert_ (EnvSnapshot.is_valid (self.fname))
+        os.utime (self.release, (2000, 2000))
+        self.assert_ (not EnvSnapshot.is_valid (self.fname))
+        os.utime (self.release, (1000, 1000))
+        self.assert_ (EnvSnapshot.is_valid (self.fname))
+        os.rmdir (self.release)
+        self.assert_ (not EnvSnapshot.is_valid (self.fname))
+
+    def test3_source (self):
+        """snapshots restore the environment, relocated"""
+        EnvSnapshot.write (self.snap, self.fname)
+        other = os.path.join (self.top, 'other')
+        os.makedirs (other)
+        sc, out, err = source (
+            self.fname, 'echo "$PYCMT_T_PATH|$PYCMT_T_VALUE|${PYCMT_T_GONE-x}"',
+            cwd=other, PYCMT_T_PATH='/usr/bin', PYCMT_T_GONE='1')
+        self.assertEqual ((sc, err), (0, ''))
+        self.assertEqual (out, """%s/bin:/usr/bin|it's "quoted"|x\n""" % other)
+        with open (os.path.join (other, '.asetup.save')) as f:
+            self.assertEqual (f.read(), '[defaults]\nopt = True\n')
+        # stale: nothing is done
+        os.utime (self.release, (2000, 2000))
+        sc, out, err = source (self.fname + ' || echo stale', 'true',
+                               cwd=self.work)
+        self.assertEqual (out, 'stale\n')
+        self.assert_ ('stale environment snapshot' in err)
+        self.assert_ (not os.path.exists (os.path.join (self.work,
+                                                        '.asetup.save')))
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# @file: manifest_unittest.py
+
+"""unit tests for the release manifest of PyCmt.Manifest"""
+
+import os, shutil, tempfile, unittest
+
+import PyCmt.Cmt as Cmt
+import PyCmt.Cache as Cache
+from PyCmt.Cmt import CmtPkg, PkgGraph
+from PyCmt.Manifest import ReleaseManifest
+
+### data ----------------------------------------------------------------------
+def release (kernel, gaudi='GaudiKernel-v23r0'):
+    """return the (pkgdb, graph) of a tiny release"""
+    pkgs = [CmtPkg ('AthenaKernel', kernel, 'Control', 'AtlasCore'),
+            CmtPkg ('StoreGate', 'StoreGate-02-39-08', 'Control', 'AtlasCore'),
+            CmtPkg ('GaudiKernel', gaudi, '', 'GAUDI')]
+    pkgdb = dict ((p.fullName(), p) for p in pkgs)
+    # StoreGate -> AthenaKernel -> GaudiKernel, StoreGate -> GaudiKernel
+    graph = PkgGraph (pkgs, [(1, 0), (0, 2), (1, 2)])
+    return pkgdb, graph
+
+### manifests -----------------------------------------------------------------
+class ReleaseManifestTestCase (unittest.TestCase):
+    def setUp (self):
+        self.db = ReleaseManifest (':memory:')
+        pkgdb, graph = release ('AthenaKernel-00-42-07')
+        self.db.add_release ('17.0.0', pkgdb, graph=graph)
+        pkgdb, graph = release ('AthenaKernel-00-42-08')
+        self.db.add_release ('17.0.1', pkgdb.values())
+
+    def tearDown (self):
+        self.db.close()
+
+    def test1_add_release (self):
+        """releases are stored, and replaced when added again"""
+        self.assertEqual (self.db.releases(), ['17.0.0', '17.0.1'])
+        pkgdb, graph = release ('AthenaKernel-00-43-00')
+        self.db.add_release ('17.0.1', pkgdb)
+        self.assertEqual (self.db.releases(), ['17.0.0', '17.0.1'])
+        self.assertEqual (self.db.version ('AthenaKernel', '17.0.1'),
+                          'AthenaKernel-00-43-00')
+        self.db.remove_release ('17.0.0')
+        self.assertEqual (self.db.releases(), ['17.0.1'])
+        self.assertEqual (self.db.uses ('StoreGate', '17.0.0'), [])
+
+    def test2_version (self):
+        """versions of a package, by leaf or full name"""
+        self.assertEqual (self.db.version ('AthenaKernel', '17.0.0'),
+                          'AthenaKernel-00-42-07')
+        self.assertEqual (self.db.version ('Control/AthenaKernel', '17.0.1'),
+                          'AthenaKernel-00-42-08')
+        self.assertEqual (self.db.version ('/Control/AthenaKernel/', '17.0.1'),
+                          'AthenaKernel-00-42-08')
+        self.assertEqual (self.db.version ('Tools/AthenaKernel', '17.0.0'),
+                          None)
+        self.assertEqual (self.db.version ('AthenaKernel', '16.0.0'), None)
+        pkg = self.db.pkg ('StoreGate', '17.0.0')
+        self.assertEqual ((pkg.path, pkg.project), ('Control', 'AtlasCore'))
+
+    def test3_versions (self):
+        """versions of a package across releases"""
+        self.assertEqual (self.db.versions ('Control/AthenaKernel'),
+                          {'17.0.0': 'AthenaKernel-00-42-07',
+                           '17.0.1': 'AthenaKernel-00-42-08'})
+        self.assertEqual (self.db.versions ('GaudiKernel'),
+                          {'17.0.0': 'GaudiKernel-v23r0',
+                           '17.0.1': 'GaudiKernel-v23r0'})
+        self.assertEqual (self.db.versions ('NoSuchPkg'), {})
+        self.assertEqual (self.db.releases_with ('GaudiKernel-v23r0'),
+                          ['17.0.0', '17.0.1'])
+        self.assertEqual (self.db.releases_with ('AthenaKernel-00-42-08'),
+                          ['17.0.1'])
+        self.assertEqual (self.db.releases_with ('AthenaKernel-00-00-00'), [])
+
+    def test4_uses (self):
+        """'use' edges of a release"""
+        self.assertEqual (self.db.uses ('StoreGate', '17.0.0'),
+                          ['AthenaKernel', 'GaudiKernel'])
+        self.assertEqual (self.db.uses ('Control/StoreGate', '17.0.0'),
+                          ['AthenaKernel', 'GaudiKernel'])
+        self.assertEqual (self.db.clients ('GaudiKernel', '17.0.0'),
+                          ['AthenaKernel', 'StoreGate'])
+        self.assertEqual (self.db.clients ('StoreGate', '17.0.0'), [])
+        # stored without a graph
+        self.assertEqual (self.db.uses ('StoreGate', '17.0.1'), [])
+
+### release snapshots ---------------------------------------------------------
+class ReleaseTagsTestCase (unittest.TestCase):
+    def setUp (self):
+        self.cachedir = tempfile.mkdtemp()
+        self.environ = os.environ.get ('PYCMT_CACHEDIR')
+        os.environ['PYCMT_CACHEDIR'] = self.cachedir
+        self.CmtMgr = Cmt.CmtMgr
+
+    def tearDown (self):
+        Cmt.CmtMgr = self.CmtMgr
+        if self.environ is None:
+            del os.environ['PYCMT_CACHEDIR']
+        else:
+            os.environ['PYCMT_CACHEDIR'] = self.environ
+        shutil.rmtree (self.cachedir)
+
+    def test1_snapshots (self):
+        """releases with snapshots are added without running asetup"""
+        def no_asetup (*args, **kw):
+            raise AssertionError ('asetup should not run')
+        Cmt.CmtMgr = no_asetup
+        pkgdb, graph = release ('AthenaKernel-00-42-07')
+        key = Cmt._snapshot_key ('17.0.0,here')
+        Cache.dump ('release_snapshot', key, pkgdb)
+        Cache.dump ('release_graph', key, graph)
+        db = ReleaseManifest (':memory:')
+        try:
+            db.add_release_tags ('17.0.0,here', with_uses=True)
+            self.assertEqual (db.version ('AthenaKernel', '17.0.0,here'),
+                              'AthenaKernel-00-42-07')
+            self.assertEqual (db.uses ('AthenaKernel', '17.0.0,here'),
+                              ['GaudiKernel'])
+        finally:
+            db.close()
+        self.assertRaises (AssertionError, Cmt.release_graph, '17.0.1,here')
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
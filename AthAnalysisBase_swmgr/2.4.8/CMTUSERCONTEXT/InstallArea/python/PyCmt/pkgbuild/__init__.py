@@ -18,6 +18,7 @@ import imp
 import inspect
 
 from PyCmt.Logging import logging
+from PyCmt.Timing import timed
 
 ### globals -------------------------------------------------------------------
 msg = logging.getLogger('PkgBuilder')
@@ -447,9 +448,13 @@ class PkgBuilder(object):
     
     def cmt(self, *args, **kwds):
         cmtdir = osp.join(self.env['pkg_root'],'cmt')
+        if not args and kwds.keys() == ['macro_value']:
+            # all macros are fetched at once (and cached) per cmt dir
+            return self._cmt.show_macro(kwds['macro_value'], cmtdir)
         with _dir_restore(cmtdir):
             return self._cmt.show(*args, **kwds)
         
+    @timed
     def pkg_build(self):
         """the main kitchen-sink method
         """
@@ -485,6 +490,7 @@ class PkgBuilder(object):
                   self.env['CMTCONFIG'])
         return 0
 
+    @timed
     def pre_build(self):
         cmtconfig = self.env['CMTCONFIG']
         assert cmtconfig != ''
@@ -518,6 +524,7 @@ class PkgBuilder(object):
             self._prepare_relocate()
         return
 
+    @timed
     def build(self):
         self.fetch_src()
         self.configure_impl()
@@ -525,6 +532,7 @@ class PkgBuilder(object):
         self.install_impl()
         return 0
     
+    @timed
     def post_build(self):
         if _DO_RELOCATE:
             self._relocate()
@@ -538,6 +546,7 @@ class PkgBuilder(object):
         sh.remove(self._build_log.name)
         return
 
+    @timed
     def fetch_src(self):
         msg = self.msg
         pkg_src = self.env['pkg_src']
@@ -3,10 +3,14 @@
 """Shell execution environments for programs to play in"""
 
 __all__ = [
+    'AsyncLocalShell',
     'LocalShell',
+    'ShellPool',
     'utils'
     ]
 
 from .localshell import LocalShell
+from .asyncshell import AsyncLocalShell
+from .shellpool import ShellPool
 from . import utils
 
@@ -0,0 +1,512 @@
+# @file: pyshell/asyncshell.py
+
+"""Talk programmatically to many local shells, from a single reactor thread"""
+
+from __future__ import with_statement
+
+import atexit, collections, errno, os, pty, select, signal, threading, time
+import logging
+
+import basicshell
+import localshell
+from PyCmt.Futures import Future, CancelledError, TimeoutError
+
+### data ----------------------------------------------------------------------
+__all__ = [
+    'AsyncLocalShell',
+    'Reactor',
+    ]
+
+INTPOLL  = 0.05  # delay between attempts to interrupt a command (seconds)
+INTTRIES = 20    # attempts before interrupting the shell itself
+
+msg = logging.getLogger ('AsyncLocalShell')
+if len(msg.handlers) == 0:
+    logging.basicConfig()
+
+### reactor -------------------------------------------------------------------
+class Reactor (object):
+    """a single thread reading (select-ing) the pseudo-terminals of many
+    shells and dispatching their output, and enforcing the deadlines of their
+    commands"""
+
+    def __init__ (self):
+        self._lock   = threading.Lock()
+        self._shells = {}                 # master fd -> shell
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = None
+        self._stop   = False
+
+    def register (self, shell):
+        with self._lock:
+            self._shells[shell.master_fd] = shell
+            if self._thread is None:
+                self._thread = threading.Thread (target=self._loop,
+                                                 name='pyshell-reactor')
+                self._thread.daemon = True
+                self._thread.start()
+        self.wakeup()
+
+    def unregister (self, shell):
+        with self._lock:
+            self._shells.pop (shell.master_fd, None)
+
+    def shells (self):
+        with self._lock:
+            return self._shells.values()
+
+    def wakeup (self):
+        """make the reactor re-read its list of shells and deadlines"""
+        os.write (self._wake_w, 'x')
+
+    def stop (self, timeout=None):
+        """stop the reactor thread (the shells are left alone)"""
+        self._stop = True
+        self.wakeup()
+        if self._thread is not None:
+            self._thread.join (timeout)
+
+    def _loop (self):
+        while not self._stop:
+            shells = self.shells()
+            deadlines = [d for d in [sh._deadline() for sh in shells]
+                         if d is not None]
+            timeout = None
+            if deadlines:
+                timeout = max (0., min (deadlines) - time.time())
+            fds = [sh.master_fd for sh in shells] + [self._wake_r]
+            try:
+                rfds = select.select (fds, [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self._wake_r in rfds:
+                os.read (self._wake_r, 4096)
+            now = time.time()
+            for sh in shells:
+                try:
+                    if sh.master_fd in rfds:
+                        data = basicshell._read (sh.master_fd)
+                        if data:
+                            sh._feed (data)
+                        else:
+                            self.unregister (sh)
+                            sh._exited()
+                            continue
+                    sh._check_deadline (now)
+                except Exception:
+                    msg.exception ('error while dispatching the output of '
+                                   'shell (pid=%d)', sh.child_pid)
+
+    pass # Reactor
+
+_reactor = None
+_reactor_lock = threading.Lock()
+def get_reactor ():
+    """return the (process-wide) default reactor"""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+        return _reactor
+
+@atexit.register
+def _close_live_shells ():
+    if _reactor is None:
+        return
+    futures = [sh.close() for sh in _reactor.shells()]
+    for f in futures:
+        try:
+            f.result (basicshell.USRTIMEOUT)
+        except Exception:
+            pass
+    _reactor.stop (basicshell.USRTIMEOUT)
+
+### async local shell class ---------------------------------------------------
+class _Command (object):
+    """a command queued for (or running in) a shell"""
+    __slots__ = ('line', 'post', 'timeout', 'raw',
+                 'future', 'frame', 'deadline', 'error', 'sync', 'tries')
+    def __init__ (self, line, post, timeout=None, raw=False):
+        self.line     = line     # command, or callable returning it (or None)
+        self.post     = post     # callable(frame) returning the result
+        self.timeout  = timeout
+        self.raw      = raw      # not framed, e.g. 'exit'
+        self.future   = Future()
+        self.frame    = None
+        self.deadline = None
+        self.error    = None     # set when the command is interrupted
+        self.sync     = None     # marker echoed once the interrupt is over
+        self.tries    = 0        # attempts to interrupt the command
+
+class AsyncLocalShell (object):
+    """A local shell (behind a pseudo-terminal) whose commands return
+    futures. All the shells share a single `Reactor` thread.
+
+    Commands are queued and run one after the other, with the same command
+    protocol (exit code sentinels) and environment snapshot semantics as
+    `LocalShell`. Running commands may be given a `timeout` or be cancelled
+    (see `cancel`): they are then interrupted (^C) and their future raises
+    `TimeoutError` or `CancelledError`.
+
+    usage:
+     sh = AsyncLocalShell()
+     f = sh.run ('cmt show path', timeout=10)
+     sc, out = f.result()
+    """
+
+    def __init__ (self, reactor=None):
+        # start a working shell and connect through a pseudo-terminal
+        pid, fd = pty.fork()
+        if pid == 0:                                                # child
+            os.execv ('/bin/sh', ['sh'])
+        self.master_fd = fd
+        self.child_pid = pid
+        self.alive = True
+        self.interactive = 0
+
+        self._shellc, data = basicshell._handshake (fd)
+        if self._shellc == 'c':
+            self._rc_var = '$status'
+        else:
+            self._rc_var = '$?'
+        self._rc_tag, self._rc_rex = basicshell._rc_tag()
+
+        # commands are sent as soon as they are queued: wait for the first
+        # prompt, lest the terminal echoes them before it
+        if basicshell.PROMPT not in data:
+            try:
+                basicshell.wait_for_pattern (fd, basicshell.USRTIMEOUT,
+                                             [basicshell.PROMPT], data)
+            except OSError, e:
+                msg.debug ('for first prompt: %s', e)
+        data = basicshell.PROMPT
+
+        self._lock    = threading.RLock()
+        self._queue   = collections.deque()
+        self._current = None
+        self._nsync   = 0
+
+        # client-side snapshot of the environment (see `LocalShell._environ`)
+        self._env = None
+        self._env_fname = None
+
+        self._dispatcher = basicshell._LineDispatcher (
+            self._output, self._command, self._prompt, r'\S+> ', data)
+        if reactor is None:
+            reactor = get_reactor()
+        self.reactor = reactor
+        reactor.register (self)
+
+    @property
+    def shellc (self):
+        """return 'c' for csh or '' for bash (or equiv.)"""
+        return self._shellc
+
+    ## queue management (any thread) ------------------------------------------
+    def _submit (self, cmd):
+        with self._lock:
+            if not self.alive:
+                cmd.future.set_exception (
+                    OSError ('shell (pid=%d) is not running' % self.child_pid))
+                return cmd.future
+            self._queue.append (cmd)
+        self._pump()
+        return cmd.future
+
+    def _pump (self):
+        """send the next queued command(s) to the shell if it is idle"""
+        done = []
+        wakeup = False
+        with self._lock:
+            while self._current is None and self._queue:
+                cmd = self._queue.popleft()
+                if not cmd.future.set_running_or_notify_cancel():
+                    continue                              # cancelled
+                line = cmd.line
+                try:
+                    if callable (line):
+                        line = line()
+                    if line is None:
+                        # nothing to run (e.g. served from the env snapshot)
+                        done.append (cmd)
+                        continue
+                    if self._env is not None and \
+                           localshell._env_cmds.search (line):
+                        self._env = None
+                    cmd.frame = basicshell._Frame()
+                    if not cmd.raw:
+                        line = basicshell._frame_cmd (line, 0, self._rc_tag,
+                                                      self._rc_var)
+                        cmd.frame.sent (line)
+                    if cmd.timeout is not None:
+                        cmd.deadline = time.time() + cmd.timeout
+                        wakeup = True
+                    self._current = cmd
+                    os.write (self.master_fd, line+os.linesep)
+                except Exception, err:
+                    self._current = None
+                    cmd.error = err
+                    done.append (cmd)
+        for cmd in done:
+            self._resolve (cmd)
+        if wakeup:
+            self.reactor.wakeup()
+
+    def _resolve (self, cmd):
+        if cmd.error is not None:
+            cmd.future.set_exception (cmd.error)
+            return
+        try:
+            result = cmd.post (cmd.frame)
+        except Exception, err:
+            cmd.future.set_exception (err)
+        else:
+            cmd.future.set_result (result)
+
+    def _interrupt (self, cmd):
+        # interrupt the foreground job of the shell. A ^C on the terminal
+        # would also flush the command line if the shell did not read it yet,
+        # so it is only used if the shell itself stays busy (e.g. in a loop)
+        try:
+            pgrp = os.tcgetpgrp (self.master_fd)
+            cmd.tries += 1
+            if pgrp != self.child_pid:
+                os.killpg (pgrp, signal.SIGINT)
+            elif cmd.tries <= INTTRIES:
+                cmd.deadline = time.time() + INTPOLL         # try again later
+                return
+            else:
+                os.write (self.master_fd, '\x03')
+        except OSError:
+            pass
+
+        # the number of prompts which follow is unknown: wait for a marker
+        # echoed afterwards
+        self._nsync += 1
+        cmd.sync = '%sSYNC_%d' % (self._rc_tag, self._nsync)
+        try:
+            os.write (self.master_fd, 'echo %s%s' % (cmd.sync, os.linesep))
+        except OSError:
+            pass
+
+    ## reactor callbacks (reactor thread) --------------------------------------
+    def _feed (self, data):
+        self._dispatcher.feed (data)
+
+    def _output (self, data):
+        cmd = self._current
+        if cmd is None:
+            return
+        if cmd.sync is not None:
+            self._command (data)
+            return
+        frame = cmd.frame
+        if frame is None or frame.echoed (data):
+            return
+        res = basicshell._split_rc (data, self._rc_tag, self._rc_rex)
+        if res is not None:
+            frame.add (*res)
+
+    def _command (self, line):
+        cmd = self._current
+        if cmd is None:
+            return
+        if cmd.sync is None:
+            frame = cmd.frame
+            if frame is not None and not frame.echoed (line) and \
+                   not frame.echo:
+                # output of a multi-line command (see `_Frame.echoed`)
+                self._output (basicshell._unprompt (line)+os.linesep)
+        elif line.strip() == cmd.sync:
+            cmd.sync = ''                                # marker seen
+
+    def _prompt (self, prompt):
+        self.interactive = int (prompt != basicshell.PROMPT)
+        with self._lock:
+            cmd = self._current
+            if cmd is not None and cmd.sync:
+                return                  # interrupted, marker not seen yet
+            if cmd is not None and cmd.sync is None and not cmd.raw and \
+                   prompt == basicshell.PROMPT and not cmd.frame.done():
+                return                  # more lines to come, see `_frame_cmd`
+            self._current = None
+        if cmd is not None:
+            self._resolve (cmd)
+        self._pump()
+
+    def _deadline (self):
+        cmd = self._current
+        if cmd is not None and cmd.sync is None:
+            return cmd.deadline
+        return None
+
+    def _check_deadline (self, now):
+        with self._lock:
+            cmd = self._current
+            if (cmd is None or cmd.deadline is None or cmd.sync is not None
+                or now < cmd.deadline):
+                return
+            if cmd.error is None:
+                cmd.error = TimeoutError ('command timed out after %ss' %
+                                          cmd.timeout)
+            self._interrupt (cmd)
+
+    def _exited (self):
+        with self._lock:
+            self.alive = False
+            cmds = list (self._queue)
+            self._queue.clear()
+            if self._current is not None:
+                cmds.insert (0, self._current)
+                self._current = None
+        for cmd in cmds:
+            if cmd.raw and cmd.line == 'exit':
+                cmd.future.set_result (0)
+            else:
+                cmd.future.set_exception (
+                    OSError ('shell (pid=%d) exited' % self.child_pid))
+        try:
+            os.waitpid (self.child_pid, os.WNOHANG)
+        except OSError:
+            pass
+        try:
+            os.close (self.master_fd)
+        except OSError:
+            pass
+        if self._env_fname is not None:
+            try:
+                os.remove (self._env_fname)
+            except OSError:
+                pass
+
+    ## public interface --------------------------------------------------------
+    def run (self, cmd, timeout=None):
+        """execute `cmd` and return a future of its (status, output)"""
+        def post (frame):
+            status, out = frame.status (1)[0]
+            return status, out.strip()
+        return self._submit (_Command (cmd, post, timeout))
+
+    def source (self, script, args='', timeout=None):
+        """source environment settings from `script`.
+        return a future of (see `utils.source`)
+         0: all ok
+         1: `script` can not be located
+         2: sourcing of `script` failed
+        """
+        script = os.path.expanduser (os.path.expandvars (script))
+        if not os.path.exists (script):
+            if self._shellc == 'c':
+                script = script + '.csh'
+            else:
+                script = script + '.sh'
+            if not os.path.exists (script):
+                msg.debug ('script [%s] does not exist', script)
+                f = Future()
+                f.set_running_or_notify_cancel()
+                f.set_result (1)
+                return f
+        def post (frame):
+            if frame.status (1)[0][0]:
+                return 2
+            return 0
+        return self._submit (_Command ('source %s %s' % (script, args), post,
+                                       timeout))
+
+    def environ (self):
+        """return a future of (a copy of) the environment of the shell"""
+        def line ():
+            if self._env is not None:
+                return None
+            if self._env_fname is None:
+                import tempfile
+                fd, self._env_fname = tempfile.mkstemp (prefix='pyshell-env-')
+                os.close (fd)
+            return "env -0 > '%s'" % self._env_fname
+        def post (frame):
+            if frame is not None:
+                if frame.status (1)[0][0] != 0:
+                    raise OSError ('could not capture the environment')
+                f = open (self._env_fname, 'rb')
+                try:
+                    self._env = localshell._parse_env (f.read().split ('\0'))
+                finally:
+                    f.close()
+            return self._env.copy()
+        return self._submit (_Command (line, post))
+
+    def getenv (self, name):
+        """return a future of the value of the environment variable `name`
+        ('' if it is not set. contrary to `LocalShell.getenv`, the variables
+        of the shell which have not been exported are not seen)"""
+        f = Future()
+        def done (env):
+            if env.exception() is not None:
+                f.set_exception (env.exception())
+            else:
+                f.set_result (env.result().get (name, ''))
+        f.set_running_or_notify_cancel()
+        self.environ().add_done_callback (done)
+        return f
+
+    def putenv (self, name, value):
+        """set an environment variable. return a future of the status"""
+        if self._shellc == 'c':
+            cmd = 'setenv %s %s' % (name, value)
+        else:
+            cmd = 'export %s=%s' % (name, value)
+        def post (frame):
+            return frame.status (1)[0][0]
+        return self._submit (_Command (cmd, post))
+
+    def unsetenv (self, name):
+        """remove an environment variable. return a future of the status"""
+        if self._shellc == 'c':
+            cmd = 'unsetenv '+name
+        else:
+            cmd = 'unset '+name
+        def post (frame):
+            return frame.status (1)[0][0]
+        return self._submit (_Command (cmd, post))
+
+    def getcwd (self):
+        """return a future of the current directory"""
+        def post (frame):
+            status, out = frame.status (1)[0]
+            if status != 0:
+                raise OSError ('could not determine current directory')
+            return out.strip()
+        return self._submit (_Command ('pwd', post))
+
+    def chdir (self, dir):
+        """change the current working directory. return a future of None"""
+        def post (frame):
+            if frame.status (1)[0][0] != 0:
+                raise OSError ('can\'t enter [%s]' % dir)
+        return self._submit (_Command ('cd '+dir, post))
+
+    def cancel (self, future):
+        """cancel the command of `future`: a queued command is dropped, a
+        running one is interrupted (its future then raises `CancelledError`)
+        return False if the command is already done
+        """
+        if future.cancel():
+            return True
+        with self._lock:
+            cmd = self._current
+            if cmd is None or cmd.future is not future or \
+                   cmd.error is not None:
+                return False
+            cmd.error = CancelledError()
+            self._interrupt (cmd)
+        self.reactor.wakeup()
+        return True
+
+    def close (self):
+        """logout once the queued commands are done.
+        return a future resolved when the shell has exited"""
+        return self._submit (_Command ('exit', None, raw=True))
+
+    pass # AsyncLocalShell
@@ -2,12 +2,14 @@
 
 """Talk programmatically to a shell, via a pseudo-terminal"""
 
-import os, re, sys, thread, time
+import atexit, errno, os, random, re, signal, sys, thread, time, weakref
+import Queue
 import pty, select
 import logging
 
 import vt100
 import utils as shell_utils
+from PyCmt.Timing import timed
 
 ### data ----------------------------------------------------------------------
 __all__ = [
@@ -21,11 +23,25 @@ if len(msg.handlers)==0:
 
 PROMPT     = '_PY_SHELL_'
 SHELLLIST  = ['csh', 'sh']
-SLEEPTIME  = 0.01
-PCTIMEOUT  = 0.05
 USRTIMEOUT = 10.
+RC_TAG     = '_PY_RC_'
+MAXLINE    = 3000  # max size of a batch of commands (tty input buffer is 4k)
+READSIZE   = 65536 # max size of a single read from the pseudo-terminal
+MAXPROMPT  = 1024  # partial lines longer than this are not checked for prompts
+STREAMQUEUE = 256  # max number of output lines buffered by `stream`
 
 ### read loops ----------------------------------------------------------------
+def _read (fd, n=READSIZE):
+    """read (at most `n` bytes) from `fd`.
+    return '' once the other end of the pseudo-terminal has been closed.
+    """
+    try:
+        return os.read (fd, n)
+    except OSError, e:
+        if e.errno == errno.EIO:                  # slave side is gone
+            return ''
+        raise
+
 def wait_for_pattern (fd, timeout, patterns=None, initial_data=''):
     """read data from file descriptor `fd` as it becomes available.
     process it and search for matches among `patterns`.
@@ -38,8 +54,10 @@ def wait_for_pattern (fd, timeout, patterns=None, initial_data=''):
     if patterns is None:
         patterns = []
 
-    lapsed_time = 0.
+    deadline = time.time() + timeout
     data = initial_data
+    scanned = 0                   # patterns are only searched for in new data
+    overlap = max([len(p) for p in patterns] or [1]) - 1
 
     while 1:
         # look for any data if no patterns are provided
@@ -47,23 +65,79 @@ def wait_for_pattern (fd, timeout, patterns=None, initial_data=''):
             return data, None
         elif data:
             # scan for requested patterns in the data
+            start = max (0, scanned-overlap)
             for pattern in patterns:
-                pos = data.find(pattern)
+                pos = data.find(pattern, start)
                 if 0<=pos:
                     return data[pos+len(pattern)+1:], pattern # found a pattern
+            scanned = len(data)
 
-        # look for non-blocking reads
-        rfds, wfds, xfds = select.select ([fd, 0], [], [], PCTIMEOUT)
+        # block until data arrives or the time is up
+        remaining = deadline - time.time()
+        if remaining <= 0.:
+            raise OSError, 'timed out while waiting for data (fd=%d)'%fd
+        rfds, wfds, xfds = select.select ([fd], [], [], remaining)
         if fd in rfds:
-            data = data + os.read (fd, 1024)                  # safe read
+            new_data = _read (fd)
+            if not new_data:
+                raise OSError, 'shell exited while waiting for data (fd=%d)'%fd
+            data = data + new_data
+
+class _LineDispatcher (object):
+    """split the output of a shell into lines, as it comes, and dispatch them
+    to `output(line)` or `command(line)` (the echo of a command line, without
+    its prompt). `prompt(prompt)` is called when a magic prompt (or the
+    alternative `alt_prompt`) shows up after a command: the shell is then
+    ready for the next one. Some `initial_data` on which to start feeding the
+    output may be given.
+    """
+    def __init__ (self, output, command, prompt,
+                  alt_prompt='', initial_data=''):
+        self.output, self.command, self.prompt = output, command, prompt
+        rex = PROMPT
+        if alt_prompt:
+            rex += '|'+alt_prompt
+        self.promptrex = re.compile (rex)
+
+        # the (not yet terminated) current line is kept as a list of chunks
+        self.partial, self.plen = [], 0
+        if initial_data:
+            self.partial, self.plen = [initial_data], len(initial_data)
+        self.cmd_absorbed = 0
+
+    def feed (self, new_data):
+        promptrex = self.promptrex
+        lines = new_data.split ('\n')
+        if 1 < len(lines):
+            self.partial.append (lines[0])
+            lines[0] = ''.join (self.partial)
+            self.partial = [lines.pop()]
+            self.plen = len(self.partial[0])
+            output, match, filter = self.output, promptrex.match, vt100.filter
+            for line in lines:
+                # pre-process the line
+                line = filter (line)
+
+                # special care for command lines
+                res = match (line)
+                if not res:
+                    output (line+os.linesep)
+                else:
+                    self.command (line[len(res.group()):])
+                    self.cmd_absorbed = 1
         else:
-            # check for timeout
-            lapsed_time = lapsed_time + PCTIMEOUT + SLEEPTIME
-            if timeout <= lapsed_time:
-                raise OSError, 'timed out while waiting for data (fd=%d)'%fd
-
-            # wait a bit
-            time.sleep (SLEEPTIME)
+            self.partial.append (new_data)
+            self.plen += len(new_data)
+
+        # outside line loop, scan for prompt (as start for new input)
+        if self.cmd_absorbed and self.plen < MAXPROMPT:
+            line = vt100.filter (''.join (self.partial))
+            res = line and promptrex.match (line)
+            if res:
+                prp = res.group()
+                # put the prompt back for command absorbtion
+                self.partial, self.plen, self.cmd_absorbed = [prp], len(prp), 0
+                self.prompt (prp)
 
 def _read_dispatch_loop (fd, shell, alt_prompt='', initial_data=''):
     """read data from file descriptor `fd` as it becomes available.
@@ -71,53 +145,29 @@ def _read_dispatch_loop (fd, shell, alt_prompt='', initial_data=''):
     when a magic prompt (or alternative `alt_prompt` is encountered, `shell` is
     unlocked. Some `initial_data` on which to start feeding the output may be
     given.
+    the loop blocks until data is available and returns when the shell exits.
     """
 
-    prompt = PROMPT
-    if alt_prompt:
-        prompt += '|'+alt_prompt
-    promptrex = re.compile (prompt)
+    def prompt (prp):
+        # the lines of a framed command are each followed by a prompt: the
+        # command is only done at the one after its (last) sentinel
+        frame = shell._frame
+        if frame is not None and not frame.done() and prp == PROMPT:
+            return
+        # allow for prompt printing
+        shell.prompt (prp)
+        shell._end_frame()
+        shell.lock.release()
 
     try:
-        data, cmd_absorbed = initial_data, 0
-
+        dispatcher = _LineDispatcher (shell.output, shell._command, prompt,
+                                      alt_prompt, initial_data)
         while 1:
-            rfds, wfds, xfds = select.select ([fd, 0], [], [], PCTIMEOUT)
-
-            if fd in rfds:
-                data = data + os.read (fd, 1024)
-
-                eolpos = data.find('\n')
-                while 0 <= eolpos:
-                    # pre-process the line
-                    line = vt100.filter (data[:eolpos])
-
-                    # special care for command lines
-                    res = promptrex.match (line)
-                    if not res:
-                        shell.output (line+os.linesep)
-                    else:
-                        shell.command (line[len(res.group()):])
-                        cmd_absorbed = 1
-                        
-                    # data leftover and new end of line position
-                    data = data[eolpos+1:]
-                    eolpos = data.find ('\n')
-
-                # outside line loop, scan for prompt (as start for new input)
-                line = vt100.filter (data)
-                if line and cmd_absorbed:
-                    res = promptrex.match (line)
-                    if res:
-                        prp = res.group()
-                        # allow for prompt printing
-                        shell.prompt (prp)
-                        shell.lock.release()
-
-                        # put the prompt back for command absorbtion
-                        data, cmd_absorbed = prp, 0
-            else:
-                time.sleep (SLEEPTIME)
+            select.select ([fd], [], [])
+            new_data = _read (fd)
+            if not new_data:
+                break                                     # shell exited
+            dispatcher.feed (new_data)
 
     except: #ok on exit, for debugging otherwise
         try:
@@ -126,6 +176,199 @@ def _read_dispatch_loop (fd, shell, alt_prompt='', initial_data=''):
         except ImportError:
             pass
 
+    # wake up anybody waiting on a command which will never complete
+    shell.alive = False
+    shell._end_frame()
+    if shell.lock.locked():
+        shell.lock.release()
+
+def _handshake (fd):
+    """guess the family of the shell on the other end of `fd` and set its
+    magic prompt.
+    return ('c' for csh or '' for bash (or equiv.), <residual data>)
+    """
+    # guess shell type
+    msg.debug ('guessing shell family...')
+    os.write (fd, 'echo $0\n')
+    try:
+        shellc = wait_for_pattern (fd, USRTIMEOUT, SHELLLIST)
+    except OSError, e:
+        msg.debug ('for shell testing: %s', e)
+        shellc = ('', 'bash')        # gambling...
+    msg.debug ('choosing [%s] shell family', shellc[1])
+
+    # set prompt
+    msg.debug ('setting magic prompt...')
+    if shellc[1] == 'csh':
+        shellc = 'c'
+        os.write (fd, 'set prompt=%s\nexport TERM=vt100; echo $TERM\n'%PROMPT)
+    else:
+        shellc = ''
+        os.write (fd, 'export PS1=%s PS2=\nexport TERM=vt100; echo $TERM\n'
+                  % PROMPT)
+
+    # empty buffer, there may or may not be a command echo
+    try:
+        data = '', None
+        while data[1] != 'vt100':
+            data = wait_for_pattern (fd, USRTIMEOUT,
+                                     patterns=['=vt100', 'vt100'],
+                                     initial_data=data[0])
+    except OSError, e:
+        msg.debug ('for command echo: %s', e)
+
+    # remove leading new-lines
+    return shellc, data[0].lstrip()
+
+### live shells, terminated at exit (before the interpreter tears down the
+### modules their dispatch loops rely on)
+_live_shells = weakref.WeakValueDictionary()
+
+@atexit.register
+def _close_live_shells ():
+    # busy shells are killed: exiting must not wait for their command
+    for sh in _live_shells.values():
+        sh.close (block=False)
+
+### command framing -----------------------------------------------------------
+class _Frame (object):
+    """book-keeping of the output and exit codes of a line of commands"""
+    __slots__ = ('results', 'seg', 'keep', 'sink', 'ncmds', 'echo')
+    def __init__ (self, keep=True, sink=None, ncmds=1):
+        self.results = {}    # cmd index -> (status, output)
+        self.seg     = []    # output of the current command
+        self.keep    = keep  # whether to collect the output of each command
+        self.sink    = sink  # if set, called with each output line instead
+        self.ncmds   = ncmds # number of commands (sentinels) of the line
+        self.echo    = []    # lines sent, whose terminal echo is expected
+
+    def sent (self, text):
+        """record the lines of `text`, sent to the shell"""
+        self.echo = [line.rstrip() for line in text.split ('\n')][::-1]
+
+    def echoed (self, line):
+        """whether `line` is the echo of the next line sent.
+        a shell without line editing has them all echoed by the terminal
+        as soon as they are sent (the first one after the prompt, the others
+        as plain output lines): the output of the other lines then shows up
+        after a prompt."""
+        if self.echo and self.echo[-1] == line.rstrip():
+            self.echo.pop()
+            return True
+        return False
+
+    def done (self):
+        """whether the sentinels of all the commands showed up"""
+        return len (self.results) >= self.ncmds
+
+    def add (self, data, rc=None):
+        """record the output `data` of the current command and its (index,
+        exit code) `rc` if its sentinel showed up.
+        return False if `data` has been consumed (streamed)
+        """
+        if self.sink is not None:
+            if data:
+                self.sink (data)
+            if rc is not None:
+                self.results[int(rc[0])] = (int(rc[1]), '')
+            return False
+        if self.keep:
+            self.seg.append (data)
+        if rc is not None:
+            self.results[int(rc[0])] = (int(rc[1]), ''.join(self.seg))
+            self.seg = []
+        return True
+
+    def status (self, ncmds):
+        """return the list of (status, output) of the `ncmds` commands"""
+        # a command line which could not be parsed leaves no sentinel
+        leftover = ''.join (self.seg)
+        results = []
+        for i in xrange (ncmds):
+            res = self.results.get (i)
+            if res is None:
+                msg.debug ('process exit status can not be determined')
+                res, leftover = (-1, leftover), ''
+            results.append (res)
+        return results
+
+def _rc_tag ():
+    """return a (unique) sentinel tag and the regex matching its instances"""
+    tag = '%s%08x_' % (RC_TAG, random.getrandbits(32))
+    return tag, re.compile (re.escape(tag)+r'(\d+)_(\d+)')
+
+def _frame_cmd (cmd, idx, tag, rc_var):
+    """follow `cmd` with the sentinel `tag` reporting its index `idx` and its
+    exit code (the value of `rc_var`).
+    the sentinel is echoed from a line of its own, so that trailing comments,
+    here-documents or multi-line commands are left untouched"""
+    cmd = cmd.strip()
+    if not cmd:
+        cmd = ':'
+    return '%s\necho %s%d_%s' % (cmd, tag, idx, rc_var)
+
+def _unprompt (line):
+    """strip the prompts of the lines without output from a command line"""
+    while line.startswith (PROMPT):
+        line = line[len(PROMPT):]
+    return line
+
+def _split_rc (data, tag, rex):
+    """split the sentinel `tag` (matched by `rex`) off the output `data`.
+    return (data, (index, exit code) or None), or None if `data` is the echo
+    of the line of the sentinel itself"""
+    if tag not in data:
+        return data, None
+    res = rex.search (data)
+    if res is None:
+        return None
+    return data[:res.start()], res.groups()
+
+class _OutputStream (object):
+    """iterator over the output lines of a command, as they are produced.
+    the exit code of the command is available as `status` once exhausted.
+    at most STREAMQUEUE lines are buffered: the shell is not read any further
+    (and the command blocks) while the consumer lags behind.
+    """
+    def __init__ (self, shell, cmd):
+        self.shell  = shell
+        self.status = None
+        self._queue = queue = Queue.Queue (STREAMQUEUE)
+        self._closed = closed = []
+        def sink (data):
+            # (no reference to the stream, so it can be garbage collected
+            # while the command runs)
+            if not closed:
+                queue.put (data)
+        self._frame = _Frame (keep=False, sink=sink)
+        shell._exec (shell._frame_cmd (cmd, 0), self._frame)
+
+    def __iter__ (self):
+        return self
+
+    def close (self):
+        """stop consuming the output: the rest of it is discarded"""
+        if self.status is None and not self._closed:
+            self._closed.append (True)
+            while 1:                              # unblock the dispatch loop
+                try:
+                    self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+    def __del__ (self):
+        self.close()
+
+    def next (self):
+        if self.status is not None or self._closed:
+            raise StopIteration
+        line = self._queue.get()
+        if line is None:                          # end of frame
+            self.shell._wait_lock()
+            self.status = self._frame.results.get (0, (-1,))[0]
+            raise StopIteration
+        return line
+
 ### abstract base class for shells --------------------------------------------
 class BasicShell (object):
     """Base class for shells.
@@ -144,61 +387,101 @@ class BasicShell (object):
 
         # no wrapped echo until reading starts
         self.echo = 0
-        self.bug  = ''    # output buffer
+        self.buf  = []    # output buffer (chunks)
 
-        # guess shell type
-        msg.debug ('guessing shell family...')
-        os.write (self.master_fd, 'echo $0\n')
-        try:
-            shellc = wait_for_pattern (self.master_fd, USRTIMEOUT, SHELLLIST)
-        except OSError, e:
-            msg.debug ('for shell testing: %s', e)
-            shellc = ('', 'bash')        # gambling...
-        msg.debug ('choosing [%s] shell family', shellc[1])
-
-        # set prompt
-        msg.debug ('setting magic prompt...')
-        if shellc[1] == 'csh':
-            self._shellc = 'c'
-            os.write (self.master_fd,
-                      'set prompt=%s\nexport TERM=vt100; echo $TERM\n'%PROMPT)
-        else:
-            self._shellc = ''
-            os.write (self.master_fd,
-                      'export PS1=%s\nexport TERM=vt100; echo $TERM\n'%PROMPT)
+        # set to False by the dispatch loop once the shell is gone
+        self.alive = True
 
-        # empty buffer, there may or may not be a command echo
-        try:
-            data = '', None
-            while data[1] != 'vt100':
-                data = wait_for_pattern (self.master_fd, USRTIMEOUT,
-                                         patterns=['=vt100', 'vt100'],
-                                         initial_data=data[0])
-        except OSError, e:
-            msg.debug ('for command echo: %s', e)
-                
-        # remove leading new-lines
-        data = data[0].lstrip()
+        # commands are followed by a sentinel carrying their exit code
+        self._frame = None
+        self._rc_tag, self._rc_rex = _rc_tag()
+
+        # guess shell type and set prompt
+        self._shellc, data = _handshake (self.master_fd)
+        if self._shellc == 'c':
+            self._rc_var = '$status'
+        else:
+            self._rc_var = '$?'
 
         # start reading continuously
         msg.debug ('setup done, firing up dispatch loop...')
         self.echo = 1
         thread.start_new_thread (_read_dispatch_loop,
                                  (self.master_fd, self, alt_prompt, data))
+        _live_shells[self.child_pid] = self
         msg.debug ('basic shell properly initialized')
 
     # logout on destruction
     def __del__ (self):
-        self._exec ('exit')
+        try:
+            self._exec ('exit')
+        except OSError:
+            pass
+
+    def close (self, block=True):
+        """logout and wait for the shell (and its dispatch loop) to finish.
+        If `block` is False and a command is running, the shell is killed
+        (along with the jobs of its terminal) instead of waiting for it.
+        """
+        if not self.lock.acquire (block):
+            self._kill()
+            return
+        try:
+            self._send ('exit')
+        except OSError:
+            return                            # already gone
+        self._wait_lock()      # released by the dispatch loop on shell exit
+        try:
+            os.waitpid (self.child_pid, 0)
+        except OSError:
+            pass
+
+    def _kill (self):
+        """kill the shell and hang up its terminal"""
+        try:
+            os.kill (self.child_pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.close (self.master_fd)
+        except OSError:
+            pass
+        try:
+            os.waitpid (self.child_pid, 0)
+        except OSError:
+            pass
 
-    def _exec (self, cmd):
-        """execute a command"""
-        while not self.lock.acquire (0):
-            time.sleep (SLEEPTIME)
-        os.write (self.master_fd, cmd+os.linesep)
+    def _exec (self, cmd, frame=None):
+        """execute a command.
+        blocks until the previous command (if any) is done.
+        the output of a framed command line is collected into `frame`.
+        """
+        self.lock.acquire()
+        self._send (cmd, frame)
+
+    def _send (self, cmd, frame=None):
+        """send a command, the lock being held"""
+        self._frame = frame
+        if not self.alive:
+            self.lock.release()
+            raise OSError, 'shell (pid=%d) is not running' % self.child_pid
+        if frame is not None:
+            frame.sent (cmd)
+        try:
+            os.write (self.master_fd, cmd+os.linesep)
+        except OSError:
+            self.lock.release()
+            raise
         
     def _wait_lock (self):
-        """wait for the lock to become available"""
+        """wait for the lock to become available.
+        blocks on the lock itself, unless `while_waiting` has been overridden
+        in which case it is called repeatedly until the command is done.
+        """
+        if self.while_waiting.im_func is BasicShell.while_waiting.im_func:
+            self.lock.acquire()
+            self.lock.release()
+            return
         while self.lock.locked():
             self.while_waiting()
 
@@ -207,45 +490,79 @@ class BasicShell (object):
         self.echo = not not onoff
 
     def reset_buffer (self):
-        self.buf = ''
+        self.buf = []
 
     @property
     def buffer (self):
-        return self.buf
+        buf = ''.join (self.buf)
+        self.buf = [buf]
+        return buf
 
     def output (self, data):
-        """dump output"""
+        """dump output, intercepting the exit codes of framed commands"""
+        frame = self._frame
+        if frame is not None and frame.echoed (data):
+            return
+        res = _split_rc (data, self._rc_tag, self._rc_rex)
+        if res is None:
+            return                                    # echo of a sentinel
+        data, rc = res
+        if frame is not None and not frame.add (data, rc):
+            return                # streamed output is neither echoed nor kept
+        if not data:
+            return
         if self.echo:
             self.write (data)
         else:
-            self.buf = self.buf + data
+            self.buf.append (data)
+
+    def _command (self, line):
+        """called by the dispatch loop with the lines following a prompt:
+        the echo of a command line, or the output of a line of a multi-line
+        command once all of them have been echoed (see `_Frame.echoed`)"""
+        frame = self._frame
+        if frame is None or frame.echoed (line) or frame.echo:
+            self.command (line)
+        else:
+            self.output (_unprompt (line)+os.linesep)
+
+    def _end_frame (self):
+        """called by the dispatch loop when the command line is done"""
+        frame = self._frame
+        if frame is not None and frame.sink is not None:
+            frame.sink (None)
+
+    def _frame_cmd (self, cmd, idx):
+        """append to `cmd` the sentinel reporting its exit code"""
+        return _frame_cmd (cmd, idx, self._rc_tag, self._rc_var)
+
+    def _run_framed (self, cmds, keep=True):
+        """execute `cmds` in one go, each command being
+        followed by a sentinel carrying its exit code, so the outputs and
+        exit codes all come back in one round-trip.
+        return the list of (status, output) for each command (the outputs
+        are only collected if `keep` is True)
+        """
+        frame = _Frame (keep=keep, ncmds=len (cmds))
+        self._exec ('\n'.join ([self._frame_cmd (cmd, i)
+                                for i, cmd in enumerate (cmds)]),
+                    frame)
+        self._wait_lock()
+        return frame.status (len (cmds))
 
+    @timed
     def system (self, cmd):
         """execute a command and return the status code.
         Similar to `os.system()`, except that there is no subshell
         """
 
-        # execute the command and wait for it to be done
-        self._exec (cmd)
-        self._wait_lock()
-
         if not self.interactive:
-            # retrieve status code for shell
-            echo, buf = self.echo, self.buf
-            self.echo, self.buf = 0, ''
-            self._exec ('echo $?')
-            self._wait_lock()
-
-            try:
-                status = int (self.buf)
-            except ValueError:
-                msg.debug ('process exit status can not be determined')
-                status = -1
-
-            self.echo = echo
-            self.buf  = buf
+            # the status code comes back along with the output
+            status = self._run_framed ([cmd], keep=False)[0][0]
         else:
             # no way of really knowing...
+            self._exec (cmd)
+            self._wait_lock()
             status = 0
             
         # clean-up any waiting taskes
@@ -254,6 +571,51 @@ class BasicShell (object):
         # done
         return status
 
+    def stream (self, cmd, callback=None):
+        """execute a command and process its output line by line, as it is
+        produced, without buffering it.
+        If `callback` is None, return an iterator over the output lines:
+        the exit code is then available as its `status` attribute once it
+        has been exhausted. Otherwise call `callback(line)` for each line
+        and return the exit code.
+        """
+        lines = _OutputStream (self, cmd)
+        if callback is None:
+            return lines
+        for line in lines:
+            callback (line)
+        return lines.status
+
+    def run_batch (self, cmds):
+        """execute the list of commands `cmds` in as few round-trips as
+        possible: they are sent together, in chunks of at most `MAXLINE`
+        characters.
+        Commands are run one after the other, in the same shell.
+
+        return the list of (status, output) for each command
+        """
+        echo = self.echo
+        self.set_echo (onoff=0)
+        self.reset_buffer()
+
+        results = []
+        try:
+            chunk, size = [], 0
+            for cmd in cmds:
+                n = len (cmd) + len (self._rc_tag) + 16
+                if chunk and MAXLINE < size + n:
+                    results.extend (self._run_framed (chunk))
+                    chunk, size = [], 0
+                chunk.append (cmd)
+                size += n
+            if chunk:
+                results.extend (self._run_framed (chunk))
+        finally:
+            self.set_echo (onoff=echo)
+            self.reset_buffer()
+        self.stop_waiting()
+        return [(status, out.strip()) for status, out in results]
+
     def while_waiting (self):
         """wait processing"""
         pass
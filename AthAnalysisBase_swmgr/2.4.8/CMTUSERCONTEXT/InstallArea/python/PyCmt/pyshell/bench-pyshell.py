@@ -0,0 +1,73 @@
+# @file: pyshell/bench-pyshell.py
+
+"""micro-benchmarks for pyshell: round-trips per second to a local shell"""
+
+import os, sys, time
+import optparse
+
+import localshell
+import vt100
+
+### helpers -------------------------------------------------------------------
+def bench (name, fct, n):
+    """run `fct` `n` times and print the achieved rate"""
+    t0, c0 = time.time(), time.clock()
+    for i in xrange(n):
+        fct()
+    wall, cpu = time.time()-t0, time.clock()-c0
+    print '%-24s %6i calls  %8.1f calls/s  (wall=%6.3fs cpu=%6.3fs)' % (
+        name, n, n/wall, wall, cpu)
+    return n/wall
+
+def bench_vt100 (size):
+    """throughput of the vt100 filter on a `size` bytes capture, filtered
+    line by line (as the dispatch loop does) and as a whole"""
+    from pyshell_unittest import vt100_filter_ref
+    sample = ['#   use AthenaKernel AthenaKernel-00-42-07 Control (no_auto_imports)',
+              '\x1b[01;34mInstallArea\x1b[0m  \x1b[01;32mrun.sh\x1b[0m  x86_64-slc6\r',
+              'compiling Foo.cxx   \x08\x08\x08\x08100%',
+              'CMTPATH=/afs/cern.ch/atlas/software/builds/AtlasOffline/17.0.0']
+    lines = []
+    while size > 0:
+        lines.append (sample[len(lines) % len(sample)])
+        size -= len(lines[-1])+1
+    data = '\n'.join (lines)
+    mb = len(data) / 1e6
+    for name, fct in (('vt100.filter (ref)', vt100_filter_ref),
+                      ('vt100.filter',       vt100.filter)):
+        for mode, args in (('lines', lines), ('buffer', [data])):
+            t0 = time.time()
+            for l in args:
+                fct (l)
+            wall = time.time()-t0
+            print '%-24s %6.1f MB     %8.1f MB/s     (wall=%6.3fs)' % (
+                '%s/%s' % (name, mode), mb, mb/wall, wall)
+
+def main ():
+    parser = optparse.OptionParser (usage='%prog [options]')
+    parser.add_option ('-n', '--nbr', dest='n', type='int', default=200,
+                       help='number of round-trips per benchmark')
+    parser.add_option ('--mb', dest='mb', type='float', default=1.,
+                       help='size (in MB) of the capture for the vt100 bench')
+    opts, args = parser.parse_args()
+
+    bench_vt100 (int (opts.mb*1e6))
+
+    sh = localshell.LocalShell()
+    bench ('getstatusoutput(true)', lambda: sh.getstatusoutput('true'), opts.n)
+    bench ('system(true)',          lambda: sh.system('true'),          opts.n)
+    bench ('getenv(HOME)',          lambda: sh.getenv('HOME'),          opts.n)
+    bench ('getcwd()',              sh.getcwd,                          opts.n)
+    nb = max (1, opts.n/50)
+    rate = bench ('run_batch(50*true)',
+                  lambda: sh.run_batch(['true']*50), nb)
+    print '%-24s %6i cmds   %8.1f cmds/s' % ('  => per command', nb*50, rate*50)
+    # large outputs
+    bench ('getstatusoutput(seq 1e5)',
+           lambda: sh.getstatusoutput('seq 100000'), 3)
+    bench ('stream(seq 1e5)',
+           lambda: sh.stream('seq 100000', lambda line: None), 3)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit (main())
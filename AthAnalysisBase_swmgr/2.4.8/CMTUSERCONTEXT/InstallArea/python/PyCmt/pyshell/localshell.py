@@ -3,63 +3,162 @@
 """Talk programmatically to a local shell, via pseudo-terminal"""
 
 # stdlib imports
-import os, pty, sys
+import collections, os, pty, re, stat, sys
 import logging
 
 # project imports
 import basicshell
+from utils import _parse_env, _quote
 
 ### data ----------------------------------------------------------------------
 __all__ = [
     'LocalShell',
+    'PathStat',
     ]
 msg = logging.getLogger ('LocalShell')
 if len(msg.handlers) == 0:
     logging.basicConfig()
 
+# commands which may modify the environment of the shell: the environment
+# snapshot is discarded after any of them
+_env_cmds = re.compile (
+    r'(?:^|[\s;&|(`{])'
+    r'(?:(?:source|\.|export|unset|setenv|unsetenv|asetup|eval|exec|'
+    r'cd|pushd|popd|set|declare|typeset|readonly)(?=[\s;&|)]|$)'
+    r'|[A-Za-z_][A-Za-z0-9_]*=)')
+
+# values which are exported verbatim by 'export name=value'
+_plain_value = re.compile (r'^[\w@%+=:,./-]*$')
+
+# characters which make the shell expand a path
+_expanded = re.compile (r'[$~*?\[`{]')
+
 ### helpers -------------------------------------------------------------------
 class _EnvMapping (object):
-    """helper class to get and put environment variables"""
+    """helper class to get and put environment variables.
+    reads are served from the environment snapshot of the shell. variables
+    set to an empty string are reported as missing.
+    """
     def __init__ (self, sh):
         self.shell = sh
     def __getitem__ (self, key):
-        value = self.shell.getenv (key)
+        value = self.shell._environ().get (key)
         if not value:
             raise KeyError, key
         return value
     def __setitem__ (self, key, value):
         self.shell.putenv (key, value)
-    def has_key (self, key):
-        try:
-            return not not self.shell.getenv (key)
-        except KeyError:
-            return False
+    def __delitem__ (self, key):
+        self.shell.unsetenv (key)
+    def __contains__ (self, key):
+        return not not self.shell._environ().get (key)
+    has_key = __contains__
+    def get (self, key, default=None):
+        return self.shell._environ().get (key) or default
+    def keys (self):
+        return self.shell._environ().keys()
     def items (self):
-        d = {}
-        sc, out = self.shell.getstatusoutput ('env')
-        if sc:
-            return d
-        import re
-        pat = re.compile (r'(?P<EnvKey>.*?)=(?P<EnvValue>.*)')
-        for l in out.splitlines():
-            if l.count('=') <= 0:
-                continue
-            m = re.match (pat, l)
-            if m is None:
-                print "::: [%s]"%l
-                raise RuntimeError ("err")
-            assert m is not None, "%s"%m
-            m = m.groupdict()
-            d[m['EnvKey']] = m['EnvValue']
-        return d
+        return self.shell._environ().copy()
     
+class PathStat (collections.namedtuple ('PathStat',
+                                        'path exists mode size mtime')):
+    """result of `_PathMapping.stat_many` for one path (symlinks are
+    followed). mode, size and mtime are None if the path does not exist or
+    could not be stat'ed"""
+    __slots__ = ()
+    def isdir (self):
+        return self.mode is not None and stat.S_ISDIR (self.mode)
+    def isfile (self):
+        return self.mode is not None and stat.S_ISREG (self.mode)
+
 class _PathMapping (object):
-    """helper class to mimic os.path"""
+    """helper class to mimic os.path.
+    queries are answered by the shell (relative paths are relative to its
+    current directory), in one round-trip for a list of paths. answers of
+    `exists` are cached until the shell runs another command.
+    """
     def __init__ (self, sh):
         self.shell = sh
+        self._cache = {}
+        self._cache_gen = -1
+
+    def stat_many (self, paths):
+        """return the list of `PathStat` of `paths`, taken literally (no
+        shell expansion)"""
+        paths = list (paths)
+        if not paths:
+            return []
+        sh = self.shell
+        fin, fout = sh._tmpfile ('paths-in'), sh._tmpfile ('paths-out')
+        f = open (fin, 'wb')
+        try:
+            f.write ('\0'.join (paths) + '\0')
+        finally:
+            f.close()
+        cmd = ("xargs -0 -r stat -L --printf '%%n\\0%%f\\0%%s\\0%%Y\\0' -- "
+               "< '%s' > '%s'" % (fin, fout))
+        if sh.shellc == 'c':
+            cmd = '(%s) >& /dev/null' % cmd
+        else:
+            cmd = cmd + ' 2>/dev/null'
+
+        # xargs exits with 123 if some of the paths do not exist
+        found = None
+        if sh.system (cmd) in (0, 123):
+            f = open (fout, 'rb')
+            try:
+                fields = f.read().split ('\0')[:-1]
+            finally:
+                f.close()
+            if len(fields) % 4 == 0:
+                found = {}
+                for i in xrange (0, len(fields), 4):
+                    name, mode, size, mtime = fields[i:i+4]
+                    try:
+                        found[name] = (int (mode, 16), int (size), int (mtime))
+                    except ValueError:
+                        found = None
+                        break
+        if found is None:
+            # no GNU stat: existence only
+            msg.debug ('falling back to test -e for stat_many')
+            results = sh.run_batch (['test -e '+_quote (p) for p in paths])
+            return [PathStat (p, status == 0, None, None, None)
+                    for p, (status, out) in zip (paths, results)]
+
+        results = []
+        for p in paths:
+            st = found.get (p)
+            if st is None:
+                results.append (PathStat (p, False, None, None, None))
+            else:
+                results.append (PathStat (p, True, *st))
+        return results
+
+    def exists_many (self, paths):
+        """return the list of the existence flags of `paths` (taken
+        literally), querying the shell at most once"""
+        paths = list (paths)
+        cache = self._valid_cache()
+        missing = [p for p in set (paths) if p not in cache]
+        if missing:
+            for st in self.stat_many (missing):
+                cache[st.path] = st.exists
+            self._cache, self._cache_gen = cache, self.shell._gen
+        return [cache[p] for p in paths]
+
     def exists (self, path):
-        status, output = self.shell.getstatusoutput('/bin/ls -ld '+path)
-        return not status
+        if _expanded.search (path):
+            # let the shell expand the path
+            status, output = self.shell.getstatusoutput('/bin/ls -ld '+path)
+            return not status
+        return self.exists_many ([path])[0]
+
+    def _valid_cache (self):
+        if self._cache_gen != self.shell._gen:
+            self._cache, self._cache_gen = {}, self.shell._gen
+        return self._cache
+
     def __getattr__ (self, name):
         try:
             msg.debug ('selecting [%s] from os.path...', name)
@@ -84,6 +183,15 @@ class LocalShell (basicshell.BasicShell):
         # maintain front process state
         self.interactive = 0
 
+        # client-side snapshot of the environment of the shell (see `_environ`)
+        self._env = None
+
+        # scratch files exchanged with the shell (see `_tmpfile`)
+        self._tmpfiles = {}
+
+        # count of the commands run so far (see `_PathMapping`)
+        self._gen = 0
+
         # environmental control
         self.environ = _EnvMapping (self)
 
@@ -104,6 +212,57 @@ class LocalShell (basicshell.BasicShell):
     def command (self, cmd):
         pass
 
+    def _exec (self, cmd, frame=None):
+        # forget about the environment snapshot if `cmd` may modify it
+        if self._env is not None and _env_cmds.search (cmd):
+            self._env = None
+        try:
+            return super (LocalShell, self)._exec (cmd, frame)
+        finally:
+            self._gen += 1
+
+    def _tmpfile (self, name):
+        """return the path of the scratch file `name`, to exchange data with
+        the shell"""
+        fname = self._tmpfiles.get (name)
+        if fname is None:
+            import tempfile
+            fd, fname = tempfile.mkstemp (prefix='pyshell-%s-' % name)
+            os.close (fd)
+            self._tmpfiles[name] = fname
+        return fname
+
+    def _environ (self):
+        """return the snapshot of the environment of the shell, capturing it
+        (in one round-trip, via 'env -0') if needed"""
+        env = self._env
+        if env is not None:
+            return env
+        fname = self._tmpfile ('env')
+        if self.system ("env -0 > '%s'" % fname) == 0:
+            f = open (fname, 'rb')
+            try:
+                entries = f.read().split ('\0')
+            finally:
+                f.close()
+        else:
+            # no 'env -0': newlines within values can not be told apart
+            sc, out = self.getstatusoutput ('env')
+            entries = out.splitlines()
+        env = _parse_env (entries)
+        self._env = env
+        return env
+
+    def close (self, block=True):
+        """logout and remove the scratch files (see `BasicShell.close`)"""
+        super (LocalShell, self).close (block)
+        for fname in self._tmpfiles.values():
+            try:
+                os.remove (fname)
+            except OSError:
+                pass
+        self._tmpfiles = {}
+
     def run (self, cmd, verbose=False):
         """shorthand for `getstatusoutput` with check of status
         """
@@ -159,11 +318,19 @@ class LocalShell (basicshell.BasicShell):
         else:
             self.cwd = dir
 
-        if self.system ('cd '+dir) != 0:
+        # enter and reset current working directory cache in one go
+        env = self._env
+        (stat, out), (_, cwd) = self.run_batch (['cd '+dir, 'pwd'])
+        if stat != 0:
             raise OSError, 'can\'t enter [%s]'%dir
+        self.cwd = cwd
 
-        # reset current working directory cache
-        self.getcwd()
+        # 'cd' only updates $PWD and $OLDPWD
+        if env is not None:
+            if 'PWD' in env:
+                env['OLDPWD'] = env['PWD']
+            env['PWD'] = cwd
+            self._env = env
 
     def mkdir (self, dir):
         """create `dir` in the current working directory.
@@ -187,7 +354,11 @@ class LocalShell (basicshell.BasicShell):
             raise OSError, 'can\'t symlink [%s] as [%s]' % (src, dst)
 
     def getenv (self, name):
-        """get an environment variable"""
+        """get an environment variable (from the environment snapshot) or a
+        variable of the shell which has not been exported"""
+        env = self._environ()
+        if name in env:
+            return env[name]
         stat, out = self.getstatusoutput ('echo $%s'%name)
 
         # env may contain an error message if the envvar does not exist
@@ -197,18 +368,29 @@ class LocalShell (basicshell.BasicShell):
 
     def putenv (self, name, value):
         """set an environment variable"""
+        env = self._env
         if self.shellc == 'c':
             status = self.system ('setenv %s %s' % (name, value))
         else:
             status = self.system ('export %s=%s' % (name, value))
+
+        # update the snapshot rather than capturing it again, unless the
+        # shell had to expand `value`
+        if status == 0 and env is not None and _plain_value.match (value):
+            env[name] = value
+            self._env = env
         return status
 
     def unsetenv (self, name):
         """remove an environment variable"""
+        env = self._env
         if self.shellc == 'c':
             status = self.system ('unsetenv '+name)
         else:
             status = self.system ('unset '+name)
+        if status == 0 and env is not None:
+            env.pop (name, None)
+            self._env = env
         return status
 
     def getstatusoutput (self, cmd, *args, **kwd):
@@ -2,16 +2,38 @@
 
 """unit tests for pyshell"""
 
-import logging, os, unittest
+import logging, os, random, unittest
 
 import utils
 import localshell
+import asyncshell
+import shellpool
+import vt100
 
 ### data ----------------------------------------------------------------------
 msg = logging.getLogger ('pyshell-test')
 if len(msg.handlers)==0:
     logging.basicConfig()
 
+def vt100_filter_ref (line_p):
+    """reference (character by character) implementation of `vt100.filter`
+    """
+    line, i, imax = '', 0, len(line_p)
+    while i<imax:
+        ac = ord(line_p[i])
+        if (32<=ac<127) or ac in (9,10): # printable, \t, \n
+            line += line_p[i]
+        elif ac == 27:                   # remove coded sequences
+            i += 1
+            while i<imax and line_p[i].lower() not in 'abcdhsujkm':
+                i += 1
+        elif ac == 8 or (ac==13 and
+                         line and line[-1] == ' '): # backspace or EOL spacing
+            if line:
+                line = line[:-1]
+        i += 1
+    return line
+
 ### registration --------------------------------------------------------------
 class ShellUtilsTestCase (unittest.TestCase):
     def setUp (self):
@@ -25,6 +47,44 @@ class ShellUtilsTestCase (unittest.TestCase):
         sf = utils.shell_family (os)
         self.assert_ (sf==utils.BASH or sf==utils.CSH)
 
+    def test2_source (self):
+        """environment delta of a sourced script"""
+        import shutil, tempfile
+        tmpdir = tempfile.mkdtemp()
+        cachedir = os.environ.get ('PYCMT_CACHEDIR')
+        try:
+            os.environ['PYCMT_CACHEDIR'] = tmpdir
+            base = os.path.join (tmpdir, 'setup')
+            f = open (base+utils.shell_ext (os), 'w')
+            f.write ('setenv PYSHELL_SPACES "a  b"\nunsetenv PYSHELL_GONE\n'
+                     if utils.shell_family (os) == utils.CSH else
+                     'export PYSHELL_SPACES="a  b"\nunset PYSHELL_GONE\n')
+            f.close()
+            for i in range (2):                     # 2nd one from the cache
+                env = {'PYSHELL_GONE': '1'}
+                os.environ['PYSHELL_GONE'] = '1'
+                self.assertEqual (utils.source (base, env=env), 0)
+                self.assertEqual (env, {'PYSHELL_SPACES': 'a  b'})
+        finally:
+            os.environ.pop ('PYSHELL_GONE', None)
+            if cachedir is None:
+                del os.environ['PYCMT_CACHEDIR']
+            else:
+                os.environ['PYCMT_CACHEDIR'] = cachedir
+            shutil.rmtree (tmpdir)
+
+    def test3_imports (self):
+        """every module can be imported first (no import cycle)"""
+        import subprocess, sys
+        here = os.path.dirname (os.path.abspath (__file__))
+        for mod in ('utils', 'basicshell', 'localshell', 'asyncshell',
+                    'shellpool'):
+            p = subprocess.Popen ([sys.executable, '-c', 'import '+mod],
+                                  cwd=here, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+            out = p.communicate()[0]
+            self.assertEqual (p.returncode, 0, '%s: %s' % (mod, out))
+
 class LocalShellTestCase (unittest.TestCase):
     def setUp (self):
         self.sh = localshell.LocalShell()
@@ -44,6 +104,162 @@ class LocalShellTestCase (unittest.TestCase):
         msg.debug ('shell output of ls in %s:\n%s',
                    self.sh.getcwd(), out[:-1])
 
+    def test3_environ (self):
+        """environment snapshot of a local shell"""
+        self.sh.putenv ('PYSHELL_TEST', 'foo')
+        self.assertEqual (self.sh.environ['PYSHELL_TEST'], 'foo')
+        self.sh.system ("export PYSHELL_TEST=\"$(printf 'a\\nb=c')\"")
+        self.assertEqual (self.sh.getenv ('PYSHELL_TEST'), 'a\nb=c')
+        self.sh.unsetenv ('PYSHELL_TEST')
+        self.assert_ (not self.sh.environ.has_key ('PYSHELL_TEST'))
+        # shell variables which are not exported, empty variables
+        self.sh.system ('PYSHELL_LOCAL=1; export PYSHELL_EMPTY=')
+        self.assertEqual (self.sh.getenv ('PYSHELL_LOCAL'), '1')
+        self.assert_ ('PYSHELL_LOCAL' not in self.sh.environ.keys())
+        self.assertEqual (self.sh.getenv ('PYSHELL_EMPTY'), '')
+        self.assertRaises (KeyError, self.sh.environ.__getitem__,
+                           'PYSHELL_EMPTY')
+        self.assert_ (not self.sh.environ.has_key ('PYSHELL_EMPTY'))
+        self.assertEqual (self.sh.getenv ('PYSHELL_NOT_SET'), '')
+
+    def test4_path (self):
+        """batched path queries in a local shell"""
+        self.sh.chdir ('/')
+        sts = self.sh.path.stat_many (['tmp', '/no/such/path', 'tmp'])
+        self.assertEqual ([st.exists for st in sts], [True, False, True])
+        self.assert_ (sts[0].isdir() and not sts[0].isfile())
+        self.assertEqual (self.sh.path.exists_many (['/no/such/path', '/']),
+                          [False, True])
+        self.assert_ (not self.sh.path.exists ('/no/such/path'))
+
+    def test5_stream (self):
+        """streamed output is bounded and can be abandoned"""
+        import basicshell, time
+        n = 4*basicshell.STREAMQUEUE
+        lines = self.sh.stream ('seq %d' % n)
+        self.assertEqual (lines.next().strip(), '1')
+        time.sleep (0.5)                    # slow consumer: the shell waits
+        self.assert_ (lines._queue.qsize() <= basicshell.STREAMQUEUE)
+        self.assertEqual (len (list (lines)), n-1)
+        self.assertEqual (lines.status, 0)
+        lines = self.sh.stream ('seq %d' % n)
+        lines.next()
+        del lines                           # remaining output is discarded
+        self.assertEqual (self.sh.getstatusoutput ('echo ok'), (0, 'ok'))
+
+    def test6_framing (self):
+        """exit codes of commands with comments, here-documents or lines"""
+        sh = self.sh
+        self.assertEqual (sh.getstatusoutput ('false # c'), (1, ''))
+        self.assertEqual (sh.getstatusoutput ('cat <<EOF\nx\nEOF'), (0, 'x'))
+        self.assertEqual (sh.getstatusoutput ('echo a\necho b'), (0, 'a\nb'))
+        self.assertEqual (sh.getstatusoutput ('echo a\n(exit 3)'), (3, 'a'))
+        self.assertEqual (sh.getstatusoutput ('echo ok'), (0, 'ok'))
+        self.assertEqual (sh.run_batch (['echo 1 # c', 'false',
+                                         'cat <<EOF\ny\nEOF', 'echo a\necho b']),
+                          [(0, '1'), (1, ''), (0, 'y'), (0, 'a\nb')])
+
+    def test7_exit_busy (self):
+        """exiting does not wait for the commands of busy shells"""
+        import subprocess, sys, time
+        here = os.path.dirname (os.path.abspath (__file__))
+        script = '; '.join ([
+            'import threading, time, localshell',
+            'sh = localshell.LocalShell()',
+            't = threading.Thread (target=sh.system, args=("sleep 60",))',
+            't.setDaemon (True)',
+            't.start()',
+            'time.sleep (0.5)',
+            ])
+        start = time.time()
+        p = subprocess.Popen ([sys.executable, '-c', script], cwd=here)
+        self.assertEqual (p.wait(), 0)
+        self.assert_ (time.time() - start < 10)
+
+class ShellPoolTestCase (unittest.TestCase):
+    def setUp (self):
+        def setup (sh, key):
+            sh.putenv ('PYSHELL_KEY', key)
+        self.pool = shellpool.ShellPool (size=1, setup=setup)
+
+    def tearDown (self):
+        self.pool.close()
+
+    def test1_reset (self):
+        """pooled shells are reset on check-in"""
+        with self.pool.session ('foo') as sh:
+            sh.system ('export PYSHELL_KEY=bar PYSHELL_TEST=1; cd /')
+            pid = sh.child_pid
+        with self.pool.session ('foo') as sh:
+            self.assertEqual (sh.child_pid, pid)
+            self.assertEqual (sh.getenv ('PYSHELL_KEY'), 'foo')
+            self.assert_ (not sh.environ.has_key ('PYSHELL_TEST'))
+            self.assertEqual (sh.getcwd(), os.getcwd())
+
+    def test2_warm (self):
+        """warming a pool never waits for more sessions than allowed"""
+        pool = shellpool.ShellPool (size=2, maxsize=1)
+        try:
+            pool.warm ('foo')
+            self.assertEqual (pool._live['foo'], 1)
+            with pool.session ('foo') as sh:
+                self.assertEqual (sh.system ('true'), 0)
+        finally:
+            pool.close()
+
+class AsyncLocalShellTestCase (unittest.TestCase):
+    def setUp (self):
+        self.shells = [asyncshell.AsyncLocalShell() for i in range (4)]
+
+    def tearDown (self):
+        for f in [sh.close() for sh in self.shells]:
+            f.result (10)
+
+    def test1_run (self):
+        """concurrent commands in async local shells"""
+        fs = [sh.run ('echo %d; (exit %d)' % (i, i%2))
+              for i, sh in enumerate (self.shells)]
+        for i, f in enumerate (fs):
+            self.assertEqual (f.result (10), (i%2, str(i)))
+        sh = self.shells[0]
+        sh.putenv ('PYSHELL_TEST', 'foo')
+        self.assertEqual (sh.getenv ('PYSHELL_TEST').result (10), 'foo')
+
+    def test2_timeout (self):
+        """timeout and cancellation of async commands"""
+        sh = self.shells[0]
+        f = sh.run ('sleep 10', timeout=0.2)
+        self.assertRaises (asyncshell.TimeoutError, f.result, 10)
+        f, q = sh.run ('sleep 10'), sh.run ('echo queued')
+        self.assert_ (sh.cancel (q) and sh.cancel (f))
+        self.assertRaises (asyncshell.CancelledError, f.result, 10)
+        self.assertEqual (sh.run ('echo ok').result (10), (0, 'ok'))
+
+class Vt100TestCase (unittest.TestCase):
+    def test1_known_sequences (self):
+        """vt100 filter of typical terminal output"""
+        for line in ('plain text\tand tab\n',
+                     '\x1b[01;34mdir\x1b[0m  file\r',
+                     'abc\x08\x08d \r\r',
+                     '\x08\x08\rx  \r\r\r',
+                     '\x1b[?1034h_PY_SHELL_',
+                     'trailing escape\x1b[0',
+                     'bytes \x00\x07\x7f\x80\xff kept?',
+                     '\x1b\x1b\x08m\x08ok',
+                     ''):
+            self.assertEqual (vt100.filter (line), vt100_filter_ref (line))
+
+    def test2_random (self):
+        """vt100 filter of random strings"""
+        rnd = random.Random (1234)
+        alphabet = ('abcdmhjkABCDM[0;1?x\t\n\r\x08\x1b\x00\x7f\xe9 ' +
+                    ''.join ([chr(c) for c in range(256)]))
+        for i in xrange (3000):
+            line = ''.join ([rnd.choice (alphabet)
+                             for j in xrange (rnd.randint (0, 60))])
+            self.assertEqual (vt100.filter (line), vt100_filter_ref (line),
+                              repr (line))
+
 ## run test in standalone mode
 if __name__ == '__main__':
     unittest.main()
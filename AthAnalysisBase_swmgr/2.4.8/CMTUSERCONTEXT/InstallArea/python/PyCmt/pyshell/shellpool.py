@@ -0,0 +1,235 @@
+# @file: pyshell/shellpool.py
+
+"""A pool of pre-warmed local shells, set up once per environment key"""
+
+from __future__ import with_statement
+
+import threading
+import logging
+
+import localshell
+
+### data ----------------------------------------------------------------------
+__all__ = [
+    'ShellPool',
+    ]
+
+msg = logging.getLogger ('ShellPool')
+if len(msg.handlers) == 0:
+    logging.basicConfig()
+
+# environment variables the shell maintains by itself
+_VOLATILE_ENV = ('_', 'PWD', 'OLDPWD', 'SHLVL')
+
+### helpers -------------------------------------------------------------------
+_quote = localshell._quote
+
+class _Session (object):
+    """book-keeping of a pooled shell: its key and its pristine state"""
+    __slots__ = ('sh', 'key', 'cwd', 'env')
+    def __init__ (self, sh, key):
+        self.sh  = sh
+        self.key = key
+        self.cwd = sh.getcwd()
+        self.env = sh._environ().copy()
+
+### shell pool class ----------------------------------------------------------
+class ShellPool (object):
+    """A pool of ready-to-use `LocalShell` sessions.
+
+    Sessions are created (and set up) per environment key, e.g. the asetup
+    tags of a release, and handed out to one user at a time. On check-in,
+    their working directory and environment are reset to the ones they had
+    right after their set up. Shells which died or can not be reset are
+    retired.
+
+    usage:
+     pool = ShellPool (setup=lambda sh, key: sh.run ('source setup.sh '+key))
+     with pool.session ('17.0.0') as sh:
+         sc, out = sh.getstatusoutput ('cmt show path')
+    """
+
+    def __init__ (self, size=2, maxsize=None, setup=None,
+                  factory=localshell.LocalShell):
+        """
+         `size`     number of idle sessions kept per key
+         `maxsize`  maximum number of live sessions per key (None: no limit)
+                    `checkout` blocks while it is reached
+         `setup`    callable(sh, key) setting up a fresh shell for `key`
+         `factory`  callable returning a fresh shell
+        """
+        self.size    = size
+        self.maxsize = maxsize
+        self.setup   = setup
+        self.factory = factory
+
+        self._cond   = threading.Condition()
+        self._idle   = {}      # key -> [idle sessions]
+        self._live   = {}      # key -> number of live sessions
+        self._busy   = {}      # id(sh) -> checked out session
+        self._closed = False
+
+    def _new_session (self, key):
+        sh = self.factory()
+        try:
+            if self.setup is not None:
+                self.setup (sh, key)
+            return _Session (sh, key)
+        except:
+            sh.close()
+            raise
+
+    def _retire (self, session):
+        msg.debug ('retiring shell (pid=%d) of [%s]',
+                   session.sh.child_pid, session.key)
+        session.sh.close()
+        with self._cond:
+            self._live[session.key] -= 1
+            self._cond.notify_all()
+
+    def _reset (self, session):
+        """restore the working directory and environment of `session`.
+        return False if it could not be done.
+        """
+        sh = session.sh
+        if not sh.alive or sh.interactive:
+            return False
+        try:
+            env, orig = sh._environ(), session.env
+        except OSError:
+            return False
+        if env == orig and sh.cwd == session.cwd:
+            return True
+
+        cmds = ['cd '+_quote (session.cwd)]
+        for k in set (env) | set (orig):
+            if k in _VOLATILE_ENV or env.get (k) == orig.get (k):
+                continue
+            if k not in orig:
+                if sh.shellc == 'c':
+                    cmds.append ('unsetenv '+k)
+                else:
+                    cmds.append ('unset '+k)
+            elif '\n' in orig[k]:
+                return False          # would not fit on a single line
+            elif sh.shellc == 'c':
+                cmds.append ('setenv %s %s' % (k, _quote (orig[k])))
+            else:
+                cmds.append ('export %s=%s' % (k, _quote (orig[k])))
+        try:
+            results = sh.run_batch (cmds)
+        except OSError:
+            return False
+        if [sc for sc, out in results if sc != 0]:
+            return False
+        sh.cwd = session.cwd
+        return True
+
+    def warm (self, key, n=None):
+        """set up `n` sessions for `key` (default: the size of the pool)
+        concurrently and keep them idle (up to the size of the pool).
+        at most `maxsize` sessions are set up: all of them are checked out
+        before any is checked back in.
+        """
+        if n is None:
+            n = self.size
+        if self.maxsize is not None:
+            n = min (n, self.maxsize)
+        shells, errors = [], []
+        def checkout():
+            try:
+                shells.append (self.checkout (key))
+            except Exception, err:
+                errors.append (err)
+        threads = [threading.Thread (target=checkout) for i in xrange (n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for sh in shells:
+            self.checkin (sh)
+        if errors:
+            raise errors[0]
+        return
+
+    def checkout (self, key):
+        """return a shell set up for `key`, creating it if needed.
+        it has to be given back via `checkin`.
+        """
+        with self._cond:
+            while 1:
+                if self._closed:
+                    raise RuntimeError ('shell pool is closed')
+                idle = self._idle.get (key)
+                if idle:
+                    session = idle.pop()
+                    if session.sh.alive:
+                        self._busy[id (session.sh)] = session
+                        return session.sh
+                    self._live[key] -= 1       # died while idle
+                    continue
+                if (self.maxsize is None or
+                    self._live.get (key, 0) < self.maxsize):
+                    self._live[key] = self._live.get (key, 0) + 1
+                    break
+                self._cond.wait()
+
+        # setting up a shell is slow: do it outside the lock
+        msg.debug ('starting a new shell for [%s]...', key)
+        try:
+            session = self._new_session (key)
+        except:
+            with self._cond:
+                self._live[key] -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._busy[id (session.sh)] = session
+        return session.sh
+
+    def checkin (self, sh):
+        """give the shell `sh` back to the pool"""
+        with self._cond:
+            session = self._busy.pop (id (sh))
+        if self._closed or not self._reset (session):
+            self._retire (session)
+            return
+        with self._cond:
+            idle = self._idle.setdefault (session.key, [])
+            if len (idle) < self.size:
+                idle.append (session)
+                self._cond.notify_all()
+                return
+        self._retire (session)
+
+    def session (self, key):
+        """context manager checking a shell for `key` out of the pool and
+        back in"""
+        return _PooledShell (self, key)
+
+    def close (self):
+        """retire all the idle sessions. busy ones are retired on check-in"""
+        with self._cond:
+            self._closed = True
+            sessions = [s for idle in self._idle.itervalues() for s in idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for session in sessions:
+            self._retire (session)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+    pass # ShellPool
+
+class _PooledShell (object):
+    def __init__ (self, pool, key):
+        self.pool, self.key, self.sh = pool, key, None
+    def __enter__ (self):
+        self.sh = self.pool.checkout (self.key)
+        return self.sh
+    def __exit__ (self, *exc):
+        self.pool.checkin (self.sh)
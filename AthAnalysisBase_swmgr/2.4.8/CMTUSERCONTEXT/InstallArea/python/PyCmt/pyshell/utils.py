@@ -5,21 +5,42 @@
 
 import logging, os, re
 from PyCmt.bwdcompat import subprocess
+import PyCmt.Cache as Cache
 
 ### data ----------------------------------------------------------------------
 __all__ = [
     'BASH', 'CSH',
     'shell_family', 'shell_ext',
+    'capture_env', 'diff_env',
     'source',
     ]
 
 BASH = 'bash'
 CSH  = 'csh'
 
+# environment variables maintained by the shell itself: they take no part in
+# the environment deltas and cache keys of `source`
+_VOLATILE_ENV = ('_', 'SHLVL', 'OLDPWD')
+
 msg = logging.getLogger ('shellutils')
 if len(msg.handlers)==0:
     logging.basicConfig()
 
+### helpers -------------------------------------------------------------------
+def _quote (value):
+    """single-quote `value` for the shell"""
+    return "'" + value.replace ("'", "'\\''") + "'"
+
+def _parse_env (entries):
+    """return the dict of environment variables out of the list of their
+    'name=value' `entries`"""
+    env = {}
+    for entry in entries:
+        k, sep, v = entry.partition ('=')
+        if sep:
+            env[k] = v
+    return env
+
 ### shell information ---------------------------------------------------------
 _shell_prog = {}
 def shell_name (shell=os):
@@ -90,10 +111,75 @@ def expand (name, shell=os):
     """return the expansion of `name` on the environment of `shell`"""
     return shell.path.expanduser (shell.path.expandvars(name))
 
+### environment capture -------------------------------------------------------
+def capture_env (cmd, family=BASH, cwd=None):
+    """run `cmd` in a sub-shell of the given `family` (without startup
+    files), from the environment of the current process and in directory
+    `cwd`, and capture the environment of the sub-shell before and after.
+    return (status, output, <env before>, <env after>); the environments are
+    None if `cmd` failed
+    """
+    import shutil, tempfile
+    tmpdir = tempfile.mkdtemp (prefix='pycmt-env-')
+    try:
+        before = os.path.join (tmpdir, 'before')
+        after  = os.path.join (tmpdir, 'after')
+        cmd = 'env -0 > %s && %s && env -0 > %s' % (
+            _quote (before), cmd, _quote (after))
+        if family == CSH:
+            argv = ['csh', '-f', '-c', cmd]
+        else:
+            argv = ['bash', '--noprofile', '--norc', '-c', cmd]
+        p = subprocess.Popen (argv, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, cwd=cwd)
+        out = p.communicate()[0]
+        envs = []
+        for fname in (before, after):
+            try:
+                f = open (fname, 'rb')
+            except IOError:
+                return p.returncode or 1, out, None, None
+            try:
+                envs.append (_parse_env (f.read().split ('\0')))
+            finally:
+                f.close()
+    finally:
+        shutil.rmtree (tmpdir, ignore_errors=True)
+    return p.returncode, out, envs[0], envs[1]
+
+def diff_env (before, after, ignore=_VOLATILE_ENV):
+    """return (<set or changed variables>, <unset variables>) from the
+    environment `before` to the environment `after`"""
+    changed = dict ((k, v) for k, v in after.iteritems()
+                    if before.get (k) != v and k not in ignore)
+    unset = [k for k in before if k not in after and k not in ignore]
+    return changed, unset
+
 ### source a file into the shell environment ----------------------------------
-def source (script, shell=os, env=None, args=''):
+
+def _source_cache_key (script, args, family):
+    """return the cache key of the environment delta of sourcing `script`:
+    it depends on the script (path and content), its arguments, and the
+    environment and directory it is sourced from"""
+    import hashlib
+    f = open (script, 'rb')
+    try:
+        digest = hashlib.sha1 (f.read()).hexdigest()
+    finally:
+        f.close()
+    env = sorted ((k, v) for k, v in os.environ.iteritems()
+                  if k not in _VOLATILE_ENV)
+    return Cache.cache_key (os.path.realpath (script), digest, args, family,
+                            os.getcwd(), env)
+
+def source (script, shell=os, env=None, args='', use_cache=True):
     """source environment settings from `script`.
     If `shell` is `os`, then an optional environment `env` can be given.
+    If `shell` is `os`, the variables set, changed or unset by `script` are
+    applied to `env` (default: `os.environ`). That delta is cached on disk
+    (see PyCmt.Cache) unless `use_cache` is False, keyed on the script and
+    its content, `args` and the current environment. Note that changes to
+    the files `script` itself sources are not tracked.
 
     return 0: all ok
     return 1: `script` can not be located
@@ -102,7 +188,15 @@ def source (script, shell=os, env=None, args=''):
     global msg
     
     script = expand (script, shell)
-    if not shell.path.exists (script):
+    if hasattr (shell.path, 'exists_many'):
+        # both candidates in one go
+        candidates = [script, script + shell_ext (shell)]
+        found = shell.path.exists_many (candidates)
+        if not (found[0] or found[1]):
+            msg.debug ('script [%s] does not exist', candidates[1])
+            return 1
+        script = candidates[not found[0]]
+    elif not shell.path.exists (script):
         script = script + shell_ext (shell)
         if not shell.path.exists (script):
             msg.debug ('script [%s] does not exist', script)
@@ -111,27 +205,37 @@ def source (script, shell=os, env=None, args=''):
     msg.debug ('sourcing [%s]', script)
     if shell is os:
         # the following executes on 'os'
-        stat, out = subprocess.getstatusoutput (
-            'source '+script+' '+args+' && env')
-        # verify success (note CMT workaround...)
-        if stat != 0 or len(out)==0 or out.find('No such file')>=0:
-            msg.debug ('sourcing of [%s] failed (code %d)\n%s',
-                       script, stat, shell.linesep.join(out.splitlines()))
-            return 2
-
-        out = re.split (shell.linesep, out)
-        envre = re.compile (r'(\S+)\s*=\s*(\S+)')
+        family = shell_family (shell)
+        key = delta = None
+        if use_cache:
+            key = _source_cache_key (script, args, family)
+            delta = Cache.load ('source_env', key)
+        if delta is None:
+            stat, out, before, after = capture_env (
+                'source %s %s' % (_quote (script), args), family)
+            # verify success (note CMT workaround...)
+            if stat != 0 or out.find('No such file')>=0:
+                msg.debug ('sourcing of [%s] failed (code %d)\n%s',
+                           script, stat, shell.linesep.join(out.splitlines()))
+                return 2
+            delta = diff_env (before, after)
+            if key is not None:
+                Cache.dump ('source_env', key, delta,
+                            files=[os.path.realpath (script)])
+        else:
+            msg.debug ('environment of [%s] from cache', script)
 
         # modify the environment (the sub-shell has exited)
         if env is None:
             env = shell.environ
 
         msg.debug ('setting environment variables...')
-        for o in out:
-            res = envre.search (o)
-            if res:
-                g = res.groups()
-                env[g[0]] = g[1]
+        changed, unset = delta
+        for k, v in changed.iteritems():
+            env[k] = v
+        for k in unset:
+            if k in env:
+                del env[k]
 
     else:
         # don't know how shell actually behaves,
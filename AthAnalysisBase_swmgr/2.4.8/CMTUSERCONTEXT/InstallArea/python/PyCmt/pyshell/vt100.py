@@ -2,25 +2,41 @@
 
 """vt100 decoder"""
 
+import re
+
 ## removal of escape sequences and the like
 
+# an escape runs up to (and including) the first of these letters
+_escape = re.compile (r'\x1b[^abcdhsujkmABCDHSUJKM]*(?:[abcdhsujkmABCDHSUJKM]|\Z)')
+
+# all the characters but the printable ones, \t, \n and the backspace and
+# carriage return which are interpreted
+_junk = ''.join ([chr(c) for c in range(256)
+                  if not (32<=c<127 or c in (8, 9, 10, 13))])
+
+_edit = re.compile ('([\x08\r])')
+
 def filter(line_p):
     """
     remove non-printable characters from line <line_p>
     return a printable string.
     """
-    line, i, imax = '', 0, len(line_p)
-    while i<imax:
-        ac = ord(line_p[i])
-        if (32<=ac<127) or ac in (9,10): # printable, \t, \n
-            line += line_p[i]
-        elif ac == 27:                   # remove coded sequences
-            i += 1
-            while i<imax and line_p[i].lower() not in 'abcdhsujkm':
-                i += 1
-        elif ac == 8 or (ac==13 and
-                         line and line[-1] == ' '): # backspace or EOL spacing
-            if line:
-                line = line[:-1]
-        i += 1
-    return line
+    line = line_p
+    if '\x1b' in line:
+        line = _escape.sub ('', line)
+    line = line.translate (None, _junk)
+    if not ('\x08' in line or '\r' in line):
+        return line
+
+    # backspace removes the previous character, carriage return a previous
+    # space (EOL spacing)
+    out = []
+    for tok in _edit.split (line):
+        if tok == '\x08' or (tok == '\r' and out and out[-1][-1] == ' '):
+            if out:
+                out[-1] = out[-1][:-1]
+                if not out[-1]:
+                    out.pop()
+        elif tok and tok != '\r':
+            out.append (tok)
+    return ''.join (out)
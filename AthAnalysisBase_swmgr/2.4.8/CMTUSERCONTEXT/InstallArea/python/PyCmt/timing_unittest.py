@@ -0,0 +1,113 @@
+# @file: timing_unittest.py
+
+"""unit tests for the instrumentation of PyCmt.Timing"""
+
+import json, os, shutil, subprocess, sys, tempfile, unittest
+
+import PyCmt.Timing as Timing
+from PyCmt.Timing import timed
+
+### data ----------------------------------------------------------------------
+def parse (lines, strict=False):
+    if strict:
+        raise ValueError ('bad lines')
+    return len (lines)
+
+script = """\
+from PyCmt.Timing import timed
+@timed
+def parse (lines):
+    return len (lines)
+parse ('abc')
+"""
+
+### timing --------------------------------------------------------------------
+class TimingTestCase (unittest.TestCase):
+    def setUp (self):
+        self.top = tempfile.mkdtemp()
+        self.enabled = Timing.enabled
+        Timing.reset()
+
+    def tearDown (self):
+        Timing.enabled = self.enabled
+        Timing.reset()
+        shutil.rmtree (self.top)
+
+    def test1_disabled (self):
+        """functions are left untouched when disabled"""
+        Timing.enabled = False
+        self.assert_ (timed (parse) is parse)
+        self.assert_ (timed ('cmt.parse', size=len) (parse) is parse)
+        self.assertEqual (timed (parse) ('ab'), 2)
+        self.assertEqual (Timing.stats(), {})
+
+    def test2_stats (self):
+        """calls, errors and arguments sizes are collected"""
+        Timing.enabled = True
+        f = timed (parse)
+        g = timed ('cmt.parse', size=lambda args, kw: 100) (parse)
+        self.assert_ (f is not parse)
+        self.assertEqual (f.__name__, 'parse')
+        self.assertEqual ([f ('a'), f ('abcd'), f (range (5), False)],
+                          [1, 4, 5])
+        self.assertRaises (ValueError, f, 'abc', strict=True)
+        g ([])
+        stats = Timing.stats()
+        self.assertEqual (sorted (stats),
+                          ['cmt.parse', 'timing_unittest.parse'])
+        st = stats['timing_unittest.parse']
+        self.assertEqual ((st['count'], st['errors']), (4, 1))
+        # 'a': <2, 'abc': <4, 'abcd' and range(5): <8 (bools have no size)
+        self.assertEqual (st['sizes'], {'<2': 1, '<4': 1, '<8': 2})
+        self.assert_ (0 <= st['wall_max'] <= st['wall'])
+        self.assertEqual (stats['cmt.parse']['sizes'], {'<128': 1})
+        Timing.reset()
+        self.assertEqual (Timing.stats(), {})
+
+    def test3_report (self):
+        """flat and JSON reports"""
+        Timing.enabled = True
+        f = timed (parse)
+        f ('abc')
+        fname = os.path.join (self.top, 'timing.txt')
+        Timing.report (fname)
+        Timing.report (fname)               # appended
+        with open (fname) as r:
+            lines = r.read().splitlines()
+        self.assertEqual (len (lines), 6)
+        self.assert_ (lines[0].startswith ('## PyCmt timing report -- pid %d'
+                                           % os.getpid()))
+        fields = lines[2].split()
+        self.assertEqual (fields[0:2], ['timing_unittest.parse', '1'])
+        self.assertEqual (fields[-2:], ['0', '<4:1'])
+        fname = os.path.join (self.top, 'timing-%p.json')
+        Timing.report (fname)
+        fname = fname.replace ('%p', str (os.getpid()))
+        with open (fname) as r:
+            data = json.load (r)
+        self.assertEqual (data['pid'], os.getpid())
+        self.assertEqual (data['functions']['timing_unittest.parse']['count'],
+                          1)
+
+    def test4_at_exit (self):
+        """$PYCMT_TIMING enables the instrumentation and the report at exit"""
+        fname = os.path.join (self.top, 'timing.json')
+        env = dict (os.environ)
+        env['PYCMT_TIMING'] = fname
+        env['PYTHONPATH'] = os.pathsep.join (sys.path)
+        sc = subprocess.call ([sys.executable, '-c', script], env=env)
+        self.assertEqual (sc, 0)
+        with open (fname) as r:
+            data = json.load (r)
+        # the script name of '-c' is '-c'
+        self.assertEqual (data['functions'].keys(), ['-c.parse'])
+        self.assertEqual (data['functions']['-c.parse']['sizes'], {'<4': 1})
+        env['PYCMT_TIMING'] = '0'
+        os.remove (fname)
+        self.assertEqual (subprocess.call ([sys.executable, '-c', script],
+                                           env=env), 0)
+        self.assert_ (not os.path.exists (fname))
+
+## run test in standalone mode
+if __name__ == '__main__':
+    unittest.main()
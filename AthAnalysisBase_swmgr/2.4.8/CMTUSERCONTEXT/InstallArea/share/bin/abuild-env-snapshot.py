@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+__doc__ = """run asetup once and save the environment it sets up as a flat shell script, which restores it in a fresh shell without the asetup/CMT overhead"""
+
+### imports --------------------------------------------------------------------
+import os
+import sys
+
+try:
+    import PyCmt
+except ImportError:
+    # not set up yet: pick up our own InstallArea
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, os.pardir, 'python'))
+from PyCmt import EnvSnapshot
+from PyCmt.Timing import timed
+
+### globals --------------------------------------------------------------------
+_default_output = '.env-snapshot.sh'
+
+### functions ------------------------------------------------------------------
+@timed
+def main():
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog [options] [asetup-tags]",
+        description="""\
+run 'asetup <asetup-tags>' (e.g. AthAnalysisBase,2.4.8,here) from the work
+directory and save the resulting environment as a shell script. sourcing that
+script restores the environment, unless the release install tree changed (it
+then returns 1 and the snapshot should be rebuilt, e.g. with --update)."""
+        )
+    parser.add_option(
+        '-o', '--output-file',
+        default=_default_output,
+        help='the snapshot to write [default=%default]')
+    parser.add_option(
+        '-w', '--workdir',
+        default=None,
+        help='the directory to run asetup from [default=the current one]')
+    parser.add_option(
+        '--asetup-root',
+        default=None,
+        help='the AtlasSetup installation [default=$AtlasSetup]')
+    parser.add_option(
+        '--setup',
+        default=None,
+        help='a setup command to run instead of asetup')
+    parser.add_option(
+        '--check',
+        action='store_true',
+        default=False,
+        help='only check the snapshot is up to date (exit code 0) or not (1)')
+    parser.add_option(
+        '--update',
+        action='store_true',
+        default=False,
+        help='rebuild the snapshot only if it is stale. the setup command and '
+             'work directory of the snapshot are reused if not given')
+    parser.add_option(
+        '-v', '--verbose',
+        action='store_true',
+        default=False,
+        help='enable verbose output')
+
+    opts, args = parser.parse_args()
+    fname = opts.output_file
+
+    if opts.check:
+        return not EnvSnapshot.is_valid(fname)
+
+    if opts.update and EnvSnapshot.is_valid(fname):
+        if opts.verbose:
+            print "::: snapshot [%s] is up to date" % fname
+        return 0
+
+    setup, workdir = opts.setup, opts.workdir
+    if setup is None and args:
+        setup = EnvSnapshot.asetup_cmd(' '.join(args), opts.asetup_root)
+    if opts.update:
+        hdr = EnvSnapshot.read_header(fname) or {}
+        if setup is None:
+            setup = hdr.get('setup')
+        if workdir is None:
+            workdir = hdr.get('workdir')
+    if setup is None:
+        parser.error('no asetup tags nor setup command given')
+
+    print ":"*80
+    print "::: taking environment snapshot of [%s]..." % setup
+    try:
+        snap = EnvSnapshot.take(setup, workdir)
+    except RuntimeError, err:
+        print "**ERROR** %s" % err
+        return 1
+    EnvSnapshot.write(snap, fname)
+    if opts.verbose:
+        for name in sorted(snap['changed']):
+            print "::: %s=%s" % (name, snap['changed'][name])
+    print "::: saved [%d] variables (and [%d] unset ones) into [%s]" % (
+        len(snap['changed']), len(snap['unset']), fname)
+    print ":"*80
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
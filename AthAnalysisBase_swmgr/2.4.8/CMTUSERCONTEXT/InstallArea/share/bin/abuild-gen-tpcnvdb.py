@@ -6,9 +6,19 @@ import os
 import subprocess
 
 try:
-    from PyUtils.Decorators import forking
+    from PyCmt.Decorators import forking_pool
 except ImportError:
-    def forking(fct):
+    forking_pool = None
+    try:
+        from PyUtils.Decorators import forking
+    except ImportError:
+        def forking(fct):
+            return fct
+
+try:
+    from PyCmt.Timing import timed
+except ImportError:
+    def timed(fct):
         return fct
 
 _exclude_list = [
@@ -70,24 +80,38 @@ def _get_id(fct):
         return props['id']
     return props['name']
 
-@forking
+_bkg = None
+"""the factories available before loading any library to inspect"""
+
+def _warmup():
+    """load the libraries needed to inspect T/P converter libraries and record
+    the factories they provide"""
+    global _bkg
+    pyathena = import_pyathena()
+    pyathena.load_library('AthenaKernelDict')
+    _bkg = set(_get_id(fct) for fct in _get_mbr_factories())
+
+def _run_isolated(fct):
+    """run `fct` in a process of its own, or in one of a pool of (warmed-up)
+    long-lived processes if available"""
+    if forking_pool is None:
+        return forking(fct)
+    # the factories of the libraries inspected before by the same worker are
+    # not local symbols of the next ones: recycling workers is only needed to
+    # bound their memory
+    return forking_pool(processes=1, warmup=_warmup, maxtasks=50)(fct)
+
+@timed
+@_run_isolated
 def inspect_library(libname):
     tpcnv_db = {}
     print "::: inspecting [%s]..." % (libname,)
+    if _bkg is None:
+        _warmup()
+    bkg = _bkg
     pyathena = import_pyathena()
-    pyathena.load_library('AthenaKernelDict')
     is_in_dso = pyathena.Athena.DsoUtils.inDso
 
-    members = _get_mbr_factories()
-    
-    #print "-->",len(members)
-    bkg = set()
-    for i,fct in enumerate(members):
-        ident = _get_id(fct)
-        #print "==",ident
-        bkg.add(ident)
-    #bkg = list(bkg)
-
     # load the component library
     print "::: loading [%s]..." % (libname,)
     dso = pyathena.load_library(libname)
@@ -138,6 +162,7 @@ def inspect_library(libname):
         
     return tpcnv_db
 
+@timed
 def inspect_installarea(topdir=None):
     if topdir is None:
         cmtpath = os.environ['CMTPATH']
@@ -174,6 +199,7 @@ def inspect_installarea(topdir=None):
 
     return tpcnv_db
 
+@timed
 def save_tpcnv_db(tpcnv_db, fname):
     """save the registry of T/P converter into file `fname`
     
@@ -199,6 +225,7 @@ def save_tpcnv_db(tpcnv_db, fname):
 
     return
 
+@timed
 def main():
     import argparse
     parser = argparse.ArgumentParser(
@@ -294,6 +321,8 @@ def main():
     for topdir in install_area:
         print "::  install-area [%s]..." % (topdir,)
         db.update(inspect_installarea(topdir=topdir))
+    if forking_pool is not None:
+        inspect_library.pool.close()
     save_tpcnv_db(db, args.output_file)
 
     print "::: bye."
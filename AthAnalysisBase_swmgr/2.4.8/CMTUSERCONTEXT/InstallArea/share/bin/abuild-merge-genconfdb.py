@@ -10,6 +10,12 @@ import shutil
 import getopt
 import subprocess
 
+try:
+    from PyCmt.Timing import timed
+except ImportError:
+    def timed(fct):
+        return fct
+
 _useropts = "o:vh"
 _userlongopts = [
     "install-area=",
@@ -29,6 +35,7 @@ Accepted command line options:
 
 ### functions ------------------------------------------------------------------
 
+@timed
 def collect_genconfdb_fnames(topdir,
                              pattern='*confDb.py',
                              exclude_pattern='*_merged_confDb.py'):
@@ -55,6 +62,7 @@ def collect_genconfdb_fnames(topdir,
     print "::: collecting genconfdb files... [done] (nbr=%i)" % (len(all_files),)
     return all_files
     
+@timed
 def merge_files(fnames, ofname):
     """merge the content of all files `fnames` into the file `ofname`
     """
@@ -70,6 +78,7 @@ def merge_files(fnames, ofname):
     print "::: merging files into [%s]... [done]" % (ofname,)
     return 0
 
+@timed
 def do_merge_files(topdir, ofname,
                    pattern='*_confDb.py',
                    exclude_pattern='*_merged_confDb.py'):
@@ -84,6 +93,7 @@ def do_merge_files(topdir, ofname,
 
     return merge_files(confdb_fnames, ofname)
 
+@timed
 def main():
     """the main entry point of this script
     """
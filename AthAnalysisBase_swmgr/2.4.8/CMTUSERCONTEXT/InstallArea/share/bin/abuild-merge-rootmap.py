@@ -10,6 +10,12 @@ import shutil
 import getopt
 import subprocess
 
+try:
+    from PyCmt.Timing import timed
+except ImportError:
+    def timed(fct):
+        return fct
+
 ### globals --------------------------------------------------------------------
 _dsomap_exclude_list = [
     "TestRootConversions1Dict.dsomap",
@@ -65,6 +71,7 @@ def _is_in_ignore_list(fname):
     bfname = os.path.basename(fname)
     return bfname in _dsomap_exclude_list
 
+@timed
 def collect_dsomap_fnames(topdir, pattern=['*.dsomap','*.rootmap']):
     """ recursively inspect the `topdir` directory for files named '*.dsomap'
         returns a list of unique real paths
@@ -99,6 +106,7 @@ def collect_dsomap_fnames(topdir, pattern=['*.dsomap','*.rootmap']):
     print "::: collecting dsomap files... [done] (nbr=%i)" % (len(all_files),)
     return all_files
     
+@timed
 def merge_files(fnames, ofname):
     """merge the content of all files `fnames` into the file `ofname`
     """
@@ -114,6 +122,7 @@ def merge_files(fnames, ofname):
     print "::: merging files into [%s]... [done]" % (ofname,)
     return 0
 
+@timed
 def do_merge_files(topdir, ofname, pattern=['*.dsomap','*.rootmap']):
 
     if isinstance(topdir, basestring):
@@ -124,6 +133,7 @@ def do_merge_files(topdir, ofname, pattern=['*.dsomap','*.rootmap']):
         dsomap_fnames.extend(collect_dsomap_fnames(d, pattern))
     return merge_files(dsomap_fnames, ofname)
 
+@timed
 def main():
     """the main entry point of this script
     """